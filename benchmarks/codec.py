@@ -0,0 +1,103 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+# Microbenchmark of the message codec.
+#
+# Times decoding and encoding of updates with elements of growing size,
+# using every backend installed (json, ujson, orjson, msgpack), plus the
+# cost of the old path that encoded a failed update again before
+# publishing it to the error queue.
+#
+#     python -m benchmarks.codec --properties 10,100,1000 --number 2000
+import argparse
+import json
+import timeit
+
+from globomap_loader import codec
+
+
+def make_update(properties):
+    return {
+        'action': 'UPDATE', 'type': 'collections', 'collection': 'vip',
+        'key': 'bench_vip_1',
+        'element': {
+            'id': 'vip_1', 'name': 'vip_1', 'provider': 'bench',
+            'timestamp': 1501448160,
+            'properties': {'property_{}'.format(i): 'value {}'.format(i)
+                           for i in range(properties)},
+            'properties_metadata': {
+                'property_{}'.format(i): {'description': 'Property {}'.format(i)}
+                for i in range(properties)},
+        },
+    }
+
+
+def backends():
+    """(name, loads, dumps) of every installed backend."""
+    found = [('json', json.loads,
+              lambda document: json.dumps(document).encode('utf-8'))]
+    if codec.ujson is not None:
+        found.append(('ujson', codec.ujson.loads,
+                      lambda document: codec.ujson.dumps(document).encode()))
+    if codec.orjson is not None:
+        found.append(('orjson', codec.orjson.loads, codec.orjson.dumps))
+    if codec.msgpack is not None:
+        found.append((
+            'msgpack',
+            lambda body: codec.msgpack.unpackb(body, raw=False),
+            lambda document: codec.msgpack.packb(document, use_bin_type=True)
+        ))
+    return found
+
+
+def run(properties, number):
+    rows = []
+    for size in properties:
+        update = make_update(size)
+        for name, loads, dumps in backends():
+            body = dumps(update)
+            decode = timeit.timeit(lambda: loads(body), number=number)
+            encode = timeit.timeit(lambda: dumps(update), number=number)
+            rows.append({
+                'properties': size, 'backend': name, 'bytes': len(body),
+                'decode_us': decode / number * 1e6,
+                'encode_us': encode / number * 1e6,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Message codec microbenchmark')
+    parser.add_argument('--properties', default='10,100,1000',
+                        help='Comma separated element sizes')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Repetitions of each measurement')
+    args = parser.parse_args()
+
+    rows = run([int(size) for size in args.properties.split(',')],
+               args.number)
+    print('Default JSON backend: {}'.format(codec.JSON_BACKEND))
+    print('{:>10} {:>8} {:>9} {:>11} {:>11}'.format(
+        'properties', 'backend', 'bytes', 'decode us', 'encode us'))
+    for row in rows:
+        print('{properties:>10} {backend:>8} {bytes:>9} '
+              '{decode_us:>11.1f} {encode_us:>11.1f}'.format(**row))
+    print('Re-publishing the original body of a failed update skips the '
+          'encode column.')
+
+
+if __name__ == '__main__':
+    main()
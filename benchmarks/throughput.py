@@ -0,0 +1,349 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+# End-to-end throughput benchmark of the loader.
+#
+# Each scenario starts FACTOR worker processes. Every worker builds a
+# GenericDriver and a DriverWorker exactly as the loader does, but its
+# consumer talks to the in-memory broker of tests/fake_amqp.py holding its
+# share of the messages, and the GloboMap client talks to the fake API of
+# tests/fake_api.py served by this process. A worker stops once all its
+# messages are acked, then reports its timings; the scenario reports
+# messages/sec, p50/p99 end-to-end latency (publish to ack), CPU seconds
+# per message and peak RSS.
+#
+#     python -m benchmarks.throughput --messages 5000 \
+#         --factor 1,2 --prefetch 0,100 --batch-size 1,20 \
+#         --latency lognormal:0.005,0.5 --output results.json
+#
+# Results are written as JSON so runs of two releases can be compared
+# with --compare.
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from tests.fake_api import FakeGloboMapAPI
+from tests.fake_api import WRITE_CONFLICT
+from tests.fake_api import constant
+from tests.fake_api import lognormal
+from tests.fake_api import uniform
+
+DEFAULT_MIX = 'PATCH=0.7,UPDATE=0.1,CREATE=0.1,DELETE=0.1'
+COLLECTIONS = (
+    ('collections', 'vip'), ('collections', 'pool'),
+    ('collections', 'comp_unit'), ('edges', 'port'),
+)
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        action, _, weight = item.partition('=')
+        mix.append((action.strip().upper(), float(weight or 1)))
+    return mix
+
+
+def generate_updates(count, keys, mix):
+    """Random updates over `keys` documents per collection, the actions
+    picked with the weights of `mix`."""
+    actions, weights = zip(*mix)
+    for _ in range(count):
+        kind, collection = random.choice(COLLECTIONS)
+        key = random.randrange(keys)
+        action = random.choices(actions, weights)[0]
+        element = {'id': 'doc{}'.format(key), 'provider': 'bench',
+                   'name': 'doc{}'.format(key),
+                   'timestamp': int(time.time())}
+        if kind == 'edges':
+            element['from'] = 'vip/bench_doc{}'.format(key)
+            element['to'] = 'pool/bench_doc{}'.format(key)
+        yield {'body': {
+            'action': action, 'type': kind, 'collection': collection,
+            'key': 'bench_doc{}'.format(key), 'element': element,
+        }}
+
+
+def read_capture(path, count):
+    """Replays a capture of JSON lines, either raw update bodies or
+    {"body": ..., "headers": ...} records, cycling up to `count`."""
+    with open(path) as capture:
+        records = [json.loads(line) for line in capture if line.strip()]
+    if not records:
+        raise ValueError('Empty capture {}'.format(path))
+    records = [record if 'body' in record else {'body': record}
+               for record in records]
+    return [records[i % len(records)] for i in range(count or len(records))]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def distribution(value):
+    name, _, args = value.partition(':')
+    args = [float(arg) for arg in args.split(',') if arg]
+    return {'constant': constant, 'uniform': uniform,
+            'lognormal': lognormal}[name](*args)
+
+
+class CountingExceptionHandler(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def handle_exception(self, driver_name, update, **kwargs):
+        self.count += 1
+
+
+def run_worker(shard_path, rate):
+    """Consumes a shard of messages and prints the worker report."""
+    from globomap_loader.driver.generic import GenericDriver
+    from globomap_loader.loader.globomap import GloboMapClient
+    from globomap_loader.loader.loader import DriverWorker
+    from globomap_loader.settings import GLOBOMAP_API_URL
+    from tests.fake_amqp import FakeBroker
+    from tests.fake_amqp import consume_until_drained
+
+    with open(shard_path) as shard:
+        records = [json.loads(line) for line in shard]
+
+    broker = FakeBroker(expected=len(records))
+    handler = CountingExceptionHandler()
+    worker = DriverWorker(
+        GloboMapClient(GLOBOMAP_API_URL), GenericDriver(), handler)
+    callback, auto_ack = worker._setup_pipeline()
+
+    def publish():
+        interval = 1.0 / rate if rate else 0
+        for record in records:
+            body = record['body']
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            broker.publish(body, record.get('headers'))
+            if interval:
+                time.sleep(interval)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    publisher = threading.Thread(target=publish)
+    publisher.daemon = True
+    publisher.start()
+    consume_until_drained(worker.driver, broker, callback, auto_ack,
+                          worker._prefetch_count())
+    elapsed = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    for component in ('batcher', 'dispatcher', 'retry_scheduler',
+                      'prefetch_controller'):
+        if getattr(worker, component, None) is not None:
+            getattr(worker, component).stop()
+
+    cpu = (after.ru_utime - usage.ru_utime) + \
+        (after.ru_stime - usage.ru_stime)
+    print(json.dumps({
+        'messages': len(records),
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'max_rss_kb': after.ru_maxrss,
+        'acked': broker.acked,
+        'dropped': broker.dropped,
+        'redelivered': broker.redelivered,
+        'ack_frames': broker.ack_frames,
+        'error_publishes': handler.count,
+        'latencies': broker.latencies,
+    }))
+
+
+def run_scenario(api, records, config, rate, extra_env):
+    factor = config['FACTOR']
+    env = dict(os.environ, **extra_env)
+    env.update({key: str(value) for key, value in config.items()})
+    env.update({
+        'GLOBOMAP_API_URL': api.url,
+        'GLOBOMAP_API_USERNAME': 'bench', 'GLOBOMAP_API_PASSWORD': 'bench',
+        'GLOBOMAP_RMQ_HOST': 'fake', 'GLOBOMAP_RMQ_USER': 'bench',
+        'GLOBOMAP_RMQ_PASSWORD': 'bench', 'GLOBOMAP_RMQ_VIRTUAL_HOST': '/',
+        'GLOBOMAP_RMQ_QUEUE_NAME': 'bench', 'GLOBOMAP_RMQ_EXCHANGE': 'bench',
+    })
+
+    shards, workers = [], []
+    for index in range(factor):
+        shard = tempfile.NamedTemporaryFile(
+            'w', suffix='.jsonl', delete=False)
+        for record in records[index::factor]:
+            shard.write(json.dumps(record) + '\n')
+        shard.close()
+        shards.append(shard.name)
+        workers.append(subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.throughput',
+             '--worker', shard.name, '--rate', str(rate / factor)],
+            env=env, stdout=subprocess.PIPE))
+
+    requests_before = api.requests()
+    started = time.time()
+    reports = []
+    for process in workers:
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('Worker failed with {}'.format(
+                process.returncode))
+        reports.append(json.loads(output.decode().strip().splitlines()[-1]))
+    wall = time.time() - started
+    for shard in shards:
+        os.unlink(shard)
+
+    latencies = list(itertools.chain.from_iterable(
+        report.pop('latencies') for report in reports))
+    messages = sum(report['messages'] for report in reports)
+    elapsed = max(report['elapsed'] for report in reports)
+    return {
+        'config': config,
+        'messages': messages,
+        'elapsed': elapsed,
+        'wall': wall,
+        'msgs_per_sec': messages / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'cpu_per_message': sum(r['cpu'] for r in reports) / messages,
+        'max_rss_kb': max(r['max_rss_kb'] for r in reports),
+        'acked': sum(r['acked'] for r in reports),
+        'redelivered': sum(r['redelivered'] for r in reports),
+        'ack_frames': sum(r['ack_frames'] for r in reports),
+        'error_publishes': sum(r['error_publishes'] for r in reports),
+        'api_requests': api.requests() - requests_before,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    previous = {json.dumps(s['config'], sort_keys=True): s
+                for s in baseline['scenarios']}
+    for scenario in results['scenarios']:
+        old = previous.get(json.dumps(scenario['config'], sort_keys=True))
+        if not old:
+            continue
+        print('{}: {:.0f} -> {:.0f} msgs/s ({:+.1%}), p99 {:.4f} -> '
+              '{:.4f}s'.format(
+                  scenario['config'], old['msgs_per_sec'],
+                  scenario['msgs_per_sec'],
+                  scenario['msgs_per_sec'] / old['msgs_per_sec'] - 1,
+                  old['latency_p99'], scenario['latency_p99']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loader throughput benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--keys', type=int, default=500,
+                        help='Documents per collection')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument('--capture', help='JSON lines capture to replay')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages/sec published, 0 queues all first')
+    parser.add_argument('--factor', default='1')
+    parser.add_argument('--prefetch', default='0')
+    parser.add_argument('--batch-size', default='1')
+    parser.add_argument('--lanes', default='0')
+    parser.add_argument('--env', action='append', default=[],
+                        help='KEY=VALUE passed to every worker')
+    parser.add_argument('--latency', type=distribution,
+                        default='constant:0.001',
+                        help='API latency: constant:S, uniform:LOW,HIGH '
+                             'or lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--fail', action='append', default=[],
+                        help='STATUS:RATE injected in document requests, '
+                             'e.g. 503:0.01 or 1200:0.05')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='Previous results to compare')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.worker:
+        return run_worker(args.worker, args.rate)
+
+    if args.capture:
+        records = read_capture(args.capture, args.messages)
+    else:
+        records = list(generate_updates(args.messages, args.keys, args.mix))
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    api = FakeGloboMapAPI(latency=args.latency)
+    for fault in args.fail:
+        status, _, rate = fault.partition(':')
+        if int(status) == WRITE_CONFLICT:
+            api.write_conflict(rate=float(rate))
+        else:
+            api.fail(int(status), rate=float(rate), route='document')
+    api.start()
+
+    grid = itertools.product(
+        *[[int(value) for value in option.split(',')] for option in
+          (args.factor, args.prefetch, args.batch_size, args.lanes)])
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'messages': len(records),
+        'rate': args.rate,
+        'env': extra_env,
+        'scenarios': [],
+    }
+    try:
+        for factor, prefetch, batch_size, lanes in grid:
+            config = {'FACTOR': factor, 'PREFETCH_COUNT': prefetch,
+                      'BATCH_SIZE': batch_size, 'DISPATCH_LANES': lanes}
+            scenario = run_scenario(
+                api, records, config, args.rate, extra_env)
+            print('{config}: {msgs_per_sec:.0f} msgs/s, p50 '
+                  '{latency_p50:.4f}s, p99 {latency_p99:.4f}s, '
+                  '{cpu_per_message:.6f} cpu s/msg, {max_rss_kb} KB'
+                  .format(**scenario))
+            results['scenarios'].append(scenario)
+    finally:
+        api.stop()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
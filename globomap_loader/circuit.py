@@ -0,0 +1,212 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from globomap_loader import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class Backoff(object):
+    """
+    Delays between attempts to reach a dependency: the first attempt
+    after a failure is immediate, the next ones wait exponentially longer
+    from `base` up to `maximum` seconds, with jitter so that workers
+    failing together don't retry together.
+    """
+
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+        self.attempts = 0
+
+    def delay(self):
+        """Seconds to wait before the next attempt."""
+        self.attempts += 1
+        if self.attempts == 1:
+            return 0
+        delay = min(self.maximum, self.base * 2 ** (self.attempts - 2))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a dependency that keeps failing. The circuit opens
+    after `failure_threshold` failures in a row or, with a `window` of
+    seconds, once at least `min_calls` calls were made in the window and
+    `error_rate` of them failed or `slow_call_rate` of them took
+    `slow_call` seconds or more (0 ignores latency). An open circuit
+    refuses calls for `reset_timeout` seconds, then lets `probes` calls
+    through: it closes once they all succeed in time and opens again as
+    soon as one fails or is slow. A failure_threshold of 0 disables the
+    breaker, which then never opens.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout, window=0,
+                 error_rate=1.0, min_calls=10, slow_call=0,
+                 slow_call_rate=1.0, probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.window = window
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.slow_call_rate = slow_call_rate
+        self.probes = max(1, probes)
+        self.opened = 0
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = 0
+        self._probed = 0
+        # [second, calls, errors, slow calls] of the last window seconds
+        self._buckets = deque()
+        self._lock = threading.Lock()
+        metrics.BREAKER_STATE.labels(name).set(0)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._retry_after() <= 0:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """True if a call may be made now."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._retry_after() > 0:
+                    return False
+                self._set_state(HALF_OPEN)
+                self._probing = self._probed = 0
+            if self._probing >= self.probes:
+                return False
+            self._probing += 1
+            return True
+
+    def retry_after(self):
+        """Seconds until calls are allowed again."""
+        with self._lock:
+            if self._state != OPEN:
+                return 0
+            return max(self._retry_after(), 0)
+
+    def success(self, latency=None):
+        """Records a call that got an answer, taking `latency` seconds."""
+        with self._lock:
+            slow = bool(self.slow_call) and latency is not None and \
+                latency >= self.slow_call
+            self._observe(False, slow)
+            if self._state == HALF_OPEN:
+                self._probing = max(self._probing - 1, 0)
+                if slow:
+                    self._open('a slow probe')
+                    return
+                self._probed += 1
+                if self._probed >= self.probes:
+                    LOGGER.info('Circuit %s closed', self.name)
+                    self._set_state(CLOSED)
+                    self._failures = 0
+                    self._buckets.clear()
+            elif self._state == CLOSED:
+                self._failures = 0
+                if slow and self._tripped():
+                    self._open('slow calls')
+
+    def failure(self, latency=None):
+        with self._lock:
+            self._failures += 1
+            self._observe(True, False)
+            if self._state == HALF_OPEN:
+                self._probing = max(self._probing - 1, 0)
+                self._open('a failed probe')
+            elif self._state == CLOSED and self._tripped():
+                self._open('{} failures'.format(self._failures))
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            calls, errors, slow = self._window_counts()
+        return {
+            'open': int(state != CLOSED),
+            'state': STATE_CODES[state],
+            'failures': self._failures,
+            'opened': self.opened,
+            'error_rate': errors / calls if calls else 0,
+            'slow_rate': slow / calls if calls else 0,
+        }
+
+    def _retry_after(self):
+        return self._opened_at + self.reset_timeout - time.time()
+
+    def _set_state(self, state):
+        self._state = state
+        metrics.BREAKER_STATE.labels(self.name).set(STATE_CODES[state])
+
+    def _open(self, reason):
+        LOGGER.warning('Circuit %s opened for %ss after %s', self.name,
+                       self.reset_timeout, reason)
+        self._set_state(OPEN)
+        self._opened_at = time.time()
+        self.opened += 1
+
+    def _observe(self, error, slow):
+        if not self.window:
+            return
+        second = int(time.time())
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0, 0])
+        bucket = self._buckets[-1]
+        bucket[1] += 1
+        bucket[2] += error
+        bucket[3] += slow
+
+    def _window_counts(self):
+        horizon = time.time() - self.window
+        while self._buckets and self._buckets[0][0] < horizon:
+            self._buckets.popleft()
+        calls = sum(bucket[1] for bucket in self._buckets)
+        errors = sum(bucket[2] for bucket in self._buckets)
+        slow = sum(bucket[3] for bucket in self._buckets)
+        return calls, errors, slow
+
+    def _tripped(self):
+        if not self.failure_threshold:
+            return False
+        if self._failures >= self.failure_threshold:
+            return True
+        if not self.window:
+            return False
+        calls, errors, slow = self._window_counts()
+        return calls >= self.min_calls and (
+            errors >= calls * self.error_rate or
+            bool(self.slow_call) and slow >= calls * self.slow_call_rate)
+
@@ -0,0 +1,83 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+if orjson is not None:
+    JSON_BACKEND = 'orjson'
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+elif ujson is not None:
+    JSON_BACKEND = 'ujson'
+    _json_loads = ujson.loads
+
+    def _json_dumps(document):
+        return ujson.dumps(document, ensure_ascii=False).encode('utf-8')
+else:
+    JSON_BACKEND = 'json'
+    _json_loads = json.loads
+
+    def _json_dumps(document):
+        return json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+
+class UnsupportedContentType(ValueError):
+    pass
+
+
+def media_type(content_type):
+    """The media type of a content_type, without its parameters."""
+    return (content_type or '').split(';', 1)[0].strip().lower()
+
+
+def loads(body, content_type=None):
+    """
+    Decodes a message body by its AMQP content_type. msgpack bodies need
+    the msgpack package; any other body is JSON, decoded with the fastest
+    JSON library installed (orjson, ujson or the standard json module).
+    """
+    if media_type(content_type) in MSGPACK_TYPES:
+        return _msgpack().unpackb(body, raw=False)
+    return _json_loads(body)
+
+
+def dumps(document, content_type=None):
+    """Encodes a document to message body bytes, see loads."""
+    if media_type(content_type) in MSGPACK_TYPES:
+        return _msgpack().packb(document, use_bin_type=True)
+    return _json_dumps(document)
+
+
+def _msgpack():
+    if msgpack is None:
+        raise UnsupportedContentType(
+            'msgpack bodies need the msgpack package installed')
+    return msgpack
@@ -0,0 +1,80 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AckCoalescer(object):
+    """
+    Collects the acks of a channel and sends them as a single
+    Basic.Ack with multiple=True. The ack covers the highest acked
+    delivery tag below every delivery still unsettled, so a message that
+    is in progress, waiting for a retry or that failed is never acked by
+    accident. Must be used from the connection IOLoop.
+    """
+
+    def __init__(self, channel, max_pending):
+        self.channel = channel
+        self.max_pending = max_pending
+        self.frames = 0
+        self._outstanding = set()
+        self._acked = []
+
+    def delivered(self, delivery_tag):
+        self._outstanding.add(delivery_tag)
+
+    def ack(self, delivery_tag):
+        self._outstanding.discard(delivery_tag)
+        self._acked.append(delivery_tag)
+        if len(self._acked) >= self.max_pending:
+            self.flush()
+
+    def rejected(self, delivery_tag):
+        self._outstanding.discard(delivery_tag)
+
+    def pending(self):
+        return len(self._acked)
+
+    def flush(self, stragglers=False):
+        """Sends every ack that can be covered without touching an
+        unsettled delivery. With stragglers, acks held behind an unsettled
+        delivery are sent one by one, so a long retry does not exhaust the
+        prefetch window. Returns the highest delivery tag acked, if any."""
+        if not self._acked:
+            return None
+        limit = min(self._outstanding) if self._outstanding else None
+        if limit is None:
+            eligible, held = self._acked, []
+        else:
+            eligible = [tag for tag in self._acked if tag < limit]
+            held = [tag for tag in self._acked if tag > limit]
+
+        delivery_tag = None
+        if eligible:
+            delivery_tag = max(eligible)
+            LOGGER.debug('Acknowledging %s messages up to %s',
+                         len(eligible), delivery_tag)
+            self.channel.basic_ack(delivery_tag, multiple=True)
+            self.frames += 1
+        if stragglers:
+            for tag in sorted(held):
+                self.channel.basic_ack(tag)
+                self.frames += 1
+            delivery_tag = max(held + [delivery_tag or 0]) or None
+            held = []
+        self._acked = held
+        return delivery_tag
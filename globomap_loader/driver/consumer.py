@@ -1,9 +1,18 @@
-import json
+import functools
 import logging
+import threading
+import time
 
 import pika
 from pika import adapters
 
+from globomap_loader import codec
+from globomap_loader import metrics
+from globomap_loader.circuit import Backoff
+from globomap_loader.driver.ack import AckCoalescer
+from globomap_loader.logs import MessageSummary
+from globomap_loader.logs import SampledLogger
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -25,9 +34,27 @@ class RabbitMQClient(object):
         :param str amqp_url: The AMQP url to connect with
         """
         self._connection = None
+        self._callbacks_lock = threading.Lock()
+        self._pending_callbacks = []
         self._channel = None
         self._closing = False
-        self._consumer_tag = None
+        self._consumer_tags = []
+        self.queues = []
+        self.shard_exchange = None
+        self.shard_queues = []
+        self._pending_binds = 0
+        self.prefetch_count = 10
+        self.in_flight = 0
+        self.ack_batch_size = 1
+        self.ack_flush_interval = 1
+        self._acks = None
+        self._backoff = Backoff(1, 60)
+        self._breaker = None
+        self._disconnected_at = None
+        self._log = SampledLogger(LOGGER)
+        self._summary = None
+        self._received_at = {}
+        self.on_decode_error = None
 
         credentials = pika.PlainCredentials(user, password)
         self.parameters = pika.ConnectionParameters(
@@ -35,18 +62,89 @@ class RabbitMQClient(object):
             virtual_host=vhost, credentials=credentials
         )
 
-    def set_settings(self, exchange, queue, routing_keys, callback):
+    def set_settings(self, exchange, queue, routing_keys, callback,
+                     auto_ack=True, prefetch_count=10):
         """This method set exchange and queue info to use in consume.
         :param str exchange: The name of exchange
         :param str exchange_type: The type of exchange
         :param str queue: The name of queue
         :param str routing_keys: The routing key
+        :param bool auto_ack: Ack each message as soon as the callback
+            returns. When False the callback owns the delivery and must
+            settle it through acknowledge_message_threadsafe or
+            reject_message_threadsafe
+        :param int prefetch_count: Unacked deliveries RabbitMQ may send
         """
         self.exchange = exchange
         self.exchange_type = 'topic'
         self.queue = queue
+        self.queues = [queue]
         self.routing_keys = routing_keys
         self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+
+    def set_sharding(self, exchange, hash_header, shard_queues, queues):
+        """Consume from shards of the queue instead of the queue itself.
+        The updates exchange is bound to a consistent-hash exchange that
+        routes each message by the hash of its hash_header to one of the
+        shard queues. Every shard is declared and bound so the hash ring
+        stays whole, but only `queues` are consumed. Shards accept a
+        single active consumer, so a shard is never consumed by two
+        workers at once.
+        :param str exchange: The name of the consistent-hash exchange
+        :param str hash_header: The header the messages are hashed on
+        :param list shard_queues: The names of all the shard queues
+        :param list queues: The shard queues consumed by this client
+        """
+        self.shard_exchange = exchange
+        self.hash_header = hash_header
+        self.shard_queues = shard_queues
+        self.queues = queues
+
+    def set_decode_error_handler(self, handler):
+        """Hand the messages whose body cannot be decoded to handler, called
+        with the body, headers, content_type and the error. The message is
+        acked once handler returns, and rejected without requeue if it
+        raises or when there is no handler.
+        :param callable handler: Publishes the message somewhere else
+        """
+        self.on_decode_error = handler
+
+    def set_ack_coalescing(self, batch_size, flush_interval):
+        """Coalesce acks into Basic.Ack frames with multiple=True, sent
+        every batch_size acks or flush_interval seconds. A batch_size of
+        1 acks every message on its own.
+        :param int batch_size: Acks held before a flush
+        :param float flush_interval: Seconds between timed flushes
+        """
+        self.ack_batch_size = batch_size
+        self.ack_flush_interval = flush_interval
+
+    def set_log_sampling(self, rate, per_second, summary_interval,
+                         bypass=False):
+        """Write only a sample of the per-message records and a summary
+        of the messages processed every summary_interval seconds.
+        :param float rate: Fraction of the per-message records written
+        :param int per_second: Most per-message records written a second,
+            0 for no limit
+        :param float summary_interval: Seconds between summaries, 0
+            disables them
+        """
+        self._log = SampledLogger(LOGGER, rate, per_second, bypass)
+        self._summary = None
+        if summary_interval > 0:
+            self._summary = MessageSummary(
+                LOGGER, summary_interval, self._log)
+
+    def set_reconnect_policy(self, backoff, breaker=None):
+        """Reconnect after the delays of backoff, the first one right
+        away, and not while breaker is open.
+        :param Backoff backoff: Delays between reconnection attempts
+        :param CircuitBreaker breaker: Circuit of the broker
+        """
+        self._backoff = backoff
+        self._breaker = breaker
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -55,7 +153,9 @@ class RabbitMQClient(object):
         :rtype: pika.SelectConnection
         """
         LOGGER.info('Connecting to RabbitMQ')
-        return adapters.TornadoConnection(self.parameters, self.on_connection_open)
+        return adapters.TornadoConnection(
+            self.parameters, on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error)
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -78,12 +178,34 @@ class RabbitMQClient(object):
         :param str reply_text: The server provided reply_text if given
         """
         self._channel = None
+        self._acks = None
         if self._closing:
             self._connection.ioloop.stop()
         else:
-            LOGGER.warning('Connection closed, reopening in 5 seconds: (%s) %s',
-                           reply_code, reply_text)
-            self._connection.add_timeout(5, self.reconnect)
+            self._schedule_reconnect('Connection closed: (%s) %s' % (
+                reply_code, reply_text))
+
+    def on_connection_open_error(self, connection, error):
+        """Invoked by pika when the connection to RabbitMQ could not be
+        established.
+        :param pika.connection.Connection connection: The failed connection
+        :param error: The reason of the failure
+        """
+        if self._closing:
+            connection.ioloop.stop()
+        else:
+            self._schedule_reconnect('Connection failed: %s' % (error,))
+
+    def _schedule_reconnect(self, reason):
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+        if self._breaker:
+            self._breaker.failure()
+        delay = self._backoff.delay()
+        if self._breaker:
+            delay = max(delay, self._breaker.retry_after())
+        LOGGER.warning('%s, reconnecting in %.1f seconds', reason, delay)
+        self._connection.add_timeout(delay, self.reconnect)
 
     def on_connection_open(self, unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
@@ -92,6 +214,16 @@ class RabbitMQClient(object):
         :type unused_connection: pika.SelectConnection
         """
         LOGGER.info('Connection opened')
+        if self._closing:
+            self.close_connection()
+            return
+        self._backoff.reset()
+        if self._breaker:
+            self._breaker.success()
+        if self._disconnected_at is not None:
+            metrics.DISCONNECTED_SECONDS.labels('consumer').inc(
+                time.time() - self._disconnected_at)
+            self._disconnected_at = None
         self.add_on_connection_close_callback()
         self.open_channel()
 
@@ -101,7 +233,12 @@ class RabbitMQClient(object):
         """
         if not self._closing:
 
+            if self._breaker and not self._breaker.allow():
+                self._connection.add_timeout(
+                    max(self._breaker.retry_after(), 1), self.reconnect)
+                return
             # Create a new connection
+            metrics.RECONNECTS.labels('consumer').inc()
             self._connection = self.connect()
 
     def add_on_channel_close_callback(self):
@@ -123,6 +260,7 @@ class RabbitMQClient(object):
         """
         LOGGER.warning('Channel %i was closed: (%s) %s',
                        channel, reply_code, reply_text)
+        self._acks = None
         self._connection.close()
 
     def on_channel_open(self, channel):
@@ -133,6 +271,12 @@ class RabbitMQClient(object):
         """
         LOGGER.info('Channel opened')
         self._channel = channel
+        self.in_flight = 0
+        self._received_at = {}
+        self._acks = None
+        if self.ack_batch_size > 1:
+            self._acks = AckCoalescer(channel, self._ack_threshold())
+            self._schedule_ack_flush(self._acks)
         self.add_on_channel_close_callback()
         self.setup_exchange(self.exchange)
 
@@ -151,10 +295,66 @@ class RabbitMQClient(object):
     def on_exchange_declareok(self, unused_frame):
         """Invoked by pika when RabbitMQ has finished the Exchange.Declare RPC
         command.
-        :param pika.Frame.Method unused_frame: Exchange.DeclareOk response frame
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk frame
         """
         LOGGER.info('Exchange declared')
-        self.setup_queue(self.queue)
+        if self.shard_exchange:
+            self.setup_shard_exchange(self.shard_exchange)
+        else:
+            self.setup_queue(self.queue)
+
+    def setup_shard_exchange(self, exchange_name):
+        """Declare the consistent-hash exchange hashing on the shard
+        header. When it is complete, the on_shard_exchange_declareok method
+        will be invoked by pika.
+        :param str|unicode exchange_name: The name of the exchange to declare
+        """
+        LOGGER.info('Declaring exchange %s', exchange_name)
+        self._channel.exchange_declare(
+            self.on_shard_exchange_declareok, exchange_name,
+            'x-consistent-hash', durable=True,
+            arguments={'hash-header': self.hash_header})
+
+    def on_shard_exchange_declareok(self, unused_frame):
+        """Invoked by pika when the consistent-hash exchange is declared.
+        Binds it to the updates exchange and declares the shard queues;
+        consuming starts once every binding is done.
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk frame
+        """
+        self._pending_binds = len(self.routing_keys) + len(self.shard_queues)
+        for routing_key in self.routing_keys:
+            LOGGER.info('Binding %s to %s with %s',
+                        self.exchange, self.shard_exchange, routing_key)
+            self._channel.exchange_bind(
+                self.on_shard_bindok, self.shard_exchange, self.exchange,
+                routing_key)
+        for queue in self.shard_queues:
+            LOGGER.info('Declaring queue %s', queue)
+            self._channel.queue_declare(
+                functools.partial(self.on_shard_queue_declareok, queue),
+                queue, durable=True,
+                arguments={'x-single-active-consumer': True})
+
+    def on_shard_queue_declareok(self, queue, unused_frame):
+        """Invoked by pika when a shard queue is declared. Binds it to the
+        consistent-hash exchange with a weight of one, so every shard gets
+        an even part of the hash ring.
+        :param str queue: The name of the shard queue
+        :param pika.frame.Method unused_frame: The Queue.DeclareOk frame
+        """
+        LOGGER.info('Binding %s to %s', self.shard_exchange, queue)
+        self._channel.queue_bind(
+            self.on_shard_bindok, queue, self.shard_exchange, '1')
+
+    def on_shard_bindok(self, unused_frame):
+        """Invoked by pika when a binding of the shards is done. Starts
+        consuming after the last one.
+        :param pika.frame.Method unused_frame: The Bind response frame
+        """
+        self._pending_binds -= 1
+        if self._pending_binds == 0:
+            LOGGER.info('Shards bound')
+            self.start_consuming()
 
     def setup_queue(self, queue_name):
         """Setup the queue on RabbitMQ by invoking the Queue.Declare RPC
@@ -200,6 +400,7 @@ class RabbitMQClient(object):
         LOGGER.info('Consumer was cancelled remotely, shutting down: %r',
                     method_frame)
         if self._channel:
+            self.flush_acks()
             self._channel.close()
 
     def acknowledge_message(self, delivery_tag):
@@ -207,8 +408,92 @@ class RabbitMQClient(object):
         Basic.Ack RPC method for the delivery tag.
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
         """
-        LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        LOGGER.debug('Acknowledging message %s', delivery_tag)
+        metrics.MESSAGES_ACKED.inc()
+        if self._acks:
+            self._acks.ack(delivery_tag)
+        else:
+            self._channel.basic_ack(delivery_tag)
+
+    def flush_acks(self):
+        """Send every coalesced ack, including the ones held behind a
+        delivery still unsettled."""
+        if self._acks:
+            self._acks.flush(stragglers=True)
+
+    def _ack_threshold(self):
+        # Held acks count against the prefetch window, flush before it
+        # is exhausted.
+        return max(1, min(self.ack_batch_size, self.prefetch_count // 2))
+
+    def _schedule_ack_flush(self, coalescer):
+        self._connection.add_timeout(
+            self.ack_flush_interval,
+            functools.partial(self._flush_acks_on_timer, coalescer))
+
+    def _flush_acks_on_timer(self, coalescer):
+        if coalescer is not self._acks:
+            return
+        self.flush_acks()
+        self._schedule_ack_flush(coalescer)
+
+    def acknowledge_message_threadsafe(self, delivery_tag):
+        """Schedule the Basic.Ack of a deferred delivery on the IOLoop, so
+        it can be called from any thread. Deliveries of a channel that was
+        closed meanwhile are skipped, RabbitMQ will redeliver them.
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        """
+        self.add_callback_threadsafe(
+            self._settle_message, self._channel, delivery_tag, None)
+
+    def reject_message_threadsafe(self, delivery_tag, requeue=True):
+        """Schedule the Basic.Nack of a deferred delivery on the IOLoop, so
+        it can be called from any thread.
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool requeue: Ask RabbitMQ to requeue the message
+        """
+        self.add_callback_threadsafe(
+            self._settle_message, self._channel, delivery_tag, requeue)
+
+    def add_callback_threadsafe(self, callback, *args):
+        """Run callback on the connection IOLoop from any thread. The ones
+        added before run created the connection are run once it exists."""
+        with self._callbacks_lock:
+            if self._connection is None:
+                self._pending_callbacks.append((callback, args))
+                return
+        self._add_callback(self._connection, callback, *args)
+
+    def _add_callback(self, connection, callback, *args):
+        connection.ioloop.add_callback(callback, *args)
+
+    def _settle_message(self, channel, delivery_tag, requeue):
+        # in_flight restarts from 0 with every channel, so deliveries of
+        # an older one are no longer counted.
+        if channel is not None and channel is self._channel:
+            self.in_flight = max(self.in_flight - 1, 0)
+            metrics.IN_FLIGHT.set(self.in_flight)
+        if channel is None or channel is not self._channel or \
+                not channel.is_open:
+            self._log.log(logging.WARNING, 'Channel closed, skipping '
+                          'settlement of message %s', delivery_tag)
+            return
+        self._record(delivery_tag, 'acked' if requeue is None else
+                     'requeued' if requeue else 'rejected')
+        if requeue is None:
+            self.acknowledge_message(delivery_tag)
+        else:
+            self._log.log(logging.INFO, 'Rejecting message %s', delivery_tag)
+            metrics.MESSAGES_REJECTED.inc()
+            if self._acks:
+                self._acks.rejected(delivery_tag)
+            channel.basic_nack(delivery_tag, requeue=requeue)
+
+    def _record(self, delivery_tag, outcome):
+        if self._summary:
+            received_at = self._received_at.pop(delivery_tag, None)
+            self._summary.record(outcome, received_at and
+                                 time.time() - received_at)
 
     def on_message(self, channel, method, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -222,22 +507,58 @@ class RabbitMQClient(object):
         :param pika.Spec.BasicProperties: properties
         :param str|unicode body: The message body
         """
-        document = json.loads(body)
+        self.in_flight += 1
+        metrics.MESSAGES_CONSUMED.inc()
+        metrics.IN_FLIGHT.set(self.in_flight)
+        if self._acks:
+            self._acks.delivered(method.delivery_tag)
+        if self._summary:
+            self._received_at[method.delivery_tag] = time.time()
+        try:
+            document = codec.loads(body, properties.content_type)
+        except Exception as err:
+            LOGGER.exception('Could not decode message #%s (%s)',
+                             method.delivery_tag, properties.content_type)
+            self._decode_error(channel, method.delivery_tag, properties,
+                               body, err)
+            return
         request_id = properties.headers.get(
             'X-REQUEST-ID') if properties.headers else ''
-        LOGGER.info('Received message #%s, X-REQUEST-ID:%s, %s',
-                    method.delivery_tag, request_id, document)
+        self._log.log(logging.INFO, 'Received message #%s, X-REQUEST-ID:%s',
+                      method.delivery_tag, request_id, payload=document)
 
-        self.callback(document, headers=properties.headers)
+        # The raw body goes along so a failed update can be published to
+        # the error queue without encoding it again.
+        self.callback(document, headers=properties.headers,
+                      delivery_tag=method.delivery_tag, body=body,
+                      content_type=properties.content_type)
 
+        if not self.auto_ack:
+            return
+
+        self.in_flight -= 1
+        metrics.IN_FLIGHT.set(self.in_flight)
+        self._record(method.delivery_tag, 'acked')
         try:
             self.acknowledge_message(method.delivery_tag)
         except Exception:
             LOGGER.exception('Cannot made ack in message. Process was stopped')
             self.stop()
         else:
-            LOGGER.info('Acked message #%s, X-REQUEST-ID:%s',
-                        method.delivery_tag, request_id)
+            LOGGER.debug('Acked message #%s, X-REQUEST-ID:%s',
+                         method.delivery_tag, request_id)
+
+    def _decode_error(self, channel, delivery_tag, properties, body, err):
+        requeue = False
+        if self.on_decode_error is not None:
+            try:
+                self.on_decode_error(body, properties.headers,
+                                     properties.content_type, err)
+                requeue = None
+            except Exception:
+                LOGGER.exception('Could not hand over undecodable message '
+                                 '#%s', delivery_tag)
+        self._settle_message(channel, delivery_tag, requeue)
 
     def on_cancelok(self, unused_frame):
         """This method is invoked by pika when RabbitMQ acknowledges the
@@ -251,11 +572,45 @@ class RabbitMQClient(object):
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
-        Basic.Cancel RPC command.
+        Basic.Cancel RPC command. A paused consumer has nothing to cancel,
+        so the channel is closed right away.
         """
         if self._channel:
+            if not self._consumer_tags:
+                self.close_channel()
+                return
             LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
-            self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
+            for consumer_tag in self._consumer_tags[:-1]:
+                self._channel.basic_cancel(
+                    consumer_tag=consumer_tag, nowait=True)
+            self._channel.basic_cancel(
+                self.on_cancelok, self._consumer_tags[-1])
+
+    def set_prefetch(self, prefetch_count):
+        """Change the number of unacked deliveries RabbitMQ may send."""
+        self.prefetch_count = prefetch_count
+        if self._acks:
+            self._acks.max_pending = self._ack_threshold()
+        if self._channel:
+            LOGGER.info('Setting prefetch to %s', prefetch_count)
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+
+    def pause_consuming(self):
+        """Stop receiving new deliveries without closing the channel by
+        cancelling the consumers. Unacked deliveries can still be settled.
+        """
+        if self._channel and self._consumer_tags:
+            for consumer_tag in self._consumer_tags:
+                LOGGER.info('Pausing consumer %s', consumer_tag)
+                self._channel.basic_cancel(
+                    consumer_tag=consumer_tag, nowait=True)
+            self._consumer_tags = []
+
+    def resume_consuming(self):
+        """Start receiving deliveries again after pause_consuming."""
+        if self._channel and not self._consumer_tags and not self._closing:
+            LOGGER.info('Resuming consumer')
+            self._consume()
 
     def start_consuming(self):
         """This method sets up the consumer by first calling
@@ -268,9 +623,14 @@ class RabbitMQClient(object):
         """
         LOGGER.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
-        self._channel.basic_qos(prefetch_count=10)
-        self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self.queue)
+        self._channel.basic_qos(prefetch_count=self.prefetch_count)
+        self._consume()
+
+    def _consume(self):
+        self._consumer_tags = [
+            self._channel.basic_consume(self.on_message, queue)
+            for queue in self.queues
+        ]
 
     def on_bindok(self, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -286,6 +646,7 @@ class RabbitMQClient(object):
         Channel.Close RPC command.
         """
         LOGGER.info('Closing the channel')
+        self.flush_acks()
         self._channel.close()
 
     def open_channel(self):
@@ -300,8 +661,45 @@ class RabbitMQClient(object):
         """Run the example consumer by connecting to RabbitMQ and then
         starting the IOLoop to block and allow the SelectConnection to operate.
         """
-        self._connection = self.connect()
-        self._connection.ioloop.start()
+        self._closing = False
+        connection = self.connect()
+        with self._callbacks_lock:
+            self._connection = connection
+            pending, self._pending_callbacks = self._pending_callbacks, []
+        for callback, args in pending:
+            self._add_callback(connection, callback, *args)
+        try:
+            self._connection.ioloop.start()
+        finally:
+            if self._disconnected_at is None:
+                self._disconnected_at = time.time()
+
+    def shutdown(self, timeout):
+        """Stop receiving deliveries and close the connection once every
+        delivery in flight was settled, or after timeout seconds, when
+        RabbitMQ redelivers the unsettled ones. Must run on the IOLoop.
+        :param float timeout: Seconds to wait for deliveries in flight
+        """
+        LOGGER.info('Shutting down with %s deliveries in flight',
+                    self.in_flight)
+        self._closing = True
+        self.pause_consuming()
+        self._wait_settled(time.time() + timeout)
+
+    def _wait_settled(self, deadline):
+        if self._channel and self.in_flight > 0 and time.time() < deadline:
+            self._connection.add_timeout(
+                0.1, functools.partial(self._wait_settled, deadline))
+            return
+        if self.in_flight > 0:
+            LOGGER.warning('%s deliveries not settled, RabbitMQ will '
+                           'redeliver them', self.in_flight)
+        if self._channel:
+            self.close_channel()
+        elif self._connection.is_closed:
+            self._connection.ioloop.stop()
+        else:
+            self.close_connection()
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -318,3 +716,23 @@ class RabbitMQClient(object):
         self.stop_consuming()
         self._connection.ioloop.start()
         LOGGER.info('Stopped')
+
+
+class AsyncioRabbitMQClient(RabbitMQClient):
+    """Same consumer running on the asyncio event loop of the current
+    thread, so the message callback can schedule coroutines.
+    """
+
+    def connect(self):
+        """This method connects to RabbitMQ using the asyncio adapter,
+        returning the connection handle.
+        :rtype: pika.adapters.AsyncioConnection
+        """
+        LOGGER.info('Connecting to RabbitMQ')
+        return adapters.AsyncioConnection(
+            self.parameters, on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error)
+
+    def _add_callback(self, connection, callback, *args):
+        """Run callback on the asyncio event loop from any thread."""
+        connection.loop.call_soon_threadsafe(callback, *args)
@@ -14,16 +14,35 @@
    limitations under the License.
 """
 import logging
+import threading
 
+from globomap_loader.circuit import Backoff
+from globomap_loader.circuit import CircuitBreaker
+from globomap_loader.driver.consumer import AsyncioRabbitMQClient
 from globomap_loader.driver.consumer import RabbitMQClient
+from globomap_loader.driver.sharding import shard_queues
+from globomap_loader.settings import ACK_BATCH_SIZE
+from globomap_loader.settings import ACK_FLUSH_INTERVAL
+from globomap_loader.settings import BREAKER_FAILURE_THRESHOLD
+from globomap_loader.settings import BREAKER_RESET_TIMEOUT
 from globomap_loader.settings import GLOBOMAP_RMQ_EXCHANGE
 from globomap_loader.settings import GLOBOMAP_RMQ_HOST
 from globomap_loader.settings import GLOBOMAP_RMQ_KEY
 from globomap_loader.settings import GLOBOMAP_RMQ_PASSWORD
 from globomap_loader.settings import GLOBOMAP_RMQ_PORT
 from globomap_loader.settings import GLOBOMAP_RMQ_QUEUE_NAME
+from globomap_loader.settings import GLOBOMAP_RMQ_SHARD_EXCHANGE
+from globomap_loader.settings import GLOBOMAP_RMQ_SHARD_HEADER
 from globomap_loader.settings import GLOBOMAP_RMQ_USER
 from globomap_loader.settings import GLOBOMAP_RMQ_VIRTUAL_HOST
+from globomap_loader.settings import LOG_RATE_LIMIT
+from globomap_loader.settings import LOG_SAMPLE_BYPASS
+from globomap_loader.settings import LOG_SAMPLE_RATE
+from globomap_loader.settings import LOG_SUMMARY_INTERVAL
+from globomap_loader.settings import QUEUE_SHARDS
+from globomap_loader.settings import RECONNECT_BASE_DELAY
+from globomap_loader.settings import RECONNECT_MAX_DELAY
+from globomap_loader.settings import WORKER_MODE
 
 
 LOGGER = logging.getLogger(__name__)
@@ -31,26 +50,57 @@ LOGGER = logging.getLogger(__name__)
 
 class GenericDriver(object):
 
-    def __init__(self):
+    def __init__(self, shards=None):
+        """
+        With QUEUE_SHARDS set the driver consumes the shard queues numbered
+        in `shards`, or all of them when None.
+        """
+        self.shards = shards
         self._connect_rabbitmq()
 
     def _connect_rabbitmq(self):
-        self.rabbitmq = RabbitMQClient(
+        client_class = RabbitMQClient
+        if WORKER_MODE == 'asyncio':
+            client_class = AsyncioRabbitMQClient
+        self.rabbitmq = client_class(
             GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
             GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST
         )
+        self.rabbitmq.set_ack_coalescing(ACK_BATCH_SIZE, ACK_FLUSH_INTERVAL)
+        self.rabbitmq.set_log_sampling(
+            LOG_SAMPLE_RATE, LOG_RATE_LIMIT, LOG_SUMMARY_INTERVAL,
+            LOG_SAMPLE_BYPASS)
+        self.breaker = CircuitBreaker(
+            'broker', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.rabbitmq.set_reconnect_policy(
+            Backoff(RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY), self.breaker)
 
-    def process_updates(self, callback):
+    def process_updates(self, callback, auto_ack=True, prefetch_count=10,
+                        on_decode_error=None):
         """
         Reads and processes messages from the GloboMap event bus until
         there's no message left in the target queue. Only acks message if
-        processed successfully by the callback.
+        processed successfully by the callback. With auto_ack disabled the
+        callback receives the delivery_tag and settles it later through
+        ack or reject; prefetch_count bounds how many deliveries may be
+        unsettled at once. Messages that cannot be decoded are handed to
+        on_decode_error instead of the callback.
         """
 
         self.rabbitmq.set_settings(
             GLOBOMAP_RMQ_EXCHANGE, GLOBOMAP_RMQ_QUEUE_NAME, [
-                GLOBOMAP_RMQ_KEY], callback
+                GLOBOMAP_RMQ_KEY], callback, auto_ack, prefetch_count
         )
+        self.rabbitmq.set_decode_error_handler(on_decode_error)
+        if QUEUE_SHARDS:
+            queues = shard_queues(GLOBOMAP_RMQ_QUEUE_NAME, QUEUE_SHARDS)
+            shards = self.shards
+            if shards is None:
+                shards = range(QUEUE_SHARDS)
+            self.rabbitmq.set_sharding(
+                GLOBOMAP_RMQ_SHARD_EXCHANGE, GLOBOMAP_RMQ_SHARD_HEADER,
+                queues, [queues[shard] for shard in shards]
+            )
 
         try:
             self.rabbitmq.run()
@@ -58,3 +108,42 @@ class GenericDriver(object):
             LOGGER.exception('Erro in process updates')
             self.rabbitmq.stop()
             raise Exception('Erro in process updates')
+
+    def ack(self, delivery_tag):
+        self.rabbitmq.acknowledge_message_threadsafe(delivery_tag)
+
+    def reject(self, delivery_tag, requeue=True):
+        self.rabbitmq.reject_message_threadsafe(delivery_tag, requeue)
+
+    def pause(self):
+        self.rabbitmq.add_callback_threadsafe(self.rabbitmq.pause_consuming)
+
+    def resume(self):
+        self.rabbitmq.add_callback_threadsafe(self.rabbitmq.resume_consuming)
+
+    def stop_consuming(self, timeout=None):
+        """
+        Stops receiving deliveries, leaving the ones in flight to be
+        settled. Blocks until the consumer is cancelled or timeout.
+        """
+        stopped = threading.Event()
+
+        def stop():
+            self.rabbitmq.pause_consuming()
+            stopped.set()
+        self.rabbitmq.add_callback_threadsafe(stop)
+        return stopped.wait(timeout)
+
+    def shutdown(self, timeout):
+        """
+        Makes process_updates return once every delivery in flight is
+        settled or after timeout seconds.
+        """
+        self.rabbitmq.add_callback_threadsafe(self.rabbitmq.shutdown, timeout)
+
+    def set_prefetch(self, prefetch_count):
+        self.rabbitmq.add_callback_threadsafe(
+            self.rabbitmq.set_prefetch, prefetch_count)
+
+    def in_flight(self):
+        return self.rabbitmq.in_flight
@@ -0,0 +1,127 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PrefetchController(object):
+    """
+    Adjusts the consumer prefetch window with AIMD from what the worker
+    observed over the last `interval` seconds: the window is halved when
+    the API error rate goes over `max_error_rate` or the mean API latency
+    over `latency_target`, and grows by `step` while the deliveries in
+    flight fill the window, staying between `minimum` and `maximum`.
+
+    `apply(prefetch)` is called with every new window and `in_flight()`
+    returns the deliveries not yet settled.
+    """
+
+    def __init__(self, initial, minimum, maximum, step, interval,
+                 latency_target, max_error_rate, apply, in_flight):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.prefetch = min(max(initial, minimum), maximum)
+        self.step = step
+        self.interval = interval
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.apply = apply
+        self.in_flight = in_flight
+        self.increases = 0
+        self.decreases = 0
+        self.last_decision = 'hold'
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._errors = 0
+        self._latency = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='PrefetchController')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def record(self, latency, error=False):
+        """Records one API call."""
+        with self._lock:
+            self._calls += 1
+            self._latency += latency
+            if error:
+                self._errors += 1
+
+    def adjust(self):
+        """Decides the next window from the calls recorded since the last
+        decision and applies it when it changed."""
+        with self._lock:
+            calls, errors, latency = self._calls, self._errors, self._latency
+            self._calls = self._errors = 0
+            self._latency = 0.0
+
+        error_rate = float(errors) / calls if calls else 0.0
+        mean_latency = latency / calls if calls else 0.0
+        in_flight = self.in_flight()
+        previous = self.prefetch
+
+        if calls and (error_rate > self.max_error_rate or
+                      mean_latency > self.latency_target):
+            self.prefetch = max(self.minimum, self.prefetch // 2)
+            decision = 'decrease'
+        elif calls and in_flight >= self.prefetch * 0.9:
+            self.prefetch = min(self.maximum, self.prefetch + self.step)
+            decision = 'increase'
+        else:
+            decision = 'hold'
+
+        if self.prefetch == previous:
+            decision = 'hold'
+        elif decision == 'increase':
+            self.increases += 1
+        else:
+            self.decreases += 1
+        self.last_decision = decision
+
+        if decision != 'hold':
+            LOGGER.info(
+                'Prefetch %s from %s to %s: calls=%s error_rate=%.2f '
+                'mean_latency=%.3fs in_flight=%s', decision, previous,
+                self.prefetch, calls, error_rate, mean_latency, in_flight
+            )
+            self.apply(self.prefetch)
+        return self.prefetch
+
+    def stats(self):
+        return {
+            'prefetch': self.prefetch,
+            'increases': self.increases,
+            'decreases': self.decreases,
+            'last_decision': self.last_decision,
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception:
+                LOGGER.exception('Error adjusting prefetch')
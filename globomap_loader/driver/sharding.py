@@ -0,0 +1,36 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+"""
+Splits the updates queue in shards fed by a consistent-hash exchange.
+
+The updates exchange forwards every update to the hash exchange, which
+routes it by the hash of a header that publishers set to
+'<collection>/<key>'. All the updates of a document land on the same
+shard, and each shard is consumed by a single worker, so they keep their
+order while the shards are processed in parallel.
+"""
+
+
+def shard_queues(queue, shards):
+    """Names of the `shards` queues the updates queue is split in."""
+    return ['{}.{}'.format(queue, shard) for shard in range(shards)]
+
+
+def assign_shards(shards, workers, slot):
+    """Shards consumed by the worker in `slot` when `workers` run:
+    every workers-th shard starting from slot."""
+    return list(range(slot, shards, workers))
+
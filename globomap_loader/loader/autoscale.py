@@ -0,0 +1,67 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import math
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Autoscaler(object):
+    """
+    Picks how many workers should consume the queue from its depth,
+    sampled at a fixed interval by the caller.
+
+    The backlog of each worker must stay above `scale_up_depth`, without
+    shrinking, for `samples` samples in a row before workers are added,
+    enough of them to bring it back to `scale_up_depth`. It must stay
+    below `scale_down_depth` as long before one worker is retired. The
+    streak starts over after every change, so the new workers get time
+    to show their effect.
+    """
+
+    def __init__(self, min_workers, max_workers, scale_up_depth,
+                 scale_down_depth, samples):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_depth = scale_up_depth
+        self.scale_down_depth = scale_down_depth
+        self.samples = samples
+        self.depth = None
+        self._above = 0
+        self._below = 0
+
+    def decide(self, workers, depth):
+        """Returns the number of workers to run given the queue depth."""
+        previous, self.depth = self.depth, depth
+        backlog = depth / float(max(workers, 1))
+        shrinking = previous is not None and depth < previous
+
+        self._above = self._above + 1 \
+            if backlog > self.scale_up_depth and not shrinking else 0
+        self._below = self._below + 1 \
+            if backlog < self.scale_down_depth else 0
+
+        target = workers
+        if self._above >= self.samples:
+            target = max(workers + 1,
+                         int(math.ceil(depth / float(self.scale_up_depth))))
+        elif self._below >= self.samples:
+            target = workers - 1
+        target = min(max(target, self.min_workers), self.max_workers)
+
+        if target != workers:
+            self._above = self._below = 0
+        return target
@@ -0,0 +1,139 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from collections import OrderedDict
+
+from globomap_loader.loader.updates import document_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+class UpdateBatcher(object):
+    """
+    Groups updates by (type, collection, action) and hands every group to
+    `flush_callback(group, items)` from a background thread as soon as it
+    holds `max_size` items or its oldest item waited `max_wait` seconds.
+
+    Groups are flushed in the order they were opened. When an update
+    touches a document that is still pending in another group, that group
+    and the groups opened before it are flushed first, so updates to the
+    same document are never reordered by the batching.
+    """
+
+    def __init__(self, flush_callback, max_size, max_wait):
+        self.flush_callback = flush_callback
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending = OrderedDict()
+        self._pending_docs = {}
+        self._ready = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name='UpdateBatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Flushes every pending group and waits for the flush thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+
+    def add(self, update, kwargs):
+        group = (update['type'], update['collection'],
+                 update['action'].upper())
+        doc = document_key(update)
+
+        with self._condition:
+            conflict = self._pending_docs.get(doc, group)
+            if conflict != group:
+                self._release_until(conflict)
+
+            if group not in self._pending:
+                self._pending[group] = (time.time() + self.max_wait, [])
+            items = self._pending[group][1]
+            items.append((update, kwargs))
+            self._pending_docs[doc] = group
+
+            if len(items) >= self.max_size:
+                self._release(group)
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return sum(len(items) for _, items in self._pending.values()) + \
+                sum(len(items) for _, items in self._ready)
+
+    def _release(self, group):
+        _, items = self._pending.pop(group)
+        for update, _ in items:
+            doc = document_key(update)
+            if self._pending_docs.get(doc) == group:
+                del self._pending_docs[doc]
+        self._ready.append((group, items))
+
+    def _release_pending(self):
+        for group in list(self._pending):
+            self._release(group)
+
+    def _release_until(self, last_group):
+        for group in list(self._pending):
+            self._release(group)
+            if group == last_group:
+                return
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if not self._running:
+                    self._release_pending()
+                else:
+                    now = time.time()
+                    for group, (deadline, _) in list(self._pending.items()):
+                        if deadline <= now:
+                            self._release(group)
+
+                if self._ready:
+                    return self._ready.popleft()
+                if not self._running:
+                    return None
+
+                timeout = None
+                if self._pending:
+                    deadline = min(d for d, _ in self._pending.values())
+                    timeout = max(deadline - time.time(), 0)
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            group, items = batch
+            try:
+                self.flush_callback(group, items)
+            except Exception:
+                LOGGER.exception('Error flushing batch %s', group)
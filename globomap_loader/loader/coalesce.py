@@ -0,0 +1,217 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import copy
+import logging
+import threading
+import time
+from collections import deque
+from collections import OrderedDict
+
+from globomap_loader import metrics
+from globomap_loader.loader.updates import document_key
+
+LOGGER = logging.getLogger(__name__)
+
+_CANCELLED = object()
+_SEPARATE = object()
+
+
+def merge_elements(previous, element):
+    """Deep merges a PATCH element into the previous one, as the API
+    merges nested objects when patching."""
+    merged = copy.deepcopy(previous) if isinstance(previous, dict) else {}
+    for name, value in (element or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict):
+            merged[name] = merge_elements(merged[name], value)
+        else:
+            merged[name] = copy.deepcopy(value)
+    return merged
+
+
+def merge(previous, update):
+    """
+    Returns the single update equivalent to `previous` followed by
+    `update`, _CANCELLED when the pair has no effect, or _SEPARATE when
+    they must be sent one after the other. `previous` is _CANCELLED when
+    the earlier updates cancelled each other.
+    """
+    action = update['action'].upper()
+    if previous is _CANCELLED:
+        return update
+    previous_action = previous['action'].upper()
+
+    if action == 'UPDATE':
+        return update
+    if action == 'PATCH' and previous_action in ('PATCH', 'UPDATE'):
+        element = merge_elements(previous.get('element'),
+                                 update.get('element'))
+        return dict(update, action=previous['action'], element=element)
+    if action == 'DELETE':
+        # The CREATE is assumed to have made the document, a DELETE right
+        # after it leaves nothing to send.
+        if previous_action == 'CREATE':
+            return _CANCELLED
+        return update
+    if action == 'CREATE' and previous_action in ('CREATE', 'UPDATE',
+                                                  'PATCH'):
+        # The document exists, so the API would refuse the CREATE.
+        return previous
+    return _SEPARATE
+
+
+class UpdateCoalescer(object):
+    """
+    Holds updates for up to `window` seconds and merges the ones touching
+    the same (type, collection, key): consecutive PATCHes are merged, a
+    later UPDATE supersedes earlier ones and a CREATE followed by a DELETE
+    is dropped. Updates that cannot be merged (e.g. PATCH after DELETE)
+    and CLEARs are sent in arrival order.
+
+    `flush_callback(update, originals)` is called from a background thread
+    with the merged update, or None when the updates cancelled each other,
+    and the (update, kwargs) pairs it replaces so every delivery can be
+    settled. At most `max_held` updates are held, older ones are flushed
+    early beyond that.
+    """
+
+    def __init__(self, flush_callback, window, max_held):
+        self.flush_callback = flush_callback
+        self.window = window
+        self.max_held = max_held
+        self.received = 0
+        self.calls = 0
+        self.cancelled = 0
+        self._pending = OrderedDict()
+        self._held = 0
+        self._ready = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name='UpdateCoalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Flushes every pending update and waits for the flush thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+        LOGGER.info('Coalescing saved %s of %s API calls',
+                    self.received - self.calls, self.received)
+
+    def add(self, update, kwargs):
+        collection, key = document_key(update)
+        doc = (update.get('type'), collection, key)
+
+        with self._condition:
+            self.received += 1
+            if key is None or update['action'].upper() == 'CLEAR':
+                for pending in list(self._pending):
+                    if pending[:2] == doc[:2]:
+                        self._release(pending)
+                self._ready.append((update, [(update, kwargs)]))
+                self._condition.notify()
+                return
+
+            if doc in self._pending:
+                deadline, merged, originals = self._pending[doc]
+                result = merge(merged, update)
+                if result is not _SEPARATE:
+                    self._pending[doc] = (deadline, result,
+                                          originals + [(update, kwargs)])
+                    self._held += 1
+                    self._release_over_limit()
+                    return
+                self._release(doc)
+
+            self._pending[doc] = (time.time() + self.window, update,
+                                  [(update, kwargs)])
+            self._held += 1
+            self._release_over_limit()
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return self._held + sum(
+                len(originals) for _, originals in self._ready)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'calls': self.calls,
+            'cancelled': self.cancelled,
+            'saved': self.received - self.calls,
+            'pending': self.pending(),
+        }
+
+    def _release(self, doc):
+        _, merged, originals = self._pending.pop(doc)
+        self._held -= len(originals)
+        self._ready.append(
+            (None if merged is _CANCELLED else merged, originals))
+
+    def _release_over_limit(self):
+        while self._held > self.max_held and self._pending:
+            self._release(next(iter(self._pending)))
+            self._condition.notify()
+
+    def _next_flush(self):
+        with self._condition:
+            while True:
+                if not self._running:
+                    for doc in list(self._pending):
+                        self._release(doc)
+                else:
+                    now = time.time()
+                    for doc, (deadline, _, _) in list(self._pending.items()):
+                        if deadline > now:
+                            break
+                        self._release(doc)
+
+                if self._ready:
+                    return self._ready.popleft()
+                if not self._running:
+                    return None
+
+                timeout = None
+                if self._pending:
+                    deadline = next(iter(self._pending.values()))[0]
+                    timeout = max(deadline - time.time(), 0)
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            flush = self._next_flush()
+            if flush is None:
+                return
+            update, originals = flush
+            if update is None:
+                self.cancelled += 1
+            else:
+                self.calls += 1
+            if len(originals) > 1:
+                metrics.COALESCED_CALLS.inc(
+                    len(originals) - (update is not None))
+            try:
+                self.flush_callback(update, originals)
+            except Exception:
+                LOGGER.exception('Error flushing coalesced update %s', update)
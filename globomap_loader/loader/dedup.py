@@ -0,0 +1,208 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def content_hash(action, element):
+    """Digest of what a write sends, stable across processes."""
+    payload = json.dumps([action, element], sort_keys=True,
+                         separators=(',', ':'), default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+
+def _key_hash(*parts):
+    return hashlib.blake2b('\0'.join(str(part) for part in parts)
+                           .encode('utf-8'), digest_size=16).digest()
+
+
+class DedupCache(object):
+    """
+    Remembers the content last written to each (type, collection, key)
+    so a write of the same content can be skipped. Holds at most
+    `max_entries` documents, least recently used first out, each for
+    `ttl` seconds.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, doc, digest):
+        """True if `digest` is the content last written to doc."""
+        with self._lock:
+            entry = self._entries.get(doc)
+            if entry is not None and entry[0] == digest and \
+                    time.time() - entry[1] < self.ttl:
+                self._entries.move_to_end(doc)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def store(self, doc, digest):
+        with self._lock:
+            self._entries[doc] = (digest, time.time())
+            self._entries.move_to_end(doc)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, doc):
+        with self._lock:
+            self._entries.pop(doc, None)
+
+    def invalidate_collection(self, type, collection):
+        with self._lock:
+            for doc in [doc for doc in self._entries
+                        if doc[:2] == (type, collection)]:
+                del self._entries[doc]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries)}
+
+
+class SharedDedupCache(DedupCache):
+    """
+    DedupCache kept in a memory-mapped file, so every worker process
+    sees the writes of the others. The file is a table of `max_entries`
+    slots indexed by the hash of the document; a document whose slot is
+    taken by another one replaces it. Access is serialized with flock.
+    """
+
+    SLOT = struct.Struct('16s8s16sd')
+
+    def __init__(self, path, max_entries, ttl):
+        super(SharedDedupCache, self).__init__(max_entries, ttl)
+        self.path = path
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        # flock does not exclude processes sharing an inherited
+        # descriptor, every process opens the table on its own.
+        size = self.SLOT.size * self.max_entries
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def _slot(self, key_hash):
+        return int.from_bytes(key_hash[:8], 'little') % self.max_entries
+
+    def _read(self, index):
+        offset = index * self.SLOT.size
+        return self.SLOT.unpack_from(self._map, offset)
+
+    def _write(self, index, *values):
+        self.SLOT.pack_into(self._map, index * self.SLOT.size, *values)
+
+    def _locked(self, operation, mode=fcntl.LOCK_EX):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._file, mode)
+            try:
+                return operation()
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def seen(self, doc, digest):
+        key = _key_hash(*doc)
+        index = self._slot(key)
+
+        def read():
+            return self._read(index)
+        slot_key, _, slot_digest, stored_at = self._locked(
+            read, fcntl.LOCK_SH)
+        hit = slot_key == key and slot_digest == digest and \
+            time.time() - stored_at < self.ttl
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def store(self, doc, digest):
+        key = _key_hash(*doc)
+        index = self._slot(key)
+        collection = _key_hash(*doc[:2])[:8]
+
+        def write():
+            slot_key = self._read(index)[0]
+            if slot_key != key and slot_key != bytes(16):
+                self.evictions += 1
+            self._write(index, key, collection, digest, time.time())
+        self._locked(write)
+
+    def invalidate(self, doc):
+        key = _key_hash(*doc)
+        index = self._slot(key)
+
+        def clear():
+            if self._read(index)[0] == key:
+                self._write(index, bytes(16), bytes(8), bytes(16), 0)
+        self._locked(clear)
+
+    def invalidate_collection(self, type, collection):
+        collection = _key_hash(type, collection)[:8]
+
+        def clear():
+            for index in range(self.max_entries):
+                if self._read(index)[1] == collection:
+                    self._write(index, bytes(16), bytes(8), bytes(16), 0)
+        self._locked(clear)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def dedup_cache(max_entries, ttl, path=None):
+    """The cache configured by the settings, or None when disabled."""
+    if max_entries <= 0:
+        return None
+    if path:
+        return SharedDedupCache(path, max_entries, ttl)
+    return DedupCache(max_entries, ttl)
@@ -0,0 +1,139 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import threading
+import zlib
+from collections import deque
+
+from globomap_loader.loader.updates import document_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LaneDispatcher(object):
+    """
+    Spreads updates over a fixed set of lanes, each one served by its own
+    thread. The lane is chosen by hashing (collection, key), so updates to
+    the same document are handled strictly in order while updates to other
+    documents run in parallel.
+
+    Lanes are not hard bounded: as soon as one of them holds `max_depth`
+    updates `on_pause` is called, and `on_resume` once every lane is back
+    under half of it, so the caller can stop and restart deliveries.
+    """
+
+    def __init__(self, handler, lanes, max_depth, on_pause=None,
+                 on_resume=None):
+        self.handler = handler
+        self.max_depth = max_depth
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.paused = False
+        self.pauses = 0
+        self.dispatched = 0
+        self._lanes = [deque() for _ in range(lanes)]
+        self._condition = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        for index in range(len(self._lanes)):
+            thread = threading.Thread(
+                target=self._run, args=(index,),
+                name='Lane-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Waits for every lane to drain and stops its thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def lane_for(self, update):
+        collection, key = document_key(update)
+        hashed = zlib.crc32('{}:{}'.format(collection, key).encode('utf-8'))
+        return hashed % len(self._lanes)
+
+    def submit(self, update, kwargs):
+        lane = self.lane_for(update)
+        pause = False
+        with self._condition:
+            self._lanes[lane].append((update, kwargs))
+            self.dispatched += 1
+            if not self.paused and len(self._lanes[lane]) >= self.max_depth:
+                self.paused = pause = True
+                self.pauses += 1
+            self._condition.notify_all()
+
+        if pause:
+            LOGGER.warning('Lane %s is full, pausing deliveries', lane)
+            if self.on_pause:
+                self.on_pause()
+
+    def depths(self):
+        with self._condition:
+            return [len(lane) for lane in self._lanes]
+
+    def stats(self):
+        return {
+            'depths': self.depths(),
+            'paused': self.paused,
+            'pauses': self.pauses,
+            'dispatched': self.dispatched,
+        }
+
+    def _next_update(self, index):
+        with self._condition:
+            lane = self._lanes[index]
+            while not lane:
+                if not self._running:
+                    return None
+                self._condition.wait()
+            return lane[0]
+
+    def _done(self, index):
+        resume = False
+        with self._condition:
+            self._lanes[index].popleft()
+            if self.paused and \
+                    max(len(lane) for lane in self._lanes) <= \
+                    self.max_depth // 2:
+                self.paused = False
+                resume = True
+
+        if resume:
+            LOGGER.info('Lanes drained, resuming deliveries')
+            if self.on_resume:
+                self.on_resume()
+
+    def _run(self, index):
+        while True:
+            item = self._next_update(index)
+            if item is None:
+                return
+            update, kwargs = item
+            try:
+                self.handler(update, kwargs)
+            except Exception:
+                LOGGER.exception('Error processing update %s', update)
+            finally:
+                self._done(index)
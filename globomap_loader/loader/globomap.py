@@ -14,28 +14,131 @@
    limitations under the License.
 """
 import logging
+import os
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from globomap_api_client import auth
 from globomap_api_client import exceptions
 from globomap_api_client.document import Document
 from globomap_api_client.query import Query
-
+from requests import Session
+
+from globomap_loader import metrics
+from globomap_loader.circuit import CircuitBreaker
+from globomap_loader.loader.dedup import content_hash
+from globomap_loader.loader.dedup import dedup_cache
+from globomap_loader.loader.governor import api_governor
+from globomap_loader.loader.governor import parse_rates
+from globomap_loader.loader.governor import retry_after
+from globomap_loader.loader.pool import PooledAdapter
+from globomap_loader.loader.token import TokenManager
+from globomap_loader.loader.updates import document_key
+from globomap_loader.logs import SampledLogger
+
+from globomap_loader.settings import API_ACTION_RATES
+from globomap_loader.settings import API_COLLECTION_RATES
+from globomap_loader.settings import API_CONCURRENCY
+from globomap_loader.settings import API_GOVERNOR_PATH
+from globomap_loader.settings import API_POOL_IDLE_TIMEOUT
+from globomap_loader.settings import API_POOL_SIZE
+from globomap_loader.settings import API_RATE_LIMIT
+from globomap_loader.settings import BATCH_PIPELINE_SIZE
+from globomap_loader.settings import BREAKER_ERROR_RATE
+from globomap_loader.settings import BREAKER_FAILURE_THRESHOLD
+from globomap_loader.settings import BREAKER_HALF_OPEN_PROBES
+from globomap_loader.settings import BREAKER_MIN_CALLS
+from globomap_loader.settings import BREAKER_RESET_TIMEOUT
+from globomap_loader.settings import BREAKER_SLOW_CALL
+from globomap_loader.settings import BREAKER_SLOW_CALL_RATE
+from globomap_loader.settings import BREAKER_WINDOW
+from globomap_loader.settings import DEDUP_CACHE_PATH
+from globomap_loader.settings import DEDUP_CACHE_SIZE
+from globomap_loader.settings import DEDUP_CACHE_TTL
 from globomap_loader.settings import GLOBOMAP_API_PASSWORD
 from globomap_loader.settings import GLOBOMAP_API_USERNAME
+from globomap_loader.settings import LOG_RATE_LIMIT
+from globomap_loader.settings import LOG_SAMPLE_BYPASS
 from globomap_loader.settings import RETRIES
+from globomap_loader.settings import TOKEN_REFRESH_MARGIN
+from globomap_loader.settings import TOKEN_TTL
 
 
 LOGGER = logging.getLogger(__name__)
+_LOG = SampledLogger(LOGGER, 1, LOG_RATE_LIMIT, LOG_SAMPLE_BYPASS)
+
+_SESSION_LOCK = threading.RLock()
 
 
 class GloboMapClient(object):
 
-    def __init__(self, host):
+    def __init__(self, host, timeout=None):
         self.host = host
+        self.timeout = timeout
+        self.retry_inline = True
+        self._pid = None
         self.generate_auth()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        for attr in ('session', 'adapter', 'auth', 'tokens', 'doc', 'query',
+                     '_executor', 'dedup', 'breaker', 'governor'):
+            state.pop(attr, None)
+        return state
+
+    def _ensure_session(self):
+        """
+        Connections can't be shared between processes, so every process
+        using the client (the client is handed to each DriverWorker) builds
+        its own keep-alive pool the first time it talks to the API.
+        """
+        if self._pid == os.getpid():
+            return
+        with _SESSION_LOCK:
+            if self._pid == os.getpid():
+                return
+            self._executor = None
+            self.adapter = PooledAdapter(
+                API_POOL_SIZE, API_POOL_IDLE_TIMEOUT, self.timeout)
+            self.session = Session()
+            self.session.mount('http://', self.adapter)
+            self.session.mount('https://', self.adapter)
+            self.session.hooks['response'].append(self._on_response)
+            self.auth = None
+            self.dedup = dedup_cache(
+                DEDUP_CACHE_SIZE, DEDUP_CACHE_TTL, DEDUP_CACHE_PATH)
+            self.breaker = CircuitBreaker(
+                'api', BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+                BREAKER_WINDOW, BREAKER_ERROR_RATE, BREAKER_MIN_CALLS,
+                BREAKER_SLOW_CALL, BREAKER_SLOW_CALL_RATE,
+                BREAKER_HALF_OPEN_PROBES)
+            self.governor = api_governor(
+                API_RATE_LIMIT, parse_rates(API_ACTION_RATES),
+                parse_rates(API_COLLECTION_RATES), API_CONCURRENCY,
+                API_GOVERNOR_PATH)
+            self._pid = os.getpid()
+            try:
+                self.generate_auth()
+            except Exception:
+                self._pid = None
+                raise
+
     def generate_auth(self):
+        """
+        Creates the API objects on first use and afterwards only renews
+        the token, keeping every object on the pooled session.
+        """
+        if self._pid != os.getpid():
+            return self._ensure_session()
+
+        if self.auth is not None:
+            LOGGER.info('Renewing Auth token')
+            self.tokens.refresh()
+            return
+
         LOGGER.info('New Auth')
         self.auth = auth.Auth(
             api_url=self.host,
@@ -44,80 +147,197 @@ class GloboMapClient(object):
         )
         self.doc = Document(auth=self.auth)
         self.query = Query(auth=self.auth)
+        for api in (self.auth, self.doc, self.query):
+            api.session = self.session
+        self.tokens = TokenManager(
+            self.auth, TOKEN_TTL, TOKEN_REFRESH_MARGIN)
+
+    def token_stats(self):
+        self._ensure_session()
+        return self.tokens.stats()
+
+    def pool_stats(self):
+        self._ensure_session()
+        return self.adapter.stats()
+
+    def breaker_stats(self):
+        self._ensure_session()
+        return self.breaker.stats()
+
+    def governor_stats(self):
+        self._ensure_session()
+        return self.governor.stats() if self.governor is not None else {}
+
+    def dedup_stats(self):
+        self._ensure_session()
+        return self.dedup.stats() if self.dedup is not None else {}
 
     def update_element_state(self, action, type, collection, element, key, retries=0):
+        self._ensure_session()
+        if not self.breaker.allow():
+            raise GloboMapCircuitOpen(self.breaker.retry_after())
+        token = self.tokens.ensure_fresh()
 
         try:
-            if action.upper() == 'CREATE':
-                return self.create(type, collection, element)
-            elif action.upper() == 'UPDATE':
-                return self.update(type, collection, key, element)
-            elif action.upper() == 'PATCH':
-                return self.patch(type, collection, key, element)
-            elif action.upper() == 'DELETE':
-                return self.delete(type, collection, key)
-            elif action.upper() == 'CLEAR':
-                return self.clear(type, collection, element)
+            return self._send(action, type, collection, element, key)
 
         except exceptions.ValidationError as err:
-            if '1200' in err.message['errors'] and retries < RETRIES:
-                LOGGER.warning(
-                    'Retry action %s %s %s %s %s',
-                    action, type, collection, element, key
+            if '1200' in err.message['errors'] and not self.retry_inline:
+                metrics.RETRIES.labels('ValidationError').inc()
+                raise GloboMapRetry(err.message, err.status_code)
+            elif '1200' in err.message['errors'] and retries < RETRIES:
+                metrics.RETRIES.labels('ValidationError').inc()
+                _LOG.log(
+                    logging.WARNING, 'Retry action %s %s %s %s',
+                    action, type, collection, key, payload=element
                 )
                 retries += 1
                 time.sleep(2)
                 self.update_element_state(
                     action, type, collection, element, key, retries)
             else:
-                LOGGER.error(
-                    'Bad request in send element %s %s %s %s %s %s',
-                    action, type, collection, element, key, err.message
+                _LOG.log(
+                    logging.ERROR,
+                    'Bad request in send element %s %s %s %s %s',
+                    action, type, collection, key, err.message,
+                    payload=element
                 )
                 raise GloboMapException(err.message, err.status_code)
 
         except exceptions.Unauthorized as err:
             if retries < RETRIES:
-                LOGGER.warning(
-                    'Retry action %s %s %s %s %s',
-                    action, type, collection, element, key
+                metrics.RETRIES.labels('Unauthorized').inc()
+                _LOG.log(
+                    logging.WARNING, 'Retry action %s %s %s %s',
+                    action, type, collection, key, payload=element
                 )
                 retries += 1
-                self.generate_auth()
-                time.sleep(5 + (retries * 5))
-                self.update_element_state(
+                try:
+                    self.tokens.unauthorized(token)
+                except Exception:
+                    LOGGER.exception('Error renewing token')
+                    raise GloboMapException(err.message, err.status_code)
+                return self.update_element_state(
                     action, type, collection, element, key, retries)
             else:
-                LOGGER.error(
-                    'Error send element %s %s %s %s %s',
-                    action, type, collection, element, key
+                _LOG.log(
+                    logging.ERROR, 'Error send element %s %s %s %s',
+                    action, type, collection, key, payload=element
                 )
                 raise GloboMapException(err.message, err.status_code)
 
         except exceptions.Forbidden as err:
-            LOGGER.error(
-                'Forbbiden send element %s %s %s %s %s',
-                action, type, collection, element, key
+            _LOG.log(
+                logging.ERROR, 'Forbbiden send element %s %s %s %s',
+                action, type, collection, key, payload=element
             )
             raise GloboMapException(err.message, err.status_code)
 
         except exceptions.ApiError as err:
-            if retries < RETRIES:
-                LOGGER.warning(
-                    'Retry send element %s %s %s %s %s',
-                    action, type, collection, element, key
+            if not self.retry_inline:
+                metrics.RETRIES.labels('ApiError').inc()
+                raise GloboMapRetry(err.message, err.status_code)
+            elif retries < RETRIES:
+                metrics.RETRIES.labels('ApiError').inc()
+                _LOG.log(
+                    logging.WARNING, 'Retry send element %s %s %s %s',
+                    action, type, collection, key, payload=element
                 )
                 retries += 1
                 time.sleep(5 + (retries * 5))
                 self.update_element_state(
                     action, type, collection, element, key, retries)
             else:
-                LOGGER.error(
-                    'Error send element %s %s %s %s %s',
-                    action, type, collection, element, key
+                _LOG.log(
+                    logging.ERROR, 'Error send element %s %s %s %s',
+                    action, type, collection, key, payload=element
                 )
                 raise GloboMapException(err.message, err.status_code)
 
+    def _send(self, action, type, collection, element, key):
+        """
+        Sends one update, telling the circuit breaker whether the API
+        answered and how fast. Errors in the request itself count as
+        failures.
+        """
+        if self.governor is None:
+            return self._timed_send(action, type, collection, element, key)
+        with self.governor.call(action.upper(), collection):
+            return self._timed_send(action, type, collection, element, key)
+
+    def _timed_send(self, action, type, collection, element, key):
+        started = time.time()
+        try:
+            with metrics.API_LATENCY.labels(
+                    action.upper(), collection).time():
+                result = self._dispatch(
+                    action, type, collection, element, key)
+        except exceptions.ApiError:
+            self.breaker.failure(time.time() - started)
+            raise
+        except Exception:
+            self.breaker.success(time.time() - started)
+            raise
+        self.breaker.success(time.time() - started)
+        return result
+
+    def _on_response(self, response, *args, **kwargs):
+        """Slows every worker down when the API asks to."""
+        seconds = retry_after(response.headers.get('Retry-After'))
+        if self.governor is not None and (
+                response.status_code == 429 or
+                response.status_code == 503 and seconds is not None):
+            self.governor.throttle(seconds)
+
+    def _dispatch(self, action, type, collection, element, key):
+        if action.upper() == 'CREATE':
+            return self.create(type, collection, element)
+        elif action.upper() == 'UPDATE':
+            return self.update(type, collection, key, element)
+        elif action.upper() == 'PATCH':
+            return self.patch(type, collection, key, element)
+        elif action.upper() == 'DELETE':
+            return self.delete(type, collection, key)
+        elif action.upper() == 'CLEAR':
+            return self.clear(type, collection, element)
+
+    def update_elements_state(self, action, type, collection, elements):
+        """
+        Applies the same action to a group of (element, key) pairs.
+        The GloboMap API has no bulk endpoint, so the group is pipelined:
+        up to BATCH_PIPELINE_SIZE requests are kept in flight, while pairs
+        touching the same document are sent one after the other to keep
+        their order.
+        Returns one entry per pair, None on success or the raised exception.
+        """
+        by_key = OrderedDict()
+        for position, (element, key) in enumerate(elements):
+            doc = document_key(
+                {'collection': collection, 'key': key, 'element': element})
+            if doc[1] is None:
+                doc = position
+            by_key.setdefault(doc, []).append(position)
+
+        results = [None] * len(elements)
+        self._ensure_session()
+
+        def send(positions):
+            for position in positions:
+                element, key = elements[position]
+                try:
+                    self.update_element_state(
+                        action, type, collection, element, key)
+                except Exception as err:
+                    results[position] = err
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(BATCH_PIPELINE_SIZE)
+        for future in [self._executor.submit(send, positions)
+                       for positions in by_key.values()]:
+            future.result()
+
+        return results
+
     def create(self, type, collection, payload):
         try:
             return self.doc.post(type, collection, payload)
@@ -129,15 +349,41 @@ class GloboMapClient(object):
             LOGGER.warning('Element already insered')
 
     def update(self, type, collection, key, payload):
-        try:
-            return self.doc.put(type, collection, key, payload)
-
-        except exceptions.NotFound:
-            return self.create(type, collection, payload)
+        return self._write_once('UPDATE', self.doc.put,
+                                type, collection, key, payload)
 
     def patch(self, type, collection, key, payload):
+        return self._write_once('PATCH', self.doc.patch,
+                                type, collection, key, payload)
+
+    def _write_once(self, action, write, type, collection, key, payload):
+        """
+        Sends an UPDATE or PATCH unless the dedup cache says the same
+        content was the last thing written to the document.
+        """
+        if getattr(self, 'dedup', None) is None:
+            return self._write(write, type, collection, key, payload)
+
+        doc = (type, collection, key)
+        digest = content_hash(action, payload)
+        if self.dedup.seen(doc, digest):
+            metrics.DEDUP_LOOKUPS.labels('hit').inc()
+            LOGGER.debug(
+                'Skipping unchanged %s %s %s', action, collection, key)
+            return None
+        metrics.DEDUP_LOOKUPS.labels('miss').inc()
+
+        try:
+            result = self._write(write, type, collection, key, payload)
+        except Exception:
+            self.dedup.invalidate(doc)
+            raise
+        self.dedup.store(doc, digest)
+        return result
+
+    def _write(self, write, type, collection, key, payload):
         try:
-            return self.doc.patch(type, collection, key, payload)
+            return write(type, collection, key, payload)
 
         except exceptions.NotFound:
             return self.create(type, collection, payload)
@@ -149,10 +395,18 @@ class GloboMapClient(object):
         except exceptions.NotFound:
             LOGGER.warning('Element %s already deleted', key)
 
+        finally:
+            if getattr(self, 'dedup', None) is not None:
+                self.dedup.invalidate((type, collection, key))
+
     def clear(self, type, collection, payload):
+        if getattr(self, 'dedup', None) is not None:
+            self.dedup.invalidate_collection(type, collection)
         return self.doc.clear(type, collection, payload)
 
     def run_query(self, query_id, variable):
+        self._ensure_session()
+        self.tokens.ensure_fresh()
         return self.query.execute(query_id, variable)
 
 
@@ -163,3 +417,23 @@ class GloboMapException(Exception):
 
         self.message = message
         self.status_code = status_code
+
+
+class GloboMapRetry(GloboMapException):
+    """
+    Transient failure raised instead of sleeping and retrying inline when
+    the caller schedules retries itself (retry_inline disabled).
+    """
+
+
+class GloboMapCircuitOpen(GloboMapRetry):
+    """
+    Raised without calling the API while its circuit is open; the circuit
+    lets calls through again after `retry_after` seconds.
+    """
+
+    def __init__(self, retry_after):
+        super(GloboMapCircuitOpen, self).__init__(
+            'GloboMap API circuit is open', 503)
+
+        self.retry_after = retry_after
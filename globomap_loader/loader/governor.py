@@ -0,0 +1,376 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import contextlib
+import email.utils
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_rates(value):
+    """Parses 'name:rate,name:rate' into a dict, '*' naming the default."""
+    rates = {}
+    for entry in value.split(','):
+        if ':' in entry:
+            name, rate = entry.rsplit(':', 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def retry_after(value):
+    """Seconds asked by a Retry-After header, in seconds or as a date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class TokenBucket(object):
+    """
+    Spreads calls to a dependency over time: `rate` calls a second on
+    average, in bursts of at most `burst`. A rate of 0 sets no limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.waited = 0
+        self._tokens = self.burst
+        self._refilled = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def take(tokens, refilled, rate, burst, count=1, now=None):
+        """Refills a bucket kept anywhere and takes `count` tokens from
+        it. Returns its new tokens and refill time, and the seconds to
+        wait for the tokens that went short."""
+        now = now or time.time()
+        tokens = min(burst, tokens + (now - refilled) * rate) - count
+        return tokens, now, max(-tokens / rate, 0)
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` calls are allowed. Returns the seconds
+        waited."""
+        if not self.rate:
+            return 0
+        with self._lock:
+            # Tokens are reserved before sleeping, so concurrent callers
+            # queue up behind each other instead of waking up together.
+            self._tokens, self._refilled, wait = self.take(
+                self._tokens, self._refilled, self.rate, self.burst, tokens)
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self, tokens=1):
+        """Takes `tokens` if available without waiting."""
+        if not self.rate:
+            return True
+        with self._lock:
+            left, refilled, wait = self.take(
+                self._tokens, self._refilled, self.rate, self.burst, tokens)
+            if wait:
+                self._tokens, self._refilled = left + tokens, refilled
+                return False
+            self._tokens, self._refilled = left, refilled
+            return True
+
+
+class ApiGovernor(object):
+    """
+    Paces the calls to the GloboMap API. Each call takes a token from the
+    bucket of the whole API (`rate` a second), of its action and of its
+    collection, `action_rates` and `collection_rates` mapping a name, or
+    '*' for any other, to calls a second; a rate of 0 sets no limit. At
+    most `concurrency` calls are in flight (0 for no limit).
+
+    When the API answers 429, or sends Retry-After, throttle() pauses
+    every call for the time asked and halves every rate. Rates recover
+    by RECOVERY of their value a second.
+    """
+
+    MIN_SCALE = 0.05
+    RECOVERY = 0.05
+
+    def __init__(self, rate=0, action_rates=None, collection_rates=None,
+                 concurrency=0):
+        self.rate = rate
+        self.action_rates = action_rates or {}
+        self.collection_rates = collection_rates or {}
+        self.concurrency = concurrency
+        self.calls = 0
+        self.waited = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._buckets = {}
+        # paused until, rate cut, throttled at
+        self._header = (0.0, 0.0, 0.0)
+        self._in_flight = 0
+        self._slot_free = threading.Condition(threading.Lock())
+
+    @contextlib.contextmanager
+    def call(self, action, collection):
+        """Waits for the turn of a call, held until the block exits."""
+        wait = self._locked(
+            lambda: self._reserve(self._limits(action, collection)))
+        if wait > 0:
+            time.sleep(wait)
+        slot = self._take_slot()
+        with self._lock:
+            self.calls += 1
+            self.waited += max(wait, 0)
+        try:
+            yield
+        finally:
+            self._release_slot(slot)
+
+    def throttle(self, seconds=None):
+        """Slows every call down after the API asked to."""
+        def update():
+            now = time.time()
+            paused_until, cut, throttled_at = self._read_header()
+            scale = self._scale(cut, throttled_at, now)
+            if now - throttled_at >= 1:
+                # Workers hit by the same burst of 429 halve rates once.
+                scale = max(scale / 2, self.MIN_SCALE)
+                throttled_at = now
+            paused_until = max(paused_until, now + (seconds or 0))
+            self._write_header(paused_until, 1 - scale, throttled_at)
+            return scale
+        scale = self._locked(update)
+        with self._lock:
+            self.throttled += 1
+        LOGGER.warning('GloboMap API asked to slow down, pausing %.1fs '
+                       'with rates at %.0f%%', seconds or 0, scale * 100)
+
+    def stats(self):
+        now = time.time()
+        paused_until, cut, throttled_at = self._locked(self._read_header)
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'waited_seconds': self.waited,
+                'throttled': self.throttled,
+                'rate_scale': self._scale(cut, throttled_at, now),
+                'paused': int(paused_until > now),
+            }
+
+    def _limits(self, action, collection):
+        limits = []
+        if self.rate:
+            limits.append(('api', self.rate))
+        rate = self.action_rates.get(action, self.action_rates.get('*'))
+        if rate:
+            limits.append(('action:{}'.format(action), rate))
+        rate = self.collection_rates.get(
+            collection, self.collection_rates.get('*'))
+        if rate:
+            limits.append(('collection:{}'.format(collection), rate))
+        return limits
+
+    def _reserve(self, limits):
+        """Takes a token from each bucket, returning the seconds to wait
+        for the ones that went short. Called with the state locked."""
+        now = time.time()
+        paused_until, cut, throttled_at = self._read_header()
+        scale = self._scale(cut, throttled_at, now)
+        wait = paused_until - now
+        for key, rate in limits:
+            rate *= scale
+            tokens, refilled = self._read_bucket(key)
+            if not refilled:
+                tokens, refilled = rate, now
+            tokens, refilled, short = TokenBucket.take(
+                tokens, refilled, rate, rate, now=now)
+            self._write_bucket(key, tokens, refilled)
+            wait = max(wait, short)
+        return wait
+
+    def _scale(self, cut, throttled_at, now):
+        return min(1.0, 1 - cut + (now - throttled_at) * self.RECOVERY)
+
+    def _locked(self, operation):
+        with self._lock:
+            return operation()
+
+    def _read_header(self):
+        return self._header
+
+    def _write_header(self, *header):
+        self._header = header
+
+    def _read_bucket(self, key):
+        return self._buckets.get(key, (0.0, 0.0))
+
+    def _write_bucket(self, key, tokens, refilled):
+        self._buckets[key] = (tokens, refilled)
+
+    def _take_slot(self):
+        if not self.concurrency:
+            return None
+        with self._slot_free:
+            while self._in_flight >= self.concurrency:
+                self._slot_free.wait()
+            self._in_flight += 1
+
+    def _release_slot(self, slot):
+        if not self.concurrency:
+            return
+        with self._slot_free:
+            self._in_flight -= 1
+            self._slot_free.notify()
+
+
+class SharedApiGovernor(ApiGovernor):
+    """
+    ApiGovernor whose buckets, pause and rate cut are kept in a
+    memory-mapped file, so every worker process on the host is paced
+    together. Access is serialized with flock. Call slots are byte-range
+    locks on the same file, released by the kernel if a worker dies.
+    """
+
+    HEADER = struct.Struct('ddd')
+    BUCKET = struct.Struct('8sdd')
+    BUCKETS = 256
+    SLOTS_OFFSET = 1 << 20
+
+    def __init__(self, path, rate=0, action_rates=None,
+                 collection_rates=None, concurrency=0):
+        super(SharedApiGovernor, self).__init__(
+            rate, action_rates, collection_rates, concurrency)
+        self.path = path
+        self._pid = None
+        self._file = None
+        self._map = None
+        self._held = set()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        # Byte-range locks belong to the process and go away when any of
+        # its descriptors of the file is closed, so the file stays open.
+        size = self.HEADER.size + self.BUCKET.size * self.BUCKETS
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_uid != os.getuid():
+            self._file.close()
+            raise IOError('{} is owned by another user'.format(self.path))
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._map = mmap.mmap(fd, size)
+        self._held = set()
+        self._pid = os.getpid()
+
+    def _locked(self, operation):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                return operation()
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _read_header(self):
+        return self.HEADER.unpack_from(self._map, 0)
+
+    def _write_header(self, *header):
+        self.HEADER.pack_into(self._map, 0, *header)
+
+    def _index(self, key):
+        """Slot of a bucket, probing linearly from its hash."""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        start = int.from_bytes(digest, 'little') % self.BUCKETS
+        for probe in range(self.BUCKETS):
+            index = (start + probe) % self.BUCKETS
+            slot_key = self.BUCKET.unpack_from(
+                self._map, self._offset(index))[0]
+            if slot_key in (digest, bytes(8)):
+                return index, digest
+        return start, digest
+
+    def _offset(self, index):
+        return self.HEADER.size + index * self.BUCKET.size
+
+    def _read_bucket(self, key):
+        index, digest = self._index(key)
+        slot_key, tokens, refilled = self.BUCKET.unpack_from(
+            self._map, self._offset(index))
+        if slot_key != digest:
+            return 0.0, 0.0
+        return tokens, refilled
+
+    def _write_bucket(self, key, tokens, refilled):
+        index, digest = self._index(key)
+        self.BUCKET.pack_into(
+            self._map, self._offset(index), digest, tokens, refilled)
+
+    def _take_slot(self):
+        if not self.concurrency:
+            return None
+        delay = 0.001
+        while True:
+            with self._lock:
+                self._open()
+                for slot in range(self.concurrency):
+                    if slot in self._held:
+                        continue
+                    try:
+                        fcntl.lockf(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                                    1, self.SLOTS_OFFSET + slot)
+                    except OSError:
+                        continue
+                    self._held.add(slot)
+                    return slot
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def _release_slot(self, slot):
+        if slot is None:
+            return
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_UN, 1, self.SLOTS_OFFSET + slot)
+            self._held.discard(slot)
+
+
+def api_governor(rate=0, action_rates=None, collection_rates=None,
+                 concurrency=0, path=None):
+    """The governor configured by the settings, shared by the processes
+    of the host when a path is set, or None when no limit is set."""
+    if not (rate or action_rates or collection_rates or concurrency):
+        return None
+    if path:
+        return SharedApiGovernor(
+            path, rate, action_rates, collection_rates, concurrency)
+    return ApiGovernor(rate, action_rates, collection_rates, concurrency)
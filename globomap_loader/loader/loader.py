@@ -13,51 +13,286 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import asyncio
+import functools
 import json
 import logging
+import os
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 
 from pika.exceptions import ConnectionClosed
 
+from globomap_loader import codec
+from globomap_loader import metrics
+from globomap_loader.circuit import Backoff
 from globomap_loader.driver.generic import GenericDriver
+from globomap_loader.driver.qos import PrefetchController
+from globomap_loader.driver.sharding import assign_shards
+from globomap_loader.driver.sharding import shard_queues
+from globomap_loader.loader.autoscale import Autoscaler
+from globomap_loader.loader.batch import UpdateBatcher
+from globomap_loader.loader.coalesce import UpdateCoalescer
+from globomap_loader.loader.dispatcher import LaneDispatcher
+from globomap_loader.loader.globomap import GloboMapCircuitOpen
 from globomap_loader.loader.globomap import GloboMapClient
 from globomap_loader.loader.globomap import GloboMapException
+from globomap_loader.loader.globomap import GloboMapRetry
+from globomap_loader.loader.retry import RetryScheduler
+from globomap_loader.loader.updates import document_key
+from globomap_loader.logs import SampledLogger
+from globomap_loader.rabbitmq import BufferedPublisher
+from globomap_loader.rabbitmq import ConfirmedPublisher
+from globomap_loader.rabbitmq import MessageSpool
 from globomap_loader.rabbitmq import RabbitMQClient
-from globomap_loader.settings import DRIVER_FETCH_INTERVAL
+from globomap_loader.settings import ASYNC_CONCURRENCY
+from globomap_loader.settings import AUTOSCALE_DOWN_DEPTH
+from globomap_loader.settings import AUTOSCALE_INTERVAL
+from globomap_loader.settings import AUTOSCALE_MAX_WORKERS
+from globomap_loader.settings import AUTOSCALE_MIN_WORKERS
+from globomap_loader.settings import AUTOSCALE_SAMPLES
+from globomap_loader.settings import AUTOSCALE_UP_DEPTH
+from globomap_loader.settings import BATCH_MAX_WAIT
+from globomap_loader.settings import BATCH_OPEN_GROUPS
+from globomap_loader.settings import BATCH_SIZE
+from globomap_loader.settings import BREAKER_OPEN_ACTION
+from globomap_loader.settings import COALESCE_WINDOW
+from globomap_loader.settings import DISPATCH_LANES
+from globomap_loader.settings import ERROR_BATCH_SIZE
+from globomap_loader.settings import ERROR_BATCH_WAIT
+from globomap_loader.settings import ERROR_BUFFER_SIZE
+from globomap_loader.settings import ERROR_MAX_UNCONFIRMED
+from globomap_loader.settings import ERROR_PUBLISH_MODE
+from globomap_loader.settings import ERROR_SPOOL_PATH
 from globomap_loader.settings import FACTOR
 from globomap_loader.settings import GLOBOMAP_API_URL
 from globomap_loader.settings import GLOBOMAP_RMQ_ERROR_EXCHANGE
 from globomap_loader.settings import GLOBOMAP_RMQ_HOST
 from globomap_loader.settings import GLOBOMAP_RMQ_PASSWORD
 from globomap_loader.settings import GLOBOMAP_RMQ_PORT
+from globomap_loader.settings import GLOBOMAP_RMQ_QUEUE_NAME
 from globomap_loader.settings import GLOBOMAP_RMQ_USER
 from globomap_loader.settings import GLOBOMAP_RMQ_VIRTUAL_HOST
+from globomap_loader.settings import LANE_DEPTH
+from globomap_loader.settings import LOG_RATE_LIMIT
+from globomap_loader.settings import LOG_SAMPLE_BYPASS
+from globomap_loader.settings import PREFETCH_ADAPTIVE
+from globomap_loader.settings import PREFETCH_COUNT
+from globomap_loader.settings import PREFETCH_INTERVAL
+from globomap_loader.settings import PREFETCH_LATENCY_TARGET
+from globomap_loader.settings import PREFETCH_MAX
+from globomap_loader.settings import PREFETCH_MAX_ERROR_RATE
+from globomap_loader.settings import PREFETCH_MIN
+from globomap_loader.settings import PREFETCH_STEP
+from globomap_loader.settings import QUEUE_SHARDS
+from globomap_loader.settings import RECONNECT_BASE_DELAY
+from globomap_loader.settings import RECONNECT_MAX_DELAY
+from globomap_loader.settings import RETRIES
+from globomap_loader.settings import RETRY_BASE_DELAY
+from globomap_loader.settings import RETRY_DEADLINE
+from globomap_loader.settings import RETRY_MAX_DELAY
+from globomap_loader.settings import RETRY_QUEUE_SIZE
+from globomap_loader.settings import SHUTDOWN_TIMEOUT
+from globomap_loader.settings import WORKER_RESTART_DELAY
+from globomap_loader.settings import WORKER_MODE
 
 logger = logging.getLogger(__name__)
+_log = SampledLogger(logger, 1, LOG_RATE_LIMIT, LOG_SAMPLE_BYPASS)
+
+_RESTART_MAX_DELAY = 60
 
 
 class CoreLoader(object):
+    """
+    Starts FACTOR DriverWorker processes and restarts the ones that
+    exit. When AUTOSCALE_MAX_WORKERS is above AUTOSCALE_MIN_WORKERS the
+    number of workers follows the depth of the updates queue instead.
+    With QUEUE_SHARDS set each worker consumes its own shards of the
+    queue, and at most one worker runs per shard.
+    """
 
     def __init__(self, driver_name=None):
         logger.info('Starting Globmap loader')
         self.globomap_client = GloboMapClient(GLOBOMAP_API_URL)
+        self.workers = []
+        self._restarts = []
+        self._retired = []
+        self._stopping = False
+        self._supervisor = None
+        self._broker = None
+        self.autoscaler = None
+        if AUTOSCALE_MAX_WORKERS > AUTOSCALE_MIN_WORKERS:
+            self.autoscaler = Autoscaler(
+                AUTOSCALE_MIN_WORKERS, AUTOSCALE_MAX_WORKERS,
+                AUTOSCALE_UP_DEPTH, AUTOSCALE_DOWN_DEPTH, AUTOSCALE_SAMPLES
+            )
 
     def load(self):
-        instances = []
-        for _ in range(0, FACTOR):
-            p = DriverWorker(
-                self.globomap_client, GenericDriver(), UpdateExceptionHandler()
-            )
-            instances.append(p)
-            p.start()
+        workers = FACTOR
+        if self.autoscaler is not None:
+            workers = min(max(FACTOR, AUTOSCALE_MIN_WORKERS),
+                          AUTOSCALE_MAX_WORKERS)
+        self.scale(workers)
+
+        self._supervisor = threading.Thread(
+            target=self._supervise, name='WorkerSupervisor')
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT + 5):
+        """
+        Sends SIGTERM to every worker so they drain, and kills the ones
+        still running after timeout seconds.
+        """
+        self._stopping = True
+        workers = [worker for worker in self.workers if worker is not None]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        workers.extend(self._retired)
+        deadline = time.time() + timeout
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                logger.warning('Worker %s did not drain in time, killing it',
+                               worker.pid)
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+            metrics.process_dead(worker.pid)
+
+    def scale(self, workers):
+        """
+        Starts or retires workers until `workers` run. Retired workers
+        get SIGTERM and drain like on shutdown. With shards, the workers
+        whose shards change are replaced by workers consuming the new ones.
+        """
+        before = len(self.workers)
+        moved = []
+        if QUEUE_SHARDS:
+            workers = min(workers, QUEUE_SHARDS)
+            moved = [
+                slot for slot in range(min(before, workers))
+                if self.workers[slot] is not None and
+                assign_shards(QUEUE_SHARDS, before, slot) !=
+                assign_shards(QUEUE_SHARDS, workers, slot)
+            ]
+        while len(self.workers) > workers:
+            worker = self.workers.pop()
+            self._restarts.pop()
+            if worker is not None:
+                worker.terminate()
+                self._retired.append(worker)
+        for slot in moved:
+            self.workers[slot].terminate()
+            self._retired.append(self.workers[slot])
+        while len(self.workers) < workers:
+            self.workers.append(None)
+            self._restarts.append([0, 0])
+        for slot in moved + list(range(before, workers)):
+            self._start_worker(slot)
+        metrics.WORKERS.set(len(self.workers))
+
+    def autoscale(self):
+        """Polls the queue depth and scales the workers accordingly."""
+        try:
+            if self._broker is None:
+                self._broker = RabbitMQClient(
+                    GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
+                    GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST
+                )
+            depth, consumers = 0, 0
+            queues = [GLOBOMAP_RMQ_QUEUE_NAME]
+            if QUEUE_SHARDS:
+                queues = shard_queues(GLOBOMAP_RMQ_QUEUE_NAME, QUEUE_SHARDS)
+            for queue in queues:
+                messages, queue_consumers = self._broker.queue_stats(queue)
+                depth += messages
+                consumers += queue_consumers
+        except Exception:
+            logger.exception('Could not read the depth of the updates queue')
+            self._broker = None
+            return
+
+        metrics.QUEUE_DEPTH.set(depth)
+        workers = len(self.workers)
+        target = self.autoscaler.decide(workers, depth)
+        if target == workers:
+            return
+        logger.info('Scaling from %s to %s workers: %s messages queued, '
+                    '%s consumers', workers, target, depth, consumers)
+        metrics.SCALING_DECISIONS.labels(
+            'up' if target > workers else 'down').inc(abs(target - workers))
+        self.scale(target)
+
+    def _start_worker(self, slot):
+        shards = None
+        if QUEUE_SHARDS:
+            shards = assign_shards(QUEUE_SHARDS, len(self.workers), slot)
+        self.workers[slot] = DriverWorker(
+            self.globomap_client, GenericDriver(shards),
+            UpdateExceptionHandler()
+        )
+        self.workers[slot].start()
+        self._restarts[slot][1] = time.time()
+
+    def _supervise(self):
+        polled = time.time()
+        while not self._stopping:
+            time.sleep(1)
+            self.restart_dead_workers()
+            self._reap_retired()
+            if self.autoscaler is not None and \
+                    time.time() - polled >= AUTOSCALE_INTERVAL:
+                polled = time.time()
+                self.autoscale()
+
+    def _reap_retired(self):
+        for worker in list(self._retired):
+            if not worker.is_alive():
+                worker.join()
+                metrics.process_dead(worker.pid)
+                self._retired.remove(worker)
+
+    def restart_dead_workers(self):
+        """
+        Restarts the workers that exited. A worker that keeps crashing is
+        restarted after a delay doubling from WORKER_RESTART_DELAY.
+        """
+        for slot, worker in enumerate(self.workers):
+            if self._stopping:
+                return
+            failures, started = self._restarts[slot]
+            if worker is not None:
+                if worker.is_alive():
+                    continue
+                worker.join()
+                metrics.process_dead(worker.pid)
+                logger.error('Worker %s exited with code %s',
+                             worker.pid, worker.exitcode)
+                if time.time() - started > _RESTART_MAX_DELAY:
+                    failures = 0
+                self.workers[slot] = None
+                self._restarts[slot] = [failures + 1, time.time()]
+                continue
+            delay = min(WORKER_RESTART_DELAY * 2 ** (failures - 1),
+                        _RESTART_MAX_DELAY)
+            if time.time() - started < delay:
+                continue
+            try:
+                self._start_worker(slot)
+                logger.info('Restarted worker %s', self.workers[slot].pid)
+            except Exception:
+                logger.exception('Could not restart worker')
+                self._restarts[slot] = [failures + 1, time.time()]
 
 
 class DriverWorker(Process):
     """
-    Worker bound to a driver instance that processes all the messages
-    provided by the driver and then sleeps for the amount of seconds
-    configured by the DRIVER_FETCH_INTERVAL envinroment variable.
+    Worker that processes all the messages provided by its driver,
+    restarting the driver with growing delays when it fails.
     """
 
     def __init__(self, globomap_client, driver, exception_handler):
@@ -66,24 +301,424 @@ class DriverWorker(Process):
         self.globomap_client = globomap_client
         self.driver = driver
         self.exception_handler = exception_handler
+        self.retry_scheduler = None
+        self.prefetch_controller = None
+        self.coalescer = None
+        self._stopping = False
+        self._consuming = False
+        self._deadline = None
+        self._drained = threading.Event()
+        self._circuit_lock = threading.Lock()
+        self._circuit_timer = None
 
     def run(self):
+        signal.signal(signal.SIGTERM, self._on_sigterm)
         logger.info('called run method in process: %s', self.name)
-        while True:
+        callback, auto_ack = self._setup_pipeline()
+        if metrics.enabled():
+            self._register_stats()
+
+        backoff = Backoff(RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY)
+        while not self._stopping:
+            started = time.time()
             try:
-                self.driver.process_updates(self._process_update)
+                self._consuming = True
+                self.driver.process_updates(
+                    callback, auto_ack=auto_ack,
+                    prefetch_count=self._prefetch_count(),
+                    on_decode_error=self._handle_decode_error)
             except Exception:
                 logger.exception(
                     'Error syncing updates from driver %s', self.driver)
             finally:
-                logger.debug('No more updates found')
-                logger.debug('Sleeping for %ss' % DRIVER_FETCH_INTERVAL)
-                time.sleep(DRIVER_FETCH_INTERVAL)
+                self._consuming = False
+            if self._stopping:
+                break
+            if time.time() - started > RECONNECT_MAX_DELAY:
+                backoff.reset()
+            delay = backoff.delay()
+            logger.info('Restarting driver %s in %.1fs', self.name, delay)
+            self._drained.wait(delay)
+
+        self._drained.wait(max(self._deadline - time.time(), 0))
+        if hasattr(self.exception_handler, 'close'):
+            self.exception_handler.close(max(self._deadline - time.time(), 1))
+        logger.info('Worker %s stopped', self.name)
+
+    def _on_sigterm(self, signum, frame):
+        if self._stopping:
+            return
+        logger.info('SIGTERM received, draining %s', self.name)
+        self._deadline = time.time() + SHUTDOWN_TIMEOUT
+        self._stopping = True
+        # The handler interrupts the consumer IOLoop, which must keep
+        # running to settle the messages in flight.
+        drain = threading.Thread(target=self._drain, name='Drain')
+        drain.daemon = True
+        drain.start()
+
+    def _drain(self):
+        """
+        Stops consuming, pushes every update held by the pipeline through
+        and has the consumer close the connection once their acks are sent
+        or at the deadline. Retries still waiting are requeued.
+        """
+        consuming = self._consuming
+        try:
+            if consuming:
+                self.driver.stop_consuming(self._deadline - time.time())
+            for component in (self.coalescer,
+                              getattr(self, 'batcher', None),
+                              getattr(self, 'dispatcher', None)):
+                if component is not None:
+                    component.stop()
+            if self.retry_scheduler is not None:
+                self.retry_scheduler.stop(
+                    lambda update, kwargs: self._settle(
+                        kwargs.get('delivery_tag'), kwargs, ack=False))
+            if self.prefetch_controller is not None:
+                self.prefetch_controller.stop()
+            with self._circuit_lock:
+                if self._circuit_timer is not None:
+                    self._circuit_timer.cancel()
+            if consuming:
+                self.driver.shutdown(max(self._deadline - time.time(), 0))
+        except Exception:
+            logger.exception('Error draining %s', self.name)
+        finally:
+            self._drained.set()
+
+    def _setup_pipeline(self):
+        """
+        Builds the per process machinery of the configured processing mode
+        and returns the message callback plus whether the consumer should
+        ack each message as soon as the callback returns. Batching takes
+        precedence over lanes, and both over asyncio concurrency; in
+        asyncio mode only the consumer then runs on the event loop.
+        """
+        if WORKER_MODE == 'asyncio':
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            if BATCH_SIZE > 1 or DISPATCH_LANES > 0:
+                logger.info('Batching or lanes enabled, ASYNC_CONCURRENCY '
+                            'is not used')
+
+        if RETRY_QUEUE_SIZE > 0:
+            self.retry_scheduler = RetryScheduler(
+                self._attempt_update, RETRY_QUEUE_SIZE, RETRY_BASE_DELAY,
+                RETRY_MAX_DELAY, RETRY_DEADLINE
+            )
+            self.retry_scheduler.start()
+            self.globomap_client.retry_inline = False
+
+        if PREFETCH_ADAPTIVE:
+            self.prefetch_controller = PrefetchController(
+                self._prefetch_count(), PREFETCH_MIN, PREFETCH_MAX,
+                PREFETCH_STEP, PREFETCH_INTERVAL, PREFETCH_LATENCY_TARGET,
+                PREFETCH_MAX_ERROR_RATE, self.driver.set_prefetch,
+                self.driver.in_flight
+            )
+            self.prefetch_controller.start()
+
+        callback, auto_ack = self._setup_mode()
+        if COALESCE_WINDOW > 0:
+            self._coalesced_callback = callback
+            if auto_ack:
+                self._coalesced_callback = self._settle_update
+            elif callback == self._schedule_update:
+                self._coalesced_callback = self._schedule_update_threadsafe
+            self.coalescer = UpdateCoalescer(
+                self._flush_coalesced, COALESCE_WINDOW,
+                max(self._prefetch_count() // 2, 1)
+            )
+            self.coalescer.start()
+            return self._coalesce_update, False
+        return callback, auto_ack
+
+    def _setup_mode(self):
+        if BATCH_SIZE > 1:
+            self.batcher = UpdateBatcher(
+                self._process_batch, BATCH_SIZE, BATCH_MAX_WAIT)
+            self.batcher.start()
+            return self._batch_update, False
+        if DISPATCH_LANES > 0:
+            self.dispatcher = LaneDispatcher(
+                self._process_and_settle, DISPATCH_LANES, LANE_DEPTH,
+                on_pause=self.driver.pause, on_resume=self.driver.resume
+            )
+            self.dispatcher.start()
+            return self._dispatch_update, False
+        if WORKER_MODE == 'asyncio':
+            self._semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+            self._executor = ThreadPoolExecutor(ASYNC_CONCURRENCY)
+            self._document_tasks = {}
+            return self._schedule_update, False
+        if self.retry_scheduler is not None or \
+                BREAKER_OPEN_ACTION != 'error':
+            return self._settle_update, False
+        return self._process_update, True
+
+    def _register_stats(self):
+        components = {
+            'api_pool': self.globomap_client.pool_stats,
+            'api_token': self.globomap_client.token_stats,
+            'dedup': self.globomap_client.dedup_stats,
+            'api_breaker': self.globomap_client.breaker_stats,
+            'api_governor': self.globomap_client.governor_stats,
+        }
+        if getattr(self.driver, 'breaker', None) is not None:
+            components['broker_breaker'] = self.driver.breaker.stats
+        if getattr(self, 'batcher', None) is not None:
+            components['batcher'] = lambda: {
+                'pending': self.batcher.pending()}
+        if getattr(self, 'dispatcher', None) is not None:
+            components['dispatcher'] = self.dispatcher.stats
+        if self.retry_scheduler is not None:
+            components['retry_scheduler'] = self.retry_scheduler.stats
+        if self.prefetch_controller is not None:
+            components['prefetch'] = self.prefetch_controller.stats
+        if self.coalescer is not None:
+            components['coalescer'] = self.coalescer.stats
+        publisher = getattr(self.exception_handler, 'rabbit_mq', None)
+        if hasattr(publisher, 'stats'):
+            components['error_publisher'] = publisher.stats
+        for component, stats in components.items():
+            metrics.register_stats(component, stats)
+
+    def _prefetch_count(self):
+        """
+        PREFETCH_COUNT when set, otherwise enough unacked deliveries to
+        keep the configured mode busy: deferred acks hold a delivery until
+        its update is sent, so a smaller window would starve it. In adaptive
+        mode this is the starting point and the controller owns the window.
+        """
+        if self.prefetch_controller is not None:
+            return self.prefetch_controller.prefetch
+        if PREFETCH_COUNT > 0:
+            return PREFETCH_COUNT
+        if BATCH_SIZE > 1:
+            return BATCH_SIZE * BATCH_OPEN_GROUPS
+        if DISPATCH_LANES > 0:
+            return DISPATCH_LANES * LANE_DEPTH
+        if WORKER_MODE == 'asyncio':
+            return ASYNC_CONCURRENCY * 2
+        return 10
 
     def _process_update(self, update, **kwargs):
         self._process_update_with_retry(update, kwargs)
 
+    def _settle_update(self, update, **kwargs):
+        self._process_and_settle(update, kwargs)
+
+    def _dispatch_update(self, update, **kwargs):
+        self.dispatcher.submit(update, kwargs)
+
+    def _coalesce_update(self, update, **kwargs):
+        self.coalescer.add(update, kwargs)
+
+    def _flush_coalesced(self, update, originals):
+        """
+        Hands a coalesced update to the processing mode. An update that
+        replaces several deliveries carries them in kwargs['coalesced'],
+        so all of them are settled, and routed to the exception handler,
+        together; updates that cancelled each other are acked right away.
+        """
+        if update is None:
+            for _, kwargs in originals:
+                self.driver.ack(kwargs.get('delivery_tag'))
+            return
+        if len(originals) == 1:
+            return self._coalesced_callback(update, **originals[0][1])
+        self._coalesced_callback(
+            update, headers=originals[-1][1].get('headers'),
+            coalesced=originals)
+
+    def _schedule_update_threadsafe(self, update, **kwargs):
+        self._loop.call_soon_threadsafe(
+            functools.partial(self._schedule_update, update, **kwargs))
+
+    def _settle(self, delivery_tag, kwargs, ack=True):
+        originals = kwargs.get('coalesced')
+        if originals:
+            tags = [original[1].get('delivery_tag') for original in originals]
+        else:
+            tags = [delivery_tag]
+        for tag in tags:
+            if ack:
+                self.driver.ack(tag)
+            else:
+                self.driver.reject(tag)
+
+    def _process_and_settle(self, update, kwargs):
+        """
+        Processes an update whose delivery is not auto acked, unless its
+        document has a retry pending, in which case it waits behind it.
+        """
+        if self.retry_scheduler is not None and \
+                self.retry_scheduler.hold(update, kwargs):
+            return
+        self._attempt_update(update, kwargs)
+
+    def _attempt_update(self, update, kwargs, attempt=0, first_seen=None):
+        """
+        Sends an update and settles its delivery: ack once the update was
+        applied or handed to the exception handler, requeue when even that
+        failed. Transient failures are handed to the retry scheduler and
+        leave the delivery pending; returns True in that case.
+        """
+        delivery_tag = kwargs.pop('delivery_tag', None)
+        try:
+            try:
+                self._process_update_with_retry(update, kwargs)
+            except GloboMapCircuitOpen as err:
+                if BREAKER_OPEN_ACTION != 'error':
+                    return self._hold_while_open(
+                        update, kwargs, delivery_tag, attempt, first_seen,
+                        err.retry_after)
+                self._handle_update_error(update, err, kwargs, retry=1)
+            except GloboMapRetry as err:
+                if self._schedule_retry(update, kwargs, delivery_tag,
+                                        attempt + 1, first_seen):
+                    return True
+                self._handle_update_error(update, err, kwargs, retry=1)
+        except Exception:
+            logger.exception('Could not settle update: %s', update)
+            self._settle(delivery_tag, kwargs, ack=False)
+        else:
+            self._settle(delivery_tag, kwargs)
+        return False
+
+    def _hold_while_open(self, update, kwargs, delivery_tag, attempt,
+                         first_seen, retry_after):
+        """
+        Keeps an update the open API circuit refused off the API: parks it
+        in the retry queue until probes are allowed, without using up a
+        retry, or requeues its delivery and pauses consuming meanwhile.
+        Returns True when the update was parked.
+        """
+        if BREAKER_OPEN_ACTION == 'park' and \
+                self.retry_scheduler is not None:
+            delay = max(retry_after, self.retry_scheduler.backoff(1))
+            if self.retry_scheduler.schedule(
+                    update, dict(kwargs, delivery_tag=delivery_tag),
+                    attempt, first_seen, delay):
+                return True
+        self._settle(delivery_tag, kwargs, ack=False)
+        self._pause_while_open(retry_after)
+        return False
+
+    def _pause_while_open(self, retry_after):
+        with self._circuit_lock:
+            if self._circuit_timer is not None or self._stopping:
+                return
+            logger.info('GloboMap API circuit is open, pausing consumer '
+                        'for %.0fs', retry_after)
+            self.driver.pause()
+            self._circuit_timer = threading.Timer(
+                max(retry_after, 1), self._resume_after_open)
+            self._circuit_timer.daemon = True
+            self._circuit_timer.start()
+
+    def _resume_after_open(self):
+        with self._circuit_lock:
+            self._circuit_timer = None
+            if not self._stopping:
+                self.driver.resume()
+
+    def _schedule_retry(self, update, kwargs, delivery_tag, attempt,
+                        first_seen=None):
+        if attempt > RETRIES:
+            return False
+        kwargs = dict(kwargs, delivery_tag=delivery_tag)
+        return self.retry_scheduler.schedule(
+            update, kwargs, attempt, first_seen)
+
+    def _schedule_update(self, update, **kwargs):
+        """
+        Chains the update after the last pending task of the same document,
+        so updates to one document are applied in delivery order.
+        """
+        doc = document_key(update)
+        previous = self._document_tasks.get(doc)
+        task = asyncio.ensure_future(
+            self._process_update_async(update, kwargs, previous),
+            loop=self._loop
+        )
+        self._document_tasks[doc] = task
+
+        def forget(done):
+            if self._document_tasks.get(doc) is done:
+                del self._document_tasks[doc]
+        task.add_done_callback(forget)
+        return task
+
+    async def _process_update_async(self, update, kwargs, previous=None):
+        """
+        Runs the blocking API call in the worker thread pool, keeping up to
+        ASYNC_CONCURRENCY updates in flight.
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            await self._loop.run_in_executor(
+                self._executor, self._process_and_settle, update, kwargs)
+
+    def _batch_update(self, update, **kwargs):
+        if self.retry_scheduler is not None and \
+                self.retry_scheduler.hold(update, kwargs):
+            return
+        self.batcher.add(update, kwargs)
+
+    def _process_batch(self, group, items):
+        """
+        Sends a group of updates sharing (type, collection, action) and
+        settles each delivery. Only the updates that failed go through the
+        exception handler; an update whose failure could not be handled is
+        requeued instead of acked.
+        """
+        type, collection, action = group
+        started = time.time()
+        errors = self.globomap_client.update_elements_state(
+            action, type, collection,
+            [(update.get('element'), update.get('key'))
+             for update, _ in items]
+        )
+        latency = (time.time() - started) / len(items)
+        for err in errors:
+            self._record_call(latency, err)
+        for (update, kwargs), err in zip(items, errors):
+            delivery_tag = kwargs.pop('delivery_tag', None)
+            try:
+                if isinstance(err, GloboMapCircuitOpen) and \
+                        BREAKER_OPEN_ACTION != 'error':
+                    self._hold_while_open(update, kwargs, delivery_tag, 0,
+                                          None, err.retry_after)
+                    continue
+                if isinstance(err, GloboMapRetry):
+                    if self._schedule_retry(update, kwargs, delivery_tag, 1):
+                        continue
+                    self._handle_update_error(update, err, kwargs, retry=1)
+                elif isinstance(err, GloboMapException):
+                    self._handle_update_error(update, err, kwargs)
+                elif err is not None:
+                    raise err
+            except Exception:
+                logger.exception('Could not settle update: %s', update)
+                self._settle(delivery_tag, kwargs, ack=False)
+            else:
+                self._settle(delivery_tag, kwargs)
+
+    def _record_call(self, latency, err=None):
+        if self.prefetch_controller is None or \
+                isinstance(err, GloboMapCircuitOpen):
+            return
+        error = isinstance(err, GloboMapRetry) or (
+            isinstance(err, GloboMapException) and
+            (err.status_code or 500) >= 500)
+        self.prefetch_controller.record(latency, error)
+
     def _process_update_with_retry(self, update, kwargs, retry=0):
+        started = time.time()
         try:
             self.globomap_client.update_element_state(
                 update['action'],
@@ -92,30 +727,56 @@ class DriverWorker(Process):
                 update.get('element'),
                 update.get('key'),
             )
+            self._record_call(time.time() - started)
         except GloboMapException as err:
-            if err.status_code == 400 and retry < 1:
-                retry += 1
-                return self._process_update_with_retry(update, kwargs, retry)
+            self._record_call(time.time() - started, err)
+            if isinstance(err, GloboMapCircuitOpen) and \
+                    BREAKER_OPEN_ACTION != 'error':
+                raise
+            if isinstance(err, GloboMapRetry) and \
+                    self.retry_scheduler is not None:
+                raise
+            self._handle_update_error(update, err, kwargs, retry)
 
-            if type(err.message) == bytes:
-                error_msg = err.message.decode('utf-8')
-            else:
-                error_msg = err.message
+    def _handle_decode_error(self, body, headers, content_type, err):
+        """Publishes a message whose body cannot be decoded, as is, to the
+        error exchange."""
+        self.exception_handler.handle_exception(
+            self.name, {'collection': 'undecodable', 'status': 400,
+                        'error_msg': 'Could not decode body: {}'.format(err)},
+            body=body, headers=headers, content_type=content_type)
 
-            logger.error('Could not process update: %s', update)
-            logger.debug('Status code: %s', err.status_code)
-            logger.debug('Response body: %s', err.message)
+    def _handle_update_error(self, update, err, kwargs, retry=0):
+        if err.status_code == 400 and retry < 1:
+            retry += 1
+            return self._process_update_with_retry(update, kwargs, retry)
 
-            try:
-                update['status'] = err.status_code
-                update['error_msg'] = error_msg
-                name = update.get('driver_name', self.name)
+        if type(err.message) == bytes:
+            error_msg = err.message.decode('utf-8')
+        else:
+            error_msg = err.message
+
+        _log.log(logging.ERROR, 'Could not process update %s %s %s',
+                 update.get('action'), update.get('collection'),
+                 update.get('key'), payload=update)
+        logger.debug('Status code: %s', err.status_code)
+        logger.debug('Response body: %s', err.message)
+
+        try:
+            originals = kwargs.get('coalesced') or [(update, kwargs)]
+            for original, original_kwargs in originals:
+                original['status'] = err.status_code
+                original['error_msg'] = error_msg
+                name = original.get('driver_name', self.name)
+                original_kwargs = {
+                    key: value for key, value in original_kwargs.items()
+                    if key != 'delivery_tag'}
 
                 self.exception_handler.handle_exception(
-                    name, update, **kwargs)
-            except Exception as err:
-                logger.exception('Fail to handle update error')
-                raise Exception(str(err))
+                    name, original, **original_kwargs)
+        except Exception as err:
+            logger.exception('Fail to handle update error')
+            raise Exception(str(err))
 
 
 class DriverFullLoadWorker(Process):
@@ -150,27 +811,79 @@ class UpdateExceptionHandler(object):
         self._connect_rabbit()
 
     def _connect_rabbit(self):
+        if ERROR_PUBLISH_MODE == 'buffered':
+            self.rabbit_mq = BufferedPublisher(
+                GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
+                GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST,
+                ERROR_BATCH_SIZE, ERROR_BATCH_WAIT,
+                MessageSpool(ERROR_SPOOL_PATH) if ERROR_SPOOL_PATH else None,
+                Backoff(RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY)
+            )
+            return
+        if ERROR_PUBLISH_MODE == 'confirm':
+            self.rabbit_mq = ConfirmedPublisher(
+                GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
+                GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST,
+                ERROR_BUFFER_SIZE, ERROR_MAX_UNCONFIRMED,
+                Backoff(RECONNECT_BASE_DELAY, RECONNECT_MAX_DELAY)
+            )
+            return
         self.rabbit_mq = RabbitMQClient(
             GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
             GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST
         )
 
+    def close(self, timeout):
+        """
+        Waits up to timeout seconds for the failed updates still being
+        published, then closes the connection.
+        """
+        try:
+            if hasattr(self.rabbit_mq, 'stop'):
+                self.rabbit_mq.stop(timeout)
+            else:
+                self.rabbit_mq.connection.close()
+        except Exception:
+            logger.exception('Error closing RabbitMQ connection')
+
     def handle_exception(self, driver_name, update, retry=True, **kwargs):
+        """
+        Publishes a failed update to the error exchange. The original
+        message body is published as is when available, with the error in
+        the X-ERROR-STATUS and X-ERROR-MSG headers; otherwise the update,
+        error included, is encoded.
+        """
         try:
             logger.debug('Sending failing update to rabbitmq error queue')
             collection = update.get('collection')
             key = 'globomap.error.{}.{}'.format(driver_name, collection)
-            self.rabbit_mq.post_message(
+            body, headers = kwargs.get('body'), kwargs.get('headers')
+            content_type = kwargs.get('content_type')
+            if body is None:
+                body = codec.dumps(update, content_type)
+            else:
+                error_msg = update.get('error_msg')
+                if not isinstance(error_msg, str):
+                    error_msg = json.dumps(error_msg)
+                headers = dict(headers or {})
+                headers['X-ERROR-STATUS'] = update.get('status')
+                headers['X-ERROR-MSG'] = error_msg
+            published = self.rabbit_mq.post_message(
                 GLOBOMAP_RMQ_ERROR_EXCHANGE,
                 key,
-                json.dumps(update),
-                kwargs.get('headers')
+                body,
+                headers,
+                content_type=content_type
             )
-            logger.debug(kwargs)
+            metrics.ERROR_PUBLISHES.labels(
+                'published' if published else 'dropped').inc()
         except ConnectionClosed:
             if retry:
                 logger.warning('RabbitMQ Connection closed, reconnecting')
                 self._connect_rabbit()
                 self.handle_exception(driver_name, update, False, **kwargs)
+            else:
+                metrics.ERROR_PUBLISHES.labels('failed').inc()
         except Exception as err:
+            metrics.ERROR_PUBLISHES.labels('failed').inc()
             logger.exception('Unable to handle exception %s', err)
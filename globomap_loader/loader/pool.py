@@ -0,0 +1,81 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTP adapter keeping up to `pool_size` keep-alive connections per host.
+    Connections left idle for longer than `idle_timeout` seconds are closed
+    on the next request instead of being reused after the server may have
+    dropped them. Requests sent without a timeout get `timeout` seconds.
+    Usage is reported by stats().
+    """
+
+    def __init__(self, pool_size, idle_timeout, timeout=None):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle_evictions = 0
+        self._evicted_requests = 0
+        self._evicted_connections = 0
+        self._last_used = time.time()
+        self._lock = threading.Lock()
+        super(PooledAdapter, self).__init__(
+            pool_connections=1, pool_maxsize=pool_size)
+
+    def send(self, request, **kwargs):
+        now = time.time()
+        with self._lock:
+            if now - self._last_used > self.idle_timeout:
+                self._evict_idle()
+            self._last_used = now
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(PooledAdapter, self).send(request, **kwargs)
+
+    def _pools(self):
+        pools = self.poolmanager.pools
+        return [pools[key] for key in pools.keys()]
+
+    def _evict_idle(self):
+        for pool in self._pools():
+            idle = [conn for conn in list(pool.pool.queue) if conn]
+            self.idle_evictions += len(idle)
+            self._evicted_requests += pool.num_requests
+            self._evicted_connections += pool.num_connections
+        if self.idle_evictions:
+            LOGGER.debug('Evicted idle connections, total %s',
+                         self.idle_evictions)
+        self.poolmanager.clear()
+
+    def stats(self):
+        requests = self._evicted_requests
+        connections = self._evicted_connections
+        for pool in self._pools():
+            requests += pool.num_requests
+            connections += pool.num_connections
+        return {
+            'requests': requests,
+            'hits': max(requests - connections, 0),
+            'new_connections': connections,
+            'idle_evictions': self.idle_evictions,
+        }
@@ -0,0 +1,187 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from globomap_loader import codec
+from globomap_loader.loader.globomap import GloboMapException
+from globomap_loader.loader.globomap import GloboMapRetry
+from globomap_loader.loader.governor import TokenBucket
+
+LOGGER = logging.getLogger(__name__)
+
+ERROR_FIELDS = ('status', 'error_msg')
+
+
+def error_status(update, headers):
+    """Status code of a failed update, from its headers or its body."""
+    status = (headers or {}).get('X-ERROR-STATUS', update.get('status'))
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+class ErrorReplayer(object):
+    """
+    Sends the failed updates of the error queue to the GloboMap API
+    again. The queue is read once, up to the messages it held when the
+    replay started. Updates matching the driver, collection and status
+    filters are sent without their error fields, at most `rate` a second
+    and `concurrency` at a time; the ones sent successfully are acked.
+    Every other message is requeued when the replay ends, transient API
+    failures included, which are not retried with sleeps.
+    """
+
+    def __init__(self, rabbit_mq, globomap_client, queue, rate=10,
+                 concurrency=4, drivers=None, collections=None,
+                 statuses=None, progress_interval=10):
+        self.rabbit_mq = rabbit_mq
+        self.globomap_client = globomap_client
+        self.globomap_client.retry_inline = False
+        self.queue = queue
+        self.bucket = TokenBucket(rate)
+        self.concurrency = max(1, concurrency)
+        self.drivers = set(drivers or ())
+        self.collections = set(collections or ())
+        self.statuses = set(statuses or ())
+        self.progress_interval = progress_interval
+        self.total = 0
+        self.read = 0
+        self.replayed = 0
+        self.failed = 0
+        self.skipped = 0
+        self._started = None
+        self._reported = None
+
+    def run(self):
+        """Replays the queue, returning the stats of the replay."""
+        self.total, _ = self.rabbit_mq.queue_stats(self.queue)
+        self._started = self._reported = time.time()
+        LOGGER.info('Replaying up to %s messages from %s',
+                    self.total, self.queue)
+        requeue = []
+        in_flight = {}
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while self.read < self.total:
+                method, properties, body = \
+                    self.rabbit_mq.get_delivery(self.queue)
+                if method is None:
+                    break
+                self.read += 1
+                update = self._select(method, properties, body)
+                if update is None:
+                    self.skipped += 1
+                    requeue.append(method.delivery_tag)
+                else:
+                    while len(in_flight) >= self.concurrency * 2:
+                        self._settle(in_flight, requeue)
+                    future = executor.submit(self._replay, update)
+                    in_flight[future] = method.delivery_tag
+                self._report()
+            while in_flight:
+                self._settle(in_flight, requeue)
+        # Messages are held unacked until the end, so a requeued one is
+        # not read again by this replay.
+        for delivery_tag in requeue:
+            self.rabbit_mq.nack_message(delivery_tag)
+        self._report(done=True)
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.time() - (self._started or time.time())
+        return {
+            'total': self.total,
+            'read': self.read,
+            'replayed': self.replayed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'per_second': self.replayed / elapsed if elapsed else 0,
+        }
+
+    def _select(self, method, properties, body):
+        """The update to replay, None if it does not pass the filters."""
+        try:
+            update = codec.loads(body, properties.content_type)
+        except ValueError:
+            LOGGER.warning('Skipping undecodable message %s',
+                           method.delivery_tag)
+            return None
+        driver = method.routing_key.split('.')[2:3]
+        if self.drivers and not self.drivers.intersection(driver):
+            return None
+        if self.collections and \
+                update.get('collection') not in self.collections:
+            return None
+        if self.statuses and \
+                error_status(update, properties.headers) not in self.statuses:
+            return None
+        return {key: value for key, value in update.items()
+                if key not in ERROR_FIELDS}
+
+    def _replay(self, update):
+        self.bucket.acquire()
+        try:
+            self.globomap_client.update_element_state(
+                update['action'],
+                update['type'],
+                update['collection'],
+                update.get('element'),
+                update.get('key'),
+            )
+            return True
+        except GloboMapRetry as err:
+            LOGGER.warning('Replay of %s %s %s failed transiently, '
+                           'requeuing it: %s %s', update['action'],
+                           update['collection'], update.get('key'),
+                           err.status_code, err.message)
+            return False
+        except GloboMapException as err:
+            LOGGER.warning('Replay of %s %s %s failed again: %s %s',
+                           update['action'], update['collection'],
+                           update.get('key'), err.status_code, err.message)
+            return False
+
+    def _settle(self, in_flight, requeue):
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            delivery_tag = in_flight.pop(future)
+            try:
+                replayed = future.result()
+            except Exception:
+                LOGGER.exception('Could not replay message %s',
+                                 delivery_tag)
+                replayed = False
+            if replayed:
+                self.replayed += 1
+                self.rabbit_mq.ack_message(delivery_tag)
+            else:
+                self.failed += 1
+                requeue.append(delivery_tag)
+
+    def _report(self, done=False):
+        now = time.time()
+        if not done and now - self._reported < self.progress_interval:
+            return
+        self._reported = now
+        LOGGER.info(
+            'Replay %s read=%s/%s replayed=%s failed=%s skipped=%s '
+            'per_second=%.1f', 'finished' if done else 'progress',
+            self.read, self.total, self.replayed, self.failed, self.skipped,
+            self.stats()['per_second'])
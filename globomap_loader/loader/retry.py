@@ -0,0 +1,179 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from globomap_loader.loader.updates import document_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RetryScheduler(object):
+    """
+    Delay queue that runs failed updates again later from its own thread,
+    so the worker keeps processing other messages meanwhile.
+
+    `handler(update, kwargs, attempt, first_seen)` is called when a retry
+    is due and returns True when it scheduled the update again. Delays
+    grow exponentially from `base_delay` up to `max_delay` with jitter,
+    and an update is not scheduled past `deadline` seconds after its
+    first failure or once `max_size` retries are waiting.
+
+    While a document has a retry pending, later updates to it are parked
+    through hold() and run, in order, once the retry is over.
+    """
+
+    def __init__(self, handler, max_size, base_delay, max_delay, deadline):
+        self.handler = handler
+        self.max_size = max_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.scheduled = 0
+        self.rejected = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._active = set()
+        self._parked = {}
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name='RetryScheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, on_pending=None):
+        """
+        Stops the thread. Retries still waiting, and the updates parked
+        behind them, are handed to `on_pending(update, kwargs)` when given
+        and otherwise left unsettled.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+        if on_pending is None:
+            return
+        with self._condition:
+            pending = [retry[2:4] for retry in sorted(self._heap)]
+            for parked in self._parked.values():
+                pending.extend(parked)
+            self._heap = []
+            self._parked = {}
+            self._active = set()
+        for update, kwargs in pending:
+            on_pending(update, kwargs)
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay,
+                    self.base_delay * (2 ** max(attempt - 1, 0)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, update, kwargs, attempt, first_seen=None,
+                 delay=None):
+        """
+        Schedules the attempt-th retry of an update, after `delay` seconds
+        instead of the backoff when given. Returns False when the update
+        can't be retried anymore.
+        """
+        now = time.time()
+        first_seen = first_seen or now
+        due = now + (self.backoff(attempt) if delay is None else delay)
+        doc = document_key(update)
+
+        with self._condition:
+            if len(self._heap) >= self.max_size or \
+                    due > first_seen + self.deadline:
+                self.rejected += 1
+                return False
+            self._push(due, update, kwargs, attempt, first_seen)
+            self._active.add(doc)
+            self.scheduled += 1
+            self._condition.notify()
+        return True
+
+    def hold(self, update, kwargs):
+        """Parks the update when its document has a retry pending."""
+        doc = document_key(update)
+        with self._condition:
+            if doc not in self._active:
+                return False
+            self._parked.setdefault(doc, deque()).append((update, kwargs))
+            return True
+
+    def depth(self):
+        with self._condition:
+            return len(self._heap) + \
+                sum(len(items) for items in self._parked.values())
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'scheduled': self.scheduled,
+            'rejected': self.rejected,
+        }
+
+    def _push(self, due, update, kwargs, attempt, first_seen):
+        heapq.heappush(self._heap, (due, next(self._counter), update,
+                                    kwargs, attempt, first_seen))
+
+    def _next_retry(self):
+        with self._condition:
+            while self._running:
+                timeout = None
+                if self._heap:
+                    timeout = self._heap[0][0] - time.time()
+                    if timeout <= 0:
+                        return heapq.heappop(self._heap)[2:]
+                self._condition.wait(timeout)
+            return None
+
+    def _finish(self, update):
+        doc = document_key(update)
+        with self._condition:
+            parked = self._parked.get(doc)
+            if parked:
+                next_update, kwargs = parked.popleft()
+                if not parked:
+                    del self._parked[doc]
+                self._push(time.time(), next_update, kwargs, 0, None)
+            else:
+                self._active.discard(doc)
+
+    def _run(self):
+        while True:
+            retry = self._next_retry()
+            if retry is None:
+                return
+            update, kwargs, attempt, first_seen = retry
+            rescheduled = False
+            try:
+                rescheduled = self.handler(
+                    update, kwargs, attempt, first_seen)
+            except Exception:
+                LOGGER.exception('Error retrying update %s', update)
+            if not rescheduled:
+                self._finish(update)
@@ -0,0 +1,152 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from datetime import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+EXPIRES_AT_FORMATS = ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_expires_at(value):
+    """Returns the epoch of an 'expires_at' timestamp or None."""
+    if not isinstance(value, str):
+        return None
+    for fmt in EXPIRES_AT_FORMATS:
+        try:
+            expires_at = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return expires_at.replace(tzinfo=timezone.utc).timestamp()
+    return None
+
+
+class TokenManager(object):
+    """
+    Keeps the token of a globomap_api_client Auth object fresh.
+
+    A background thread renews the token `margin` seconds before it
+    expires, using the 'expires_at' returned by the API or `ttl` seconds
+    after it was issued. Renewals are single flight: a request that finds
+    the token expired, or got a 401 with it, waits for the renewal already
+    running instead of authenticating again.
+    """
+
+    def __init__(self, auth, ttl, margin):
+        self.auth = auth
+        self.ttl = ttl
+        self.margin = margin
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.refresh_latency = 0.0
+        self.unauthorized_count = 0
+        self._condition = threading.Condition()
+        self._refreshing = False
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._set_expiry(time.time())
+
+    def _set_expiry(self, issued_at):
+        response = getattr(self.auth, 'auth', None)
+        expires_at = None
+        if isinstance(response, dict):
+            expires_at = parse_expires_at(response.get('expires_at'))
+        self.expires_at = expires_at or issued_at + self.ttl
+
+    def start(self):
+        """Starts the background renewal in the current process."""
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='TokenManager')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def ensure_fresh(self):
+        """
+        Returns a token that is not about to expire. When the renewal fails
+        the current token is returned, it may still be accepted.
+        """
+        self.start()
+        if time.time() >= self.expires_at - self.margin:
+            try:
+                self.refresh(self.auth.token)
+            except Exception:
+                LOGGER.exception('Error renewing token')
+        return self.auth.token
+
+    def unauthorized(self, token):
+        """Renews the token a request got a 401 with, unless it changed."""
+        with self._condition:
+            self.unauthorized_count += 1
+        self.refresh(token)
+
+    def refresh(self, stale_token=None):
+        with self._condition:
+            while self._refreshing:
+                self._condition.wait()
+            if stale_token is not None and self.auth.token != stale_token:
+                return
+            self._refreshing = True
+
+        started = time.time()
+        try:
+            self.auth.generate_token()
+        except Exception:
+            with self._condition:
+                self.refresh_errors += 1
+            raise
+        else:
+            with self._condition:
+                self.refreshes += 1
+                self.refresh_latency = time.time() - started
+                self._set_expiry(started)
+            LOGGER.info('Token renewed in %.3fs', self.refresh_latency)
+            self._wakeup.set()
+        finally:
+            with self._condition:
+                self._refreshing = False
+                self._condition.notify_all()
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'refresh_latency': self.refresh_latency,
+            'unauthorized': self.unauthorized_count,
+            'expires_in': self.expires_at - time.time(),
+        }
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self.expires_at - self.margin - time.time()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                continue
+            pause = 1
+            try:
+                self.refresh(self.auth.token)
+            except Exception:
+                LOGGER.exception('Error renewing token')
+                pause = 5
+            # Runs off the request path; avoids a tight loop when the
+            # token lifetime is shorter than the margin.
+            time.sleep(pause)
@@ -0,0 +1,29 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+
+def document_key(update):
+    """
+    Returns the (collection, key) pair identifying the document touched by
+    an update. Updates without an explicit key (CREATE) fall back to the
+    key the GloboMap API derives from the element, '<provider>_<id>'.
+    """
+    key = update.get('key')
+    if not key:
+        element = update.get('element')
+        if isinstance(element, dict) and element.get('id'):
+            key = '{}_{}'.format(element.get('provider'), element['id'])
+    return update.get('collection'), key
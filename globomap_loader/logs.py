@@ -0,0 +1,124 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import logging
+import random
+import threading
+import time
+
+
+class SampledLogger(object):
+    """
+    Writes per-message records without flooding the log: only a `rate`
+    fraction of the INFO ones is written, and at most `per_second`
+    records of any level a second (0 for no limit). With `bypass` every
+    enabled record is written.
+
+    A payload, such as a whole document, is appended only to records that
+    are written, and formatted only then.
+    """
+
+    def __init__(self, logger, rate=1.0, per_second=0, bypass=False):
+        self.logger = logger
+        self.rate = rate
+        self.per_second = per_second
+        self.bypass = bypass
+        self.suppressed = 0
+        self._tokens = per_second
+        self._refilled = time.time()
+        self._lock = threading.Lock()
+
+    def log(self, level, msg, *args, payload=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        if not self.bypass and not self._admit(level):
+            return
+        if payload is not None:
+            msg += ' payload=%s'
+            args += (payload,)
+        self.logger.log(level, msg, *args)
+
+    def _admit(self, level):
+        with self._lock:
+            if level < logging.WARNING and self.rate < 1 and \
+                    random.random() >= self.rate:
+                self.suppressed += 1
+                return False
+            if not self.per_second:
+                return True
+            now = time.time()
+            self._tokens = min(
+                self.per_second,
+                self._tokens + (now - self._refilled) * self.per_second)
+            self._refilled = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1
+            return True
+
+
+class MessageSummary(object):
+    """
+    Counts message outcomes and their latencies, and writes them as one
+    INFO record every `interval` seconds while messages flow.
+    """
+
+    MAX_SAMPLES = 10000
+
+    def __init__(self, logger, interval, sampled=None):
+        self.logger = logger
+        self.interval = interval
+        self.sampled = sampled
+        self._lock = threading.Lock()
+        self._reset(time.time())
+
+    def record(self, outcome, latency=None):
+        now = time.time()
+        with self._lock:
+            self._counts[outcome] = self._counts.get(outcome, 0) + 1
+            if latency is not None and \
+                    len(self._latencies) < self.MAX_SAMPLES:
+                self._latencies.append(latency)
+            if now - self._started < self.interval:
+                return
+            counts, latencies = self._counts, self._latencies
+            elapsed = now - self._started
+            self._reset(now)
+        self._write(counts, latencies, elapsed)
+
+    def _reset(self, now):
+        self._started = now
+        self._counts = {}
+        self._latencies = []
+
+    def _write(self, counts, latencies, elapsed):
+        suppressed = 0
+        if self.sampled is not None:
+            suppressed, self.sampled.suppressed = self.sampled.suppressed, 0
+        latencies.sort()
+        self.logger.info(
+            'summary seconds=%.0f %s latency_p50=%.3f latency_p99=%.3f '
+            'latency_max=%.3f suppressed_logs=%s', elapsed,
+            ' '.join('{}={}'.format(outcome, count)
+                     for outcome, count in sorted(counts.items())),
+            _percentile(latencies, 0.5), _percentile(latencies, 0.99),
+            latencies[-1] if latencies else 0, suppressed)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
@@ -0,0 +1,181 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import glob
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from globomap_loader.settings import METRICS_DIR
+from globomap_loader.settings import METRICS_INTERVAL
+from globomap_loader.settings import METRICS_PORT
+
+# prometheus_client picks its multiprocess storage when imported, so the
+# directory shared by the workers must be set first.
+if METRICS_PORT:
+    _directory = METRICS_DIR or os.environ.get('PROMETHEUS_MULTIPROC_DIR') \
+        or tempfile.mkdtemp(prefix='globomap-loader-metrics-')
+    os.makedirs(_directory, exist_ok=True)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = _directory
+    os.environ['prometheus_multiproc_dir'] = _directory
+
+from prometheus_client import CollectorRegistry  # noqa: E402
+from prometheus_client import Counter  # noqa: E402
+from prometheus_client import Gauge  # noqa: E402
+from prometheus_client import Histogram  # noqa: E402
+from prometheus_client import multiprocess  # noqa: E402
+from prometheus_client import start_http_server  # noqa: E402
+
+LOGGER = logging.getLogger(__name__)
+
+MESSAGES_CONSUMED = Counter(
+    'globomap_loader_messages_consumed_total',
+    'Messages delivered to the loader')
+MESSAGES_ACKED = Counter(
+    'globomap_loader_messages_acked_total',
+    'Messages acked after being processed')
+MESSAGES_REJECTED = Counter(
+    'globomap_loader_messages_rejected_total',
+    'Messages rejected back to RabbitMQ')
+IN_FLIGHT = Gauge(
+    'globomap_loader_messages_in_flight',
+    'Deliveries not settled yet', multiprocess_mode='livesum')
+API_LATENCY = Histogram(
+    'globomap_loader_api_request_seconds',
+    'GloboMap API request latency', ['action', 'collection'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+RETRIES = Counter(
+    'globomap_loader_retries_total',
+    'Updates retried, by the exception that caused the retry', ['reason'])
+COALESCED_CALLS = Counter(
+    'globomap_loader_coalesced_calls_saved_total',
+    'API calls saved by merging updates to the same document')
+DEDUP_LOOKUPS = Counter(
+    'globomap_loader_dedup_lookups_total',
+    'Writes checked against the dedup cache, hit means skipped', ['result'])
+ERROR_PUBLISHES = Counter(
+    'globomap_loader_error_publishes_total',
+    'Failed updates sent to the error exchange', ['result'])
+RECONNECTS = Counter(
+    'globomap_loader_reconnects_total',
+    'RabbitMQ reconnections', ['connection'])
+DISCONNECTED_SECONDS = Counter(
+    'globomap_loader_disconnected_seconds_total',
+    'Time spent without a RabbitMQ connection', ['connection'])
+WORKERS = Gauge(
+    'globomap_loader_workers',
+    'Worker processes run by the supervisor', multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge(
+    'globomap_loader_queue_depth',
+    'Messages ready in the updates queue at the last autoscaling poll',
+    multiprocess_mode='livesum')
+SCALING_DECISIONS = Counter(
+    'globomap_loader_scaling_decisions_total',
+    'Workers added or retired by the autoscaler', ['direction'])
+BREAKER_STATE = Gauge(
+    'globomap_loader_circuit_state',
+    'Circuit breaker state, 0 closed, 1 half-open and 2 open, the worst '
+    'among the workers', ['name'], multiprocess_mode='max')
+QUERY_RUNS = Counter(
+    'globomap_loader_query_runs_total',
+    'Scheduled query runs by outcome', ['query', 'outcome'])
+QUERY_SECONDS = Histogram(
+    'globomap_loader_query_seconds',
+    'Scheduled query duration', ['query'],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600))
+COMPONENT_STATS = Gauge(
+    'globomap_loader_component_stat',
+    'Internal counters of the worker pipeline components',
+    ['component', 'stat'], multiprocess_mode='liveall')
+
+_stats = {}
+_stats_lock = threading.Lock()
+_stats_thread = None
+
+
+def enabled():
+    return bool(METRICS_PORT)
+
+
+def start_server():
+    """
+    Serves the metrics of every process sharing the multiprocess
+    directory, normally from the parent process that starts the workers.
+    Files left by processes that are gone are removed first.
+    """
+    if not enabled():
+        return None
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        match = re.search(r'_(\d+)\.db$', path)
+        if match and not _alive(int(match.group(1))):
+            os.remove(path)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=directory)
+    LOGGER.info('Serving metrics on port %s from %s', METRICS_PORT,
+                directory)
+    return start_http_server(METRICS_PORT, registry=registry)
+
+
+def process_dead(pid):
+    """Drops the live gauges of a worker that exited."""
+    if enabled():
+        multiprocess.mark_process_dead(pid)
+
+
+def register_stats(component, stats):
+    """Exports the numeric values of a stats() callable as gauges every
+    METRICS_INTERVAL seconds."""
+    global _stats_thread
+    with _stats_lock:
+        _stats[component] = stats
+        if _stats_thread is None or not _stats_thread.is_alive():
+            _stats_thread = threading.Thread(
+                target=_export_stats_forever, name='MetricsStats')
+            _stats_thread.daemon = True
+            _stats_thread.start()
+
+
+def export_stats():
+    with _stats_lock:
+        components = list(_stats.items())
+    for component, stats in components:
+        try:
+            values = stats()
+        except Exception:
+            LOGGER.exception('Error reading %s stats', component)
+            continue
+        for stat, value in values.items():
+            if isinstance(value, (list, tuple)):
+                value = sum(value)
+            if isinstance(value, (int, float)):
+                COMPONENT_STATS.labels(component, stat).set(value)
+
+
+def _export_stats_forever():
+    event = threading.Event()
+    while not event.wait(METRICS_INTERVAL):
+        export_stats()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
@@ -13,9 +13,25 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import base64
+import collections
+import contextlib
+import fcntl
 import json
+import logging
+import os
+import struct
+import threading
+import time
 
 import pika
+from pika import adapters
+from tornado.ioloop import IOLoop
+
+from globomap_loader import metrics
+from globomap_loader.circuit import Backoff
+
+LOGGER = logging.getLogger(__name__)
 
 
 class RabbitMQClient(object):
@@ -37,13 +53,26 @@ class RabbitMQClient(object):
         else:
             return None, None
 
+    def get_delivery(self, queue):
+        """Returns the method frame, properties and raw body of the next
+        message, to be acked or nacked, or Nones when the queue is
+        empty."""
+        return self.channel.basic_get(queue)
+
+    def queue_stats(self, queue):
+        """Returns the messages ready in a queue and its consumer count,
+        without declaring it."""
+        frame = self.channel.queue_declare(queue=queue, passive=True)
+        return frame.method.message_count, frame.method.consumer_count
+
     def ack_message(self, delivery_tag):
         self.channel.basic_ack(delivery_tag)
 
     def nack_message(self, delivery_tag):
         self.channel.basic_nack(delivery_tag)
 
-    def post_message(self, exchange_name, key, message, headers, confirm=True):
+    def post_message(self, exchange_name, key, message, headers, confirm=True,
+                     content_type=None):
 
         published = self.channel.basic_publish(
             exchange=exchange_name,
@@ -51,7 +80,8 @@ class RabbitMQClient(object):
             body=message,
             properties=pika.BasicProperties(
                 delivery_mode=2,
-                headers=headers
+                headers=headers,
+                content_type=content_type
             ),
             mandatory=True
         )
@@ -66,3 +96,510 @@ class RabbitMQClient(object):
     def discard_publish(self):
         self.channel.tx_select()
         self.channel.tx_rollback()
+
+
+class ConfirmedPublisher(object):
+    """
+    Publishes messages from a background thread with publisher confirms
+    instead of AMQP transactions. Confirm mode is enabled once per
+    channel and Basic.Ack/Basic.Nack frames are handled as they arrive,
+    so many publishes share one round trip. post_message only appends to
+    a bounded local buffer and never blocks: when the buffer is full the
+    message is dropped and counted. Messages not confirmed when a
+    channel closes, or nacked by the broker, are published again.
+    Lost connections are reopened after the delays of `backoff`.
+    """
+
+    def __init__(self, host, port, user, password, vhost,
+                 buffer_size=10000, max_unconfirmed=100, backoff=None):
+        credentials = pika.PlainCredentials(user, password)
+        self.parameters = pika.ConnectionParameters(
+            host=host, port=port,
+            virtual_host=vhost, credentials=credentials
+        )
+        self.buffer_size = buffer_size
+        self.max_unconfirmed = max_unconfirmed
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._unconfirmed = collections.OrderedDict()
+        self._delivery_tag = 0
+        self._connection = None
+        self._channel = None
+        self._ioloop = None
+        self._thread = None
+        self._pid = None
+        self._closing = False
+        self._backoff = backoff or Backoff(1, 60)
+        self._disconnected_at = None
+        self._idle = threading.Condition(self._lock)
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.returned = 0
+        self.dropped = 0
+
+    def start(self):
+        """Starts the publishing thread of the current process."""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._closing = False
+            self._thread = threading.Thread(
+                target=self._run, name='ConfirmedPublisher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Waits up to timeout seconds for buffered messages to be
+        confirmed, then closes the connection."""
+        self.flush(timeout)
+        self._closing = True
+        if self._ioloop:
+            self._ioloop.add_callback(self._close)
+        if self._thread:
+            self._thread.join(timeout)
+
+    def flush(self, timeout=None):
+        """Blocks until every buffered message is confirmed. Returns False
+        on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._idle:
+            while self._buffer or self._unconfirmed:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def post_message(self, exchange_name, key, message, headers,
+                     content_type=None):
+        """Buffers a message to be published. Returns False if the buffer
+        is full and the message was dropped."""
+        self.start()
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size:
+                self.dropped += 1
+                LOGGER.warning('Publish buffer full, dropping message to %s',
+                               key)
+                return False
+            self._buffer.append(
+                (exchange_name, key, message, headers, content_type))
+        if self._ioloop:
+            self._ioloop.add_callback(self._drain)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buffered': len(self._buffer),
+                'unconfirmed': len(self._unconfirmed),
+                'published': self.published,
+                'confirmed': self.confirmed,
+                'nacked': self.nacked,
+                'returned': self.returned,
+                'dropped': self.dropped,
+            }
+
+    def _run(self):
+        self._ioloop = IOLoop()
+        self._connect()
+        self._ioloop.start()
+        self._ioloop.close()
+
+    def _connect(self):
+        self._connection = adapters.TornadoConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._ioloop
+        )
+
+    def _close(self):
+        if self._connection and self._connection.is_open:
+            self._connection.close()
+        else:
+            self._ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        self._backoff.reset()
+        if self._disconnected_at is not None:
+            metrics.DISCONNECTED_SECONDS.labels('publisher').inc(
+                time.time() - self._disconnected_at)
+            self._disconnected_at = None
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, connection, *args):
+        self._channel = None
+        self._requeue_unconfirmed()
+        if self._closing:
+            self._ioloop.stop()
+            return
+        if self._disconnected_at is None:
+            self._disconnected_at = time.time()
+        delay = self._backoff.delay()
+        LOGGER.warning('Publisher connection closed, reopening in %.1f '
+                       'seconds: %s', delay, args)
+        metrics.RECONNECTS.labels('publisher').inc()
+        self._ioloop.call_later(delay, self._connect)
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(self._on_confirm)
+        self._drain()
+
+    def _on_channel_closed(self, channel, *args):
+        LOGGER.warning('Publisher channel %i was closed: %s', channel, args)
+        self._channel = None
+        self._requeue_unconfirmed()
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_return(self, channel, method, properties, body):
+        self.returned += 1
+        LOGGER.warning('Message to %s was returned: %s',
+                       method.routing_key, method.reply_text)
+
+    def _on_confirm(self, method_frame):
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self._lock:
+            if method.multiple:
+                tags = [tag for tag in self._unconfirmed
+                        if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag]
+            for tag in tags:
+                message = self._unconfirmed.pop(tag, None)
+                if message is None:
+                    continue
+                if acked:
+                    self.confirmed += 1
+                else:
+                    self.nacked += 1
+                    self._buffer.append(message)
+            self._idle.notify_all()
+        if not acked:
+            LOGGER.warning('Broker nacked %s messages, publishing again',
+                           len(tags))
+        self._drain()
+
+    def _requeue_unconfirmed(self):
+        with self._lock:
+            self._buffer.extendleft(reversed(self._unconfirmed.values()))
+            self._unconfirmed.clear()
+
+    def _drain(self):
+        while self._channel and self._channel.is_open:
+            with self._lock:
+                if not self._buffer or \
+                        len(self._unconfirmed) >= self.max_unconfirmed:
+                    self._idle.notify_all()
+                    return
+                message = self._buffer.popleft()
+                self._delivery_tag += 1
+                self._unconfirmed[self._delivery_tag] = message
+                self.published += 1
+            exchange_name, key, body, headers, content_type = message
+            self._channel.basic_publish(
+                exchange=exchange_name,
+                routing_key=key,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2,
+                    headers=headers,
+                    content_type=content_type
+                ),
+                mandatory=True
+            )
+
+
+class MessageSpool(object):
+    """
+    Append-only file of messages that could not be published. Records
+    are length-prefixed JSON written and read under flock, so the worker
+    processes can share one file. A file owned by another user is refused.
+    """
+
+    RECORD = struct.Struct('>I')
+
+    def __init__(self, path):
+        self.path = path
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, messages):
+        with self._locked() as spool:
+            self._write(spool, messages)
+
+    def replay(self, publish, chunk_size):
+        """
+        Empties the file and hands the messages it held to publish,
+        chunk_size at a time. Returns how many were replayed. The lock is
+        held only to take the messages, so writers are not blocked by
+        publish; when it raises, the chunk that failed and the following
+        ones are appended again.
+        """
+        with self._locked() as spool:
+            spool.seek(0)
+            messages = list(self._read(spool))
+            spool.truncate(0)
+        replayed = 0
+        try:
+            while replayed < len(messages):
+                chunk = messages[replayed:replayed + chunk_size]
+                publish(chunk)
+                replayed += len(chunk)
+        finally:
+            if replayed < len(messages):
+                self.append(messages[replayed:])
+        return replayed
+
+    def _read(self, spool):
+        while True:
+            header = spool.read(self.RECORD.size)
+            if len(header) < self.RECORD.size:
+                return
+            length, = self.RECORD.unpack(header)
+            data = spool.read(length)
+            if len(data) < length:
+                LOGGER.warning('Discarding a truncated record at the end '
+                               'of %s', self.path)
+                return
+            try:
+                yield self._decode(data)
+            except ValueError:
+                LOGGER.warning('Discarding an invalid record in %s',
+                               self.path)
+
+    def _write(self, spool, messages):
+        for message in messages:
+            data = self._encode(message)
+            spool.write(self.RECORD.pack(len(data)) + data)
+        spool.flush()
+        os.fsync(spool.fileno())
+
+    @staticmethod
+    def _encode(message):
+        exchange_name, key, body, headers, content_type = message
+        record = {'exchange': exchange_name, 'key': key, 'headers': headers,
+                  'content_type': content_type}
+        if isinstance(body, bytes):
+            record['body64'] = base64.b64encode(body).decode('ascii')
+        else:
+            record['body'] = body
+        return json.dumps(record, default=str).encode('utf-8')
+
+    @staticmethod
+    def _decode(data):
+        record = json.loads(data.decode('utf-8'))
+        body = record.get('body')
+        if 'body64' in record:
+            body = base64.b64decode(record['body64'])
+        return (record['exchange'], record['key'], body, record['headers'],
+                record['content_type'])
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, 'r+b') as spool:
+            if os.fstat(spool.fileno()).st_uid != os.getuid():
+                raise IOError('{} is owned by another user'.format(self.path))
+            fcntl.flock(spool, fcntl.LOCK_EX)
+            try:
+                yield spool
+            finally:
+                fcntl.flock(spool, fcntl.LOCK_UN)
+
+
+class BufferedPublisher(object):
+    """
+    Publishes messages in batches from a background thread. post_message
+    only appends to a buffer and never blocks; the buffer is flushed
+    when it holds `batch_size` messages or its oldest message waited
+    `max_wait` seconds, with one AMQP transaction per routing key.
+    Messages that cannot be published are appended to `spool`, which is
+    replayed once the broker is reachable again, so none is lost. A
+    failure in the middle of a replay can publish a message twice.
+    """
+
+    def __init__(self, host, port, user, password, vhost, batch_size=100,
+                 max_wait=1, spool=None, backoff=None):
+        self._connection_args = (host, port, user, password, vhost)
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.spool = spool
+        self._backoff = backoff or Backoff(1, 60)
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._client = None
+        self._retry_at = None
+        self._thread = None
+        self._pid = None
+        self._closing = False
+        self.published = 0
+        self.flushes = 0
+        self.spooled = 0
+        self.replayed = 0
+
+    def start(self):
+        """Starts the flushing thread of the current process."""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._closing = False
+            if self.spool is not None and self.spool.size():
+                self._retry_at = time.time()
+            self._thread = threading.Thread(
+                target=self._run, name='BufferedPublisher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Flushes the buffer within timeout seconds, spooling what could
+        not be published, then closes the connection."""
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        with self._lock:
+            messages, self._buffer = self._buffer, []
+        if messages:
+            self._spill(messages)
+
+    def post_message(self, exchange_name, key, message, headers,
+                     content_type=None):
+        """Buffers a message to be published."""
+        self.start()
+        with self._ready:
+            if not self._buffer:
+                self._oldest = time.time()
+            self._buffer.append(
+                (exchange_name, key, message, headers, content_type))
+            if len(self._buffer) in (1, self.batch_size):
+                self._ready.notify()
+        return True
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._buffer)
+        return {
+            'buffered': buffered,
+            'published': self.published,
+            'flushes': self.flushes,
+            'spooled': self.spooled,
+            'replayed': self.replayed,
+            'spool_bytes': self.spool.size() if self.spool else 0,
+        }
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._closing and not self._due():
+                    self._ready.wait(self._wait_timeout())
+                messages, self._buffer = self._buffer, []
+                closing = self._closing
+            self._flush(messages)
+            if closing:
+                self._disconnect()
+                return
+
+    def _due(self):
+        now = time.time()
+        if len(self._buffer) >= self.batch_size or \
+                self._buffer and now - self._oldest >= self.max_wait:
+            return True
+        return self._replay_due() and now >= self._retry_at
+
+    def _wait_timeout(self):
+        timeouts = []
+        if self._buffer:
+            timeouts.append(self._oldest + self.max_wait - time.time())
+        if self._replay_due():
+            timeouts.append(self._retry_at - time.time())
+        return max(min(timeouts), 0) if timeouts else None
+
+    def _replay_due(self):
+        return self._retry_at is not None and self.spool is not None and \
+            self.spool.size() > 0
+
+    def _flush(self, messages):
+        pending = self._group(messages)
+        try:
+            if self._connect():
+                if self.spool is not None and self.spool.size():
+                    self.replayed += self.spool.replay(
+                        self._publish, self.batch_size)
+                while pending:
+                    self._publish_group(pending[0])
+                    pending.pop(0)
+        except Exception:
+            LOGGER.exception('Could not publish buffered messages')
+            self._disconnect()
+            self._retry_at = time.time() + self._backoff.delay()
+            metrics.RECONNECTS.labels('publisher').inc()
+        if pending:
+            self._spill([message for group in pending for message in group])
+
+    def _publish(self, messages):
+        for group in self._group(messages):
+            self._publish_group(group)
+
+    def _group(self, messages):
+        groups = collections.OrderedDict()
+        for message in messages:
+            groups.setdefault(message[:2], []).append(message)
+        return list(groups.values())
+
+    def _publish_group(self, group):
+        for exchange_name, key, body, headers, content_type in group:
+            self._client.post_message(
+                exchange_name, key, body, headers, confirm=False,
+                content_type=content_type)
+        self._client.channel.tx_commit()
+        self.published += len(group)
+        self.flushes += 1
+
+    def _connect(self):
+        if self._client is not None:
+            return True
+        if self._retry_at is not None and time.time() < self._retry_at:
+            return False
+        self._client = RabbitMQClient(*self._connection_args)
+        self._client.channel.tx_select()
+        self._retry_at = None
+        self._backoff.reset()
+        return True
+
+    def _disconnect(self):
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                client.connection.close()
+            except Exception:
+                pass
+
+    def _spill(self, messages):
+        if self.spool is None:
+            LOGGER.error('Dropping %s messages, no spool file is set',
+                         len(messages))
+            return
+        try:
+            self.spool.append(messages)
+            self.spooled += len(messages)
+        except Exception:
+            LOGGER.exception('Could not spool %s messages to %s',
+                             len(messages), self.spool.path)
@@ -13,11 +13,14 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import signal
+import sys
 from logging import config
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from globomap_monitoring import zbx_passive
 
+from globomap_loader import metrics
 from globomap_loader.loader.loader import CoreLoader
 from globomap_loader.settings import LOGGING
 from globomap_loader.settings import ZBX_PASSIVE_MONITOR_LOADER
@@ -33,6 +36,13 @@ def job_monitoracao_zabbix():
 if __name__ == '__main__':
     config.dictConfig(LOGGING)
 
-    CoreLoader().load()
+    metrics.start_server()
+    loader = CoreLoader()
+    loader.load()
+
+    def shutdown(signum, frame):
+        loader.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
 
     sched.start()
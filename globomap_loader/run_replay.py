@@ -0,0 +1,86 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+# !/usr/bin/env python
+#
+# Sends the failed updates of the error queue to the GloboMap API again,
+# once it recovered:
+#
+#     python globomap_loader/run_replay.py --driver Napi --status 503 \
+#         --rate 20 --concurrency 4
+import argparse
+from logging import config
+
+from globomap_loader.loader.globomap import GloboMapClient
+from globomap_loader.loader.replay import ErrorReplayer
+from globomap_loader.rabbitmq import RabbitMQClient
+from globomap_loader.settings import GLOBOMAP_API_URL
+from globomap_loader.settings import GLOBOMAP_RMQ_ERROR_QUEUE_NAME
+from globomap_loader.settings import GLOBOMAP_RMQ_HOST
+from globomap_loader.settings import GLOBOMAP_RMQ_PASSWORD
+from globomap_loader.settings import GLOBOMAP_RMQ_PORT
+from globomap_loader.settings import GLOBOMAP_RMQ_USER
+from globomap_loader.settings import GLOBOMAP_RMQ_VIRTUAL_HOST
+from globomap_loader.settings import LOGGING
+from globomap_loader.settings import REPLAY_CONCURRENCY
+from globomap_loader.settings import REPLAY_PROGRESS_INTERVAL
+from globomap_loader.settings import REPLAY_RATE
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Replay failed updates from the error queue')
+    parser.add_argument('--queue', default=GLOBOMAP_RMQ_ERROR_QUEUE_NAME,
+                        required=not GLOBOMAP_RMQ_ERROR_QUEUE_NAME,
+                        help='error queue to read')
+    parser.add_argument('--driver', action='append', default=[],
+                        help='replay only updates from this driver')
+    parser.add_argument('--collection', action='append', default=[],
+                        help='replay only updates to this collection')
+    parser.add_argument('--status', action='append', type=int, default=[],
+                        help='replay only updates that failed with this '
+                             'status code')
+    parser.add_argument('--rate', type=float, default=REPLAY_RATE,
+                        help='updates sent a second, 0 for no limit')
+    parser.add_argument('--concurrency', type=int,
+                        default=REPLAY_CONCURRENCY,
+                        help='updates sent at a time')
+    parser.add_argument('--progress-interval', type=float,
+                        default=REPLAY_PROGRESS_INTERVAL,
+                        help='seconds between progress reports')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    rabbit_mq = RabbitMQClient(
+        GLOBOMAP_RMQ_HOST, GLOBOMAP_RMQ_PORT, GLOBOMAP_RMQ_USER,
+        GLOBOMAP_RMQ_PASSWORD, GLOBOMAP_RMQ_VIRTUAL_HOST
+    )
+    replayer = ErrorReplayer(
+        rabbit_mq, GloboMapClient(GLOBOMAP_API_URL), args.queue,
+        rate=args.rate, concurrency=args.concurrency, drivers=args.driver,
+        collections=args.collection, statuses=args.status,
+        progress_interval=args.progress_interval
+    )
+    try:
+        return replayer.run()
+    finally:
+        rabbit_mq.connection.close()
+
+
+if __name__ == '__main__':
+    config.dictConfig(LOGGING)
+    main()
@@ -19,6 +19,7 @@ from logging import config
 from apscheduler.schedulers.blocking import BlockingScheduler
 from globomap_monitoring import zbx_passive
 
+from globomap_loader import metrics
 from globomap_loader.settings import LOGGING
 from globomap_loader.settings import ZBX_PASSIVE_MONITOR_SCHED_QUERIES
 from globomap_loader.tasks import run_queries
@@ -38,4 +39,5 @@ def job_monitoracao_zabbix():
 
 
 if __name__ == '__main__':
+    metrics.start_server()
     sched.start()
@@ -15,11 +15,30 @@
 """
 import os
 
-DRIVER_FETCH_INTERVAL = int(os.getenv('DRIVER_FETCH_INTERVAL', 60))
+RECONNECT_BASE_DELAY = float(os.getenv('RECONNECT_BASE_DELAY', 1))
+RECONNECT_MAX_DELAY = float(os.getenv('RECONNECT_MAX_DELAY', 60))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 0))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', 60))
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', 0.5))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 20))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', 10))
+BREAKER_SLOW_CALL_RATE = float(os.getenv('BREAKER_SLOW_CALL_RATE', 0.8))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv('BREAKER_HALF_OPEN_PROBES', 3))
+BREAKER_OPEN_ACTION = os.getenv('BREAKER_OPEN_ACTION', 'park')
 
 GLOBOMAP_API_URL = os.getenv('GLOBOMAP_API_URL')
 GLOBOMAP_API_USERNAME = os.getenv('GLOBOMAP_API_USERNAME')
 GLOBOMAP_API_PASSWORD = os.getenv('GLOBOMAP_API_PASSWORD')
+TOKEN_TTL = float(os.getenv('TOKEN_TTL', 3600))
+TOKEN_REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', 60))
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 10))
+API_POOL_IDLE_TIMEOUT = float(os.getenv('API_POOL_IDLE_TIMEOUT', 60))
+API_RATE_LIMIT = float(os.getenv('API_RATE_LIMIT', 0))
+API_ACTION_RATES = os.getenv('API_ACTION_RATES', '')
+API_COLLECTION_RATES = os.getenv('API_COLLECTION_RATES', '')
+API_CONCURRENCY = int(os.getenv('API_CONCURRENCY', 0))
+API_GOVERNOR_PATH = os.getenv('API_GOVERNOR_PATH', '')
 
 GLOBOMAP_RMQ_USER = os.getenv('GLOBOMAP_RMQ_USER')
 GLOBOMAP_RMQ_PASSWORD = os.getenv('GLOBOMAP_RMQ_PASSWORD')
@@ -29,15 +48,84 @@ GLOBOMAP_RMQ_VIRTUAL_HOST = os.getenv('GLOBOMAP_RMQ_VIRTUAL_HOST')
 GLOBOMAP_RMQ_QUEUE_NAME = os.getenv('GLOBOMAP_RMQ_QUEUE_NAME')
 GLOBOMAP_RMQ_EXCHANGE = os.getenv('GLOBOMAP_RMQ_EXCHANGE')
 GLOBOMAP_RMQ_ERROR_EXCHANGE = os.getenv('GLOBOMAP_RMQ_ERROR_EXCHANGE')
+GLOBOMAP_RMQ_ERROR_QUEUE_NAME = os.getenv('GLOBOMAP_RMQ_ERROR_QUEUE_NAME')
 GLOBOMAP_RMQ_KEY = os.getenv('GLOBOMAP_RMQ_BINDING_KEY', 'globomap.updates')
+GLOBOMAP_RMQ_SHARD_EXCHANGE = os.getenv(
+    'GLOBOMAP_RMQ_SHARD_EXCHANGE', '{}-sharded'.format(GLOBOMAP_RMQ_EXCHANGE))
+GLOBOMAP_RMQ_SHARD_HEADER = os.getenv(
+    'GLOBOMAP_RMQ_SHARD_HEADER', 'X-DOCUMENT-KEY')
+QUEUE_SHARDS = int(os.getenv('QUEUE_SHARDS', 0))
+
+ERROR_PUBLISH_MODE = os.getenv('ERROR_PUBLISH_MODE', 'tx')
+ERROR_BUFFER_SIZE = int(os.getenv('ERROR_BUFFER_SIZE', 10000))
+ERROR_MAX_UNCONFIRMED = int(os.getenv('ERROR_MAX_UNCONFIRMED', 100))
+ERROR_BATCH_SIZE = int(os.getenv('ERROR_BATCH_SIZE', 100))
+ERROR_BATCH_WAIT = float(os.getenv('ERROR_BATCH_WAIT', 1))
+ERROR_SPOOL_PATH = os.getenv('ERROR_SPOOL_PATH', '')
 
 SCHEDULER_FREQUENCY_EXEC = os.getenv('SCHEDULER_FREQUENCY_EXEC')
 
-RETRIES = os.getenv('RETRIES', 10)
+RETRIES = int(os.getenv('RETRIES', 10))
+RETRY_QUEUE_SIZE = int(os.getenv('RETRY_QUEUE_SIZE', 0))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+RETRY_DEADLINE = float(os.getenv('RETRY_DEADLINE', 600))
 
 FACTOR = int(os.getenv('FACTOR', 1))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 30))
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 1))
+AUTOSCALE_MIN_WORKERS = int(os.getenv('AUTOSCALE_MIN_WORKERS', FACTOR))
+AUTOSCALE_MAX_WORKERS = int(os.getenv('AUTOSCALE_MAX_WORKERS', FACTOR))
+AUTOSCALE_INTERVAL = float(os.getenv('AUTOSCALE_INTERVAL', 30))
+AUTOSCALE_UP_DEPTH = int(os.getenv('AUTOSCALE_UP_DEPTH', 1000))
+AUTOSCALE_DOWN_DEPTH = int(os.getenv('AUTOSCALE_DOWN_DEPTH', 100))
+AUTOSCALE_SAMPLES = int(os.getenv('AUTOSCALE_SAMPLES', 3))
+
+PREFETCH_COUNT = int(os.getenv('PREFETCH_COUNT', 0))
+PREFETCH_ADAPTIVE = os.getenv('PREFETCH_ADAPTIVE', '0') == '1'
+PREFETCH_MIN = int(os.getenv('PREFETCH_MIN', 1))
+PREFETCH_MAX = int(os.getenv('PREFETCH_MAX', 1000))
+PREFETCH_STEP = int(os.getenv('PREFETCH_STEP', 5))
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 10))
+PREFETCH_LATENCY_TARGET = float(os.getenv('PREFETCH_LATENCY_TARGET', 1))
+PREFETCH_MAX_ERROR_RATE = float(os.getenv('PREFETCH_MAX_ERROR_RATE', 0.05))
+
+ACK_BATCH_SIZE = int(os.getenv('ACK_BATCH_SIZE', 1))
+ACK_FLUSH_INTERVAL = float(os.getenv('ACK_FLUSH_INTERVAL', 1))
+
+WORKER_MODE = os.getenv('WORKER_MODE', 'tornado')
+ASYNC_CONCURRENCY = int(os.getenv('ASYNC_CONCURRENCY', 10))
+
+DISPATCH_LANES = int(os.getenv('DISPATCH_LANES', 0))
+LANE_DEPTH = int(os.getenv('LANE_DEPTH', 100))
+
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 1))
+BATCH_MAX_WAIT = float(os.getenv('BATCH_MAX_WAIT', 1))
+BATCH_OPEN_GROUPS = int(os.getenv('BATCH_OPEN_GROUPS', 4))
+BATCH_PIPELINE_SIZE = int(os.getenv('BATCH_PIPELINE_SIZE', 10))
+
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 0))
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', 0))
+DEDUP_CACHE_TTL = float(os.getenv('DEDUP_CACHE_TTL', 300))
+DEDUP_CACHE_PATH = os.getenv('DEDUP_CACHE_PATH', '')
+
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 10))
+LOG_SUMMARY_INTERVAL = float(os.getenv('LOG_SUMMARY_INTERVAL', 60))
+LOG_SAMPLE_BYPASS = os.getenv('LOG_SAMPLE_BYPASS', '0') == '1'
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 15))
+
+REPLAY_RATE = float(os.getenv('REPLAY_RATE', 10))
+REPLAY_CONCURRENCY = int(os.getenv('REPLAY_CONCURRENCY', 4))
+REPLAY_PROGRESS_INTERVAL = float(os.getenv('REPLAY_PROGRESS_INTERVAL', 10))
 
 QUERIES = os.getenv('QUERIES', '')
+QUERY_DEPENDENCIES = os.getenv('QUERY_DEPENDENCIES', '')
+QUERY_CONCURRENCY = int(os.getenv('QUERY_CONCURRENCY', 4))
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', 600))
 
 ZBX_PASSIVE_MONITOR_LOADER = os.getenv('ZBX_PASSIVE_MONITOR_LOADER')
 ZBX_PASSIVE_MONITOR_SCHED_QUERIES = os.getenv(
@@ -13,16 +13,192 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import logging
+import queue
+import threading
+import time
+
+from globomap_loader import metrics
 from globomap_loader.loader.globomap import GloboMapClient
 from globomap_loader.settings import GLOBOMAP_API_URL
 from globomap_loader.settings import QUERIES
+from globomap_loader.settings import QUERY_CONCURRENCY
+from globomap_loader.settings import QUERY_DEPENDENCIES
+from globomap_loader.settings import QUERY_TIMEOUT
 
+LOGGER = logging.getLogger(__name__)
 
-def run_queries():
-    globomap_client = GloboMapClient(GLOBOMAP_API_URL)
-    for qr in QUERIES.split(','):
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+SKIPPED = 'skipped'
+
+
+def parse_queries(queries):
+    """Parses 'query;variable,query' into (query, variable) pairs."""
+    parsed = []
+    for qr in queries.split(','):
         if qr:
             qr = qr.split(';')
             variable = qr[1] if len(qr) > 1 else ''
-            query = qr[0]
-            globomap_client.run_query(query, variable)
+            parsed.append((qr[0], variable))
+    return parsed
+
+
+def parse_dependencies(dependencies):
+    """
+    Parses 'query:dependency+dependency,query:dependency' into a dict of
+    the queries each query must wait for.
+    """
+    parsed = {}
+    for entry in dependencies.split(','):
+        if ':' in entry:
+            query, after = entry.split(':', 1)
+            parsed.setdefault(query.strip(), set()).update(
+                dep.strip() for dep in after.split('+') if dep.strip())
+    return parsed
+
+
+class QueryRunner(object):
+    """
+    Runs queries on at most `concurrency` threads. A query starts once
+    every run of the queries it depends on succeeded and is skipped when
+    one of them failed. A query running longer than `timeout` seconds is
+    recorded as timed out, but keeps its thread until the call returns,
+    which the client bounds with a request timeout; the query is skipped
+    by the following runs until then.
+    """
+
+    _running = set()
+    _running_lock = threading.Lock()
+
+    def __init__(self, client, concurrency=QUERY_CONCURRENCY,
+                 timeout=QUERY_TIMEOUT):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+
+    def run(self, queries, dependencies=None):
+        """Runs the (query, variable) pairs, returning their outcomes."""
+        dependencies = dependencies or {}
+        names = set(query for query, _ in queries)
+        for query, after in dependencies.items():
+            unknown = after - names
+            if unknown:
+                LOGGER.warning('Query %s depends on queries not scheduled: '
+                               '%s', query, ', '.join(sorted(unknown)))
+
+        outcomes = {}
+        waiting = list(queries)
+        running = {}
+        timed_out = set()
+        done = queue.Queue()
+        while waiting or running:
+            for entry in list(waiting):
+                if len(running) >= self.concurrency:
+                    break
+                state = self._dependencies_state(
+                    dependencies.get(entry[0], set()) & names,
+                    queries, outcomes)
+                if state == OK:
+                    waiting.remove(entry)
+                    if self._start(entry, done):
+                        running[entry] = time.monotonic()
+                    else:
+                        self._record(entry, SKIPPED, 0)
+                        outcomes[entry] = SKIPPED
+                elif state == FAILED:
+                    waiting.remove(entry)
+                    LOGGER.warning('Skipping query %s, a dependency did '
+                                   'not succeed', entry[0])
+                    self._record(entry, SKIPPED, 0)
+                    outcomes[entry] = SKIPPED
+
+            if not running:
+                if waiting:
+                    LOGGER.error('Skipping queries with circular '
+                                 'dependencies: %s', ', '.join(
+                                     sorted(set(q for q, _ in waiting))))
+                    for entry in waiting:
+                        self._record(entry, SKIPPED, 0)
+                        outcomes[entry] = SKIPPED
+                break
+
+            timeout = None
+            timing = [started for entry, started in running.items()
+                      if entry not in timed_out]
+            if timing:
+                timeout = max(0, min(timing) + self.timeout -
+                              time.monotonic())
+            try:
+                entry, outcome, seconds = done.get(timeout=timeout)
+            except queue.Empty:
+                now = time.monotonic()
+                for entry, started in running.items():
+                    if entry not in timed_out and \
+                            now - started >= self.timeout:
+                        timed_out.add(entry)
+                        LOGGER.error('Query %s did not finish in %ss',
+                                     entry[0], self.timeout)
+                        self._record(entry, TIMEOUT, now - started)
+                        outcomes[entry] = TIMEOUT
+                continue
+            # A query that timed out holds its slot until its call returns.
+            running.pop(entry)
+            if entry in timed_out:
+                LOGGER.info('Query %s finished after timing out in %.1fs',
+                            entry[0], seconds)
+                continue
+            self._record(entry, outcome, seconds)
+            outcomes[entry] = outcome
+        return outcomes
+
+    def _dependencies_state(self, after, queries, outcomes):
+        state = OK
+        for entry in queries:
+            if entry[0] in after:
+                if entry not in outcomes:
+                    state = None
+                elif outcomes[entry] != OK:
+                    return FAILED
+        return state
+
+    def _start(self, entry, done):
+        with self._running_lock:
+            if entry in self._running:
+                LOGGER.warning('Skipping query %s, its previous run is '
+                               'still going', entry[0])
+                return False
+            self._running.add(entry)
+        thread = threading.Thread(
+            target=self._execute, args=(entry, done),
+            name='Query-%s' % entry[0])
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _execute(self, entry, done):
+        started = time.monotonic()
+        outcome = FAILED
+        try:
+            self.client.run_query(*entry)
+            outcome = OK
+        except Exception:
+            LOGGER.exception('Query %s failed', entry[0])
+        finally:
+            with self._running_lock:
+                self._running.discard(entry)
+            done.put((entry, outcome, time.monotonic() - started))
+
+    def _record(self, entry, outcome, seconds):
+        LOGGER.info('query=%s variable=%s outcome=%s seconds=%.1f',
+                    entry[0], entry[1], outcome, seconds)
+        metrics.QUERY_RUNS.labels(entry[0], outcome).inc()
+        if outcome != SKIPPED:
+            metrics.QUERY_SECONDS.labels(entry[0]).observe(seconds)
+
+
+def run_queries():
+    globomap_client = GloboMapClient(GLOBOMAP_API_URL, QUERY_TIMEOUT)
+    QueryRunner(globomap_client).run(
+        parse_queries(QUERIES), parse_dependencies(QUERY_DEPENDENCIES))
@@ -0,0 +1,75 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from mock import MagicMock
+from mock import call
+
+from globomap_loader.driver.ack import AckCoalescer
+
+
+class TestAckCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = MagicMock()
+        self.acks = AckCoalescer(self.channel, 3)
+        for tag in range(1, 6):
+            self.acks.delivered(tag)
+
+    def test_flush_on_count_threshold(self):
+        self.acks.ack(1)
+        self.acks.ack(2)
+        self.channel.basic_ack.assert_not_called()
+
+        self.acks.ack(3)
+
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.assertEqual(0, self.acks.pending())
+
+    def test_never_ack_unsettled_delivery(self):
+        self.acks.ack(1)
+        self.acks.ack(3)
+        self.acks.ack(4)
+
+        self.channel.basic_ack.assert_called_once_with(1, multiple=True)
+        self.assertEqual(2, self.acks.pending())
+
+        self.acks.ack(2)
+        self.acks.flush()
+        self.channel.basic_ack.assert_called_with(4, multiple=True)
+
+    def test_rejected_delivery_is_skipped(self):
+        self.acks.ack(1)
+        self.acks.rejected(2)
+        self.acks.ack(3)
+
+        self.assertEqual(3, self.acks.flush())
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.channel.basic_nack.assert_not_called()
+
+    def test_flush_stragglers_one_by_one(self):
+        self.acks.ack(1)
+        self.acks.ack(3)
+
+        self.assertEqual(3, self.acks.flush(stragglers=True))
+
+        self.assertEqual([call(1, multiple=True), call(3)],
+                         self.channel.basic_ack.call_args_list)
+        self.assertEqual(0, self.acks.pending())
+
+    def test_flush_without_acks(self):
+        self.assertIsNone(self.acks.flush(stragglers=True))
+        self.channel.basic_ack.assert_not_called()
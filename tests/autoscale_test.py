@@ -0,0 +1,45 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from globomap_loader.loader.autoscale import Autoscaler
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def test_scale_up_after_samples_while_not_shrinking(self):
+        autoscaler = Autoscaler(1, 10, 100, 10, 2)
+
+        self.assertEqual(2, autoscaler.decide(2, 500))
+        self.assertEqual(5, autoscaler.decide(2, 500))
+        self.assertEqual(5, autoscaler.decide(5, 800))
+        self.assertEqual(5, autoscaler.decide(5, 700))
+        self.assertEqual(5, autoscaler.decide(5, 700))
+        self.assertEqual(7, autoscaler.decide(5, 700))
+
+    def test_scale_down_one_at_a_time_within_bounds(self):
+        autoscaler = Autoscaler(2, 10, 100, 10, 2)
+
+        self.assertEqual(3, autoscaler.decide(3, 0))
+        self.assertEqual(2, autoscaler.decide(3, 0))
+        self.assertEqual(2, autoscaler.decide(2, 0))
+        self.assertEqual(2, autoscaler.decide(2, 0))
+
+    def test_capped_at_max_workers(self):
+        autoscaler = Autoscaler(1, 3, 100, 10, 1)
+
+        self.assertEqual(3, autoscaler.decide(1, 10000))
+        self.assertEqual(3, autoscaler.decide(3, 10000))
@@ -0,0 +1,115 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import unittest
+
+from mock import Mock
+
+from globomap_loader.loader.batch import UpdateBatcher
+
+
+def update(action, key, collection='vip'):
+    return {'action': action, 'type': 'collections',
+            'collection': collection, 'key': key, 'element': {}}
+
+
+class TestUpdateBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = []
+        self.event = threading.Event()
+
+    def _flush(self, group, items):
+        self.flushed.append(
+            (group, [update['key'] for update, _ in items]))
+        self.event.set()
+
+    def test_flush_when_group_is_full(self):
+        batcher = UpdateBatcher(self._flush, 2, 60)
+        batcher.start()
+        batcher.add(update('PATCH', 'a'), {})
+        batcher.add(update('PATCH', 'b'), {})
+
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(
+            [(('collections', 'vip', 'PATCH'), ['a', 'b'])], self.flushed)
+        batcher.stop()
+
+    def test_flush_when_group_times_out(self):
+        batcher = UpdateBatcher(self._flush, 100, 0.05)
+        batcher.start()
+        batcher.add(update('PATCH', 'a'), {})
+
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(
+            [(('collections', 'vip', 'PATCH'), ['a'])], self.flushed)
+        batcher.stop()
+
+    def test_stop_flushes_pending_groups(self):
+        batcher = UpdateBatcher(self._flush, 100, 60)
+        batcher.start()
+        batcher.add(update('PATCH', 'a'), {})
+        batcher.add(update('DELETE', 'b'), {})
+        batcher.stop()
+
+        self.assertEqual([
+            (('collections', 'vip', 'PATCH'), ['a']),
+            (('collections', 'vip', 'DELETE'), ['b']),
+        ], self.flushed)
+        self.assertEqual(0, batcher.pending())
+
+    def test_keep_order_of_updates_to_same_document(self):
+        batcher = UpdateBatcher(self._flush, 100, 60)
+        batcher.add(update('UPDATE', 'b'), {})
+        batcher.add(update('PATCH', 'a'), {})
+        batcher.add(update('DELETE', 'a'), {})
+        batcher.add(update('PATCH', 'c'), {})
+        batcher.start()
+        batcher.stop()
+
+        self.assertEqual([
+            (('collections', 'vip', 'UPDATE'), ['b']),
+            (('collections', 'vip', 'PATCH'), ['a']),
+            (('collections', 'vip', 'DELETE'), ['a']),
+            (('collections', 'vip', 'PATCH'), ['c']),
+        ], self.flushed)
+
+    def test_conflict_only_flushes_groups_up_to_conflicting_one(self):
+        batcher = UpdateBatcher(self._flush, 100, 60)
+        batcher.add(update('CREATE', 'a'), {})
+        batcher.add(update('UPDATE', 'b'), {})
+        batcher.add(update('PATCH', 'a'), {})
+        batcher.add(update('UPDATE', 'c'), {})
+
+        self.assertEqual(4, batcher.pending())
+        batcher.start()
+        batcher.stop()
+
+        self.assertEqual([
+            (('collections', 'vip', 'CREATE'), ['a']),
+            (('collections', 'vip', 'UPDATE'), ['b', 'c']),
+            (('collections', 'vip', 'PATCH'), ['a']),
+        ], self.flushed)
+
+    def test_flush_errors_do_not_stop_batcher(self):
+        flush = Mock(side_effect=[Exception(), None])
+        batcher = UpdateBatcher(flush, 1, 60)
+        batcher.start()
+        batcher.add(update('PATCH', 'a'), {})
+        batcher.add(update('PATCH', 'b'), {})
+        batcher.stop()
+
+        self.assertEqual(2, flush.call_count)
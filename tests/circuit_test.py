@@ -0,0 +1,126 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from mock import patch
+
+from globomap_loader.circuit import Backoff
+from globomap_loader.circuit import CircuitBreaker
+from globomap_loader.circuit import CLOSED
+from globomap_loader.circuit import HALF_OPEN
+from globomap_loader.circuit import OPEN
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_first_attempt_is_immediate_then_grows(self):
+        backoff = Backoff(1, 8)
+
+        self.assertEqual(0, backoff.delay())
+        for delay in (1, 2, 4, 8, 8):
+            wait = backoff.delay()
+            self.assertGreaterEqual(wait, delay / 2)
+            self.assertLessEqual(wait, delay)
+
+        backoff.reset()
+        self.assertEqual(0, backoff.delay())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @patch('globomap_loader.circuit.time')
+    def test_opens_after_failures_and_probes_after_timeout(self, time_mock):
+        time_mock.time.return_value = 100
+        breaker = CircuitBreaker('api', 2, 30)
+
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(30, breaker.retry_after())
+
+        time_mock.time.return_value = 130
+        self.assertEqual(HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(OPEN, breaker.state)
+
+        time_mock.time.return_value = 160
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(CLOSED, breaker.state)
+        self.assertEqual({'open': 0, 'state': 0, 'failures': 0, 'opened': 2,
+                          'error_rate': 0, 'slow_rate': 0}, breaker.stats())
+
+    @patch('globomap_loader.circuit.time')
+    def test_opens_on_error_rate_of_the_window(self, time_mock):
+        time_mock.time.return_value = 100
+        breaker = CircuitBreaker('api', 100, 30, window=10, error_rate=0.5,
+                                 min_calls=4)
+
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(CLOSED, breaker.state)
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(OPEN, breaker.state)
+        self.assertEqual(0.6, breaker.stats()['error_rate'])
+
+        time_mock.time.return_value = 200
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(0, breaker.stats()['error_rate'])
+
+    def test_threshold_of_zero_never_opens(self):
+        breaker = CircuitBreaker('api', 0, 30, window=10, error_rate=0.5,
+                                 min_calls=1, slow_call=1)
+
+        for _ in range(10):
+            breaker.failure()
+            breaker.success(5)
+
+        self.assertEqual(CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+    @patch('globomap_loader.circuit.time')
+    def test_opens_on_slow_calls_and_closes_after_probes(self, time_mock):
+        time_mock.time.return_value = 100
+        breaker = CircuitBreaker('api', 5, 30, window=10, min_calls=2,
+                                 slow_call=1, slow_call_rate=0.5, probes=2)
+
+        breaker.success(0.1)
+        breaker.success(2)
+        self.assertEqual(OPEN, breaker.state)
+
+        time_mock.time.return_value = 130
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success(0.1)
+        self.assertEqual(HALF_OPEN, breaker.state)
+        breaker.success(3)
+        self.assertEqual(OPEN, breaker.state)
+
+        time_mock.time.return_value = 160
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.success(0.1)
+        self.assertEqual(CLOSED, breaker.state)
+        self.assertEqual(2, breaker.stats()['opened'])
+
@@ -0,0 +1,108 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import unittest
+
+from globomap_loader.loader.coalesce import UpdateCoalescer
+from globomap_loader.loader.coalesce import merge_elements
+
+
+def update(action, key='k1', **element):
+    return {'action': action, 'type': 'collections', 'collection': 'vip',
+            'key': key, 'element': element}
+
+
+class TestUpdateCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.flushed = []
+        self.done = threading.Event()
+        self.coalescer = UpdateCoalescer(self._flush, 60, 100)
+
+    def _flush(self, update, originals):
+        self.flushed.append(
+            (update, [kwargs['delivery_tag'] for _, kwargs in originals]))
+
+    def _add(self, *updates):
+        for tag, item in enumerate(updates, 1):
+            self.coalescer.add(item, {'delivery_tag': tag})
+        self.coalescer.start()
+        self.coalescer.stop()
+
+    def test_merge_consecutive_patches(self):
+        self._add(update('PATCH', name='a', properties={'x': 1}),
+                  update('PATCH', properties={'y': 2}))
+
+        self.assertEqual([(update('PATCH', name='a',
+                                  properties={'x': 1, 'y': 2}), [1, 2])],
+                         self.flushed)
+        self.assertEqual(1, self.coalescer.stats()['saved'])
+
+    def test_update_supersedes_earlier_updates(self):
+        self._add(update('PATCH', name='a'), update('UPDATE', name='b'),
+                  update('PATCH', size=1))
+
+        self.assertEqual([(update('UPDATE', name='b', size=1), [1, 2, 3])],
+                         self.flushed)
+
+    def test_drop_create_followed_by_delete(self):
+        self._add(update('CREATE', name='a'), update('DELETE'))
+
+        self.assertEqual([(None, [1, 2])], self.flushed)
+        self.assertEqual({'received': 2, 'calls': 0, 'cancelled': 1,
+                          'saved': 2, 'pending': 0}, self.coalescer.stats())
+
+    def test_keep_order_of_updates_that_cannot_merge(self):
+        self._add(update('DELETE'), update('PATCH', name='a'),
+                  update('PATCH', key='k2', name='b'))
+
+        self.assertEqual([
+            (update('DELETE'), [1]),
+            (update('PATCH', name='a'), [2]),
+            (update('PATCH', key='k2', name='b'), [3]),
+        ], self.flushed)
+
+    def test_clear_flushes_pending_updates_of_collection(self):
+        clear = {'action': 'CLEAR', 'type': 'collections',
+                 'collection': 'vip', 'element': []}
+        self._add(update('PATCH', name='a'), clear)
+
+        self.assertEqual([(update('PATCH', name='a'), [1]), (clear, [2])],
+                         self.flushed)
+
+    def test_flush_oldest_over_max_held(self):
+        self.coalescer.max_held = 1
+        self._add(update('PATCH', name='a'), update('PATCH', key='k2'))
+
+        self.assertEqual([[1], [2]], [tags for _, tags in self.flushed])
+
+    def test_flush_after_window(self):
+        self.coalescer.window = 0.05
+        self.coalescer.flush_callback = lambda update, originals: \
+            self.done.set()
+        self.coalescer.start()
+        self.coalescer.add(update('PATCH'), {'delivery_tag': 1})
+
+        self.assertTrue(self.done.wait(5))
+        self.coalescer.stop()
+
+    def test_merge_elements_does_not_change_previous(self):
+        previous = {'properties': {'x': 1}}
+
+        merged = merge_elements(previous, {'properties': {'y': 2}})
+
+        self.assertEqual({'properties': {'x': 1, 'y': 2}}, merged)
+        self.assertEqual({'properties': {'x': 1}}, previous)
@@ -0,0 +1,50 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from globomap_loader import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        document = {'action': 'PATCH', 'element': {'name': 'vip ç'}}
+
+        body = codec.dumps(document)
+
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(document, codec.loads(body))
+        self.assertEqual(document, codec.loads(body, 'application/json'))
+
+    def test_other_content_types_are_json(self):
+        body = b'{"key": "a"}'
+
+        self.assertEqual({'key': 'a'},
+                         codec.loads(body, 'application/json; charset=utf-8'))
+        self.assertEqual({'key': 'a'}, codec.loads(body, 'text/plain'))
+        self.assertEqual(body, codec.dumps({'key': 'a'}, 'text/plain'))
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack not installed')
+    def test_msgpack_round_trip(self):
+        body = codec.dumps({'key': 'a'}, 'application/msgpack')
+
+        self.assertEqual({'key': 'a'},
+                         codec.loads(body, 'application/msgpack'))
+
+    @unittest.skipIf(codec.msgpack is not None, 'msgpack installed')
+    def test_msgpack_needs_package(self):
+        with self.assertRaises(codec.UnsupportedContentType):
+            codec.loads(b'\x80', 'application/msgpack')
@@ -0,0 +1,280 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import threading
+import unittest
+
+from mock import ANY
+from mock import MagicMock
+from mock import Mock
+
+from globomap_loader.circuit import Backoff
+from globomap_loader.circuit import CircuitBreaker
+from globomap_loader.driver.consumer import RabbitMQClient
+from globomap_loader.loader.dispatcher import LaneDispatcher
+
+
+class TestRabbitMQConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = RabbitMQClient('localhost', 5672, 'user',
+                                       'password', '/')
+        self.channel = MagicMock()
+        self.channel.basic_consume.return_value = 'ctag-2'
+        self.consumer._channel = self.channel
+        self.consumer._consumer_tags = ['ctag-1']
+
+    def _deliver(self, delivery_tag, key):
+        body = json.dumps({'action': 'PATCH', 'type': 'collections',
+                           'collection': 'vip', 'key': key})
+        self.consumer.on_message(
+            self.channel, Mock(delivery_tag=delivery_tag),
+            Mock(headers=None, content_type=None), body)
+
+    def test_auto_ack_after_callback(self):
+        callback = Mock()
+        self.consumer.set_settings('exchange', 'queue', ['key'], callback)
+
+        self._deliver(1, 'a')
+
+        callback.assert_called_once_with(
+            {'action': 'PATCH', 'type': 'collections',
+             'collection': 'vip', 'key': 'a'},
+            headers=None, delivery_tag=1, body=ANY, content_type=None)
+        self.channel.basic_ack.assert_called_once_with(1)
+
+    def test_track_deferred_deliveries_in_flight(self):
+        self.channel.is_open = True
+        self.consumer.set_settings(
+            'exchange', 'queue', ['key'], Mock(), auto_ack=False)
+
+        self._deliver(1, 'a')
+        self._deliver(2, 'b')
+        self.assertEqual(2, self.consumer.in_flight)
+
+        self.consumer._settle_message(self.channel, 1, None)
+        self.assertEqual(1, self.consumer.in_flight)
+        self.channel.basic_ack.assert_called_once_with(1)
+
+        self.consumer._settle_message(MagicMock(), 2, None)
+        self.assertEqual(1, self.consumer.in_flight)
+
+    def test_set_prefetch(self):
+        self.consumer.set_prefetch(42)
+
+        self.assertEqual(42, self.consumer.prefetch_count)
+        self.channel.basic_qos.assert_called_once_with(prefetch_count=42)
+
+    def test_full_lanes_pause_and_resume_deliveries(self):
+        release = threading.Event()
+        resumed = threading.Event()
+
+        def resume():
+            self.consumer.resume_consuming()
+            resumed.set()
+
+        dispatcher = LaneDispatcher(
+            lambda update, kwargs: release.wait(5), 1, 2,
+            on_pause=self.consumer.pause_consuming, on_resume=resume
+        )
+        dispatcher.start()
+        self.consumer.set_settings(
+            'exchange', 'queue', ['key'],
+            lambda update, **kwargs: dispatcher.submit(update, kwargs),
+            auto_ack=False, prefetch_count=2
+        )
+
+        self._deliver(1, 'a')
+        self.channel.basic_cancel.assert_not_called()
+        self._deliver(2, 'b')
+
+        self.channel.basic_cancel.assert_called_once_with(
+            consumer_tag='ctag-1', nowait=True)
+        self.assertEqual([], self.consumer._consumer_tags)
+        self.channel.basic_ack.assert_not_called()
+
+        release.set()
+        self.assertTrue(resumed.wait(5))
+        dispatcher.stop()
+        self.channel.basic_consume.assert_called_once_with(
+            self.consumer.on_message, 'queue')
+        self.assertEqual(['ctag-2'], self.consumer._consumer_tags)
+
+    def test_stop_consuming_while_paused_closes_channel(self):
+        self.consumer.pause_consuming()
+
+        self.consumer.stop_consuming()
+
+        self.assertEqual(1, self.channel.basic_cancel.call_count)
+        self.channel.close.assert_called_once_with()
+
+    def test_sharded_topology_consumes_assigned_shards(self):
+        for method in ('exchange_declare', 'exchange_bind', 'queue_declare',
+                       'queue_bind'):
+            getattr(self.channel, method).side_effect = \
+                lambda callback, *args, **kwargs: callback(None)
+        self.channel.basic_consume.side_effect = ['ctag-a', 'ctag-b']
+        self.consumer.set_settings('exchange', 'queue', ['key'], Mock())
+        self.consumer.set_sharding(
+            'hash', 'X-DOCUMENT-KEY', ['queue.0', 'queue.1', 'queue.2'],
+            ['queue.0', 'queue.2'])
+        self.consumer._connection = MagicMock()
+
+        self.consumer.on_channel_open(self.channel)
+
+        self.channel.exchange_declare.assert_called_with(
+            ANY, 'hash', 'x-consistent-hash', durable=True,
+            arguments={'hash-header': 'X-DOCUMENT-KEY'})
+        self.channel.exchange_bind.assert_called_once_with(
+            ANY, 'hash', 'exchange', 'key')
+        self.assertEqual(3, self.channel.queue_bind.call_count)
+        self.channel.queue_bind.assert_called_with(
+            ANY, 'queue.2', 'hash', '1')
+        self.assertEqual(
+            ['queue.0', 'queue.2'],
+            [call[0][1] for call in self.channel.basic_consume.call_args_list])
+
+        self.consumer.pause_consuming()
+
+        self.assertEqual(2, self.channel.basic_cancel.call_count)
+        self.assertEqual([], self.consumer._consumer_tags)
+
+    def test_callbacks_added_before_connecting_run_once_connected(self):
+        self.consumer._connection = None
+        callback = Mock()
+        self.consumer.add_callback_threadsafe(callback, 30)
+        connection = MagicMock()
+        self.consumer.connect = Mock(return_value=connection)
+
+        self.consumer.run()
+
+        connection.ioloop.add_callback.assert_called_once_with(callback, 30)
+        connection.ioloop.start.assert_called_once_with()
+
+    def test_connection_opened_while_closing_is_closed(self):
+        self.consumer._connection = MagicMock(is_closing=False,
+                                              is_closed=False)
+        self.consumer._channel = None
+        self.consumer._closing = True
+
+        self.consumer.on_connection_open(self.consumer._connection)
+
+        self.consumer._connection.close.assert_called_once_with()
+        self.consumer._connection.channel.assert_not_called()
+
+    def test_coalesce_acks_until_channel_close(self):
+        self.consumer.set_ack_coalescing(50, 1)
+        self.consumer.set_settings('exchange', 'queue', ['key'], Mock(),
+                                   prefetch_count=100)
+        self.consumer._connection = MagicMock()
+        self.consumer.on_channel_open(self.channel)
+
+        for tag in range(1, 4):
+            self._deliver(tag, str(tag))
+        self.channel.basic_ack.assert_not_called()
+
+        self.consumer.close_channel()
+
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.channel.close.assert_called_once_with()
+
+    def test_ack_threshold_follows_prefetch(self):
+        self.consumer.set_ack_coalescing(50, 1)
+        self.consumer.set_settings('exchange', 'queue', ['key'], Mock(),
+                                   prefetch_count=4)
+        self.consumer._connection = MagicMock()
+        self.consumer.on_channel_open(self.channel)
+
+        self._deliver(1, 'a')
+        self._deliver(2, 'b')
+
+        self.channel.basic_ack.assert_called_once_with(2, multiple=True)
+
+    def test_shutdown_waits_for_deliveries_in_flight(self):
+        self.consumer.set_settings('exchange', 'queue', ['key'], Mock(),
+                                   auto_ack=False)
+        self.consumer._connection = MagicMock()
+        self._deliver(1, 'a')
+
+        self.consumer.shutdown(30)
+
+        self.assertEqual(1, self.channel.basic_cancel.call_count)
+        self.channel.close.assert_not_called()
+        wait_settled = self.consumer._connection.add_timeout.call_args[0][1]
+
+        self.consumer._settle_message(self.channel, 1, None)
+        wait_settled()
+
+        self.channel.basic_ack.assert_called_once_with(1)
+        self.channel.close.assert_called_once_with()
+
+    def test_reconnect_right_away_then_back_off(self):
+        connection = MagicMock()
+        self.consumer._connection = connection
+        self.consumer.set_reconnect_policy(Backoff(1, 60))
+
+        self.consumer.on_connection_closed(connection, 320, 'restart')
+        self.consumer.on_connection_open_error(connection, 'refused')
+
+        first, second = connection.add_timeout.call_args_list
+        self.assertEqual(0, first[0][0])
+        self.assertGreaterEqual(second[0][0], 0.5)
+        self.assertIsNotNone(self.consumer._disconnected_at)
+
+        self.consumer.on_connection_open(connection)
+
+        self.assertIsNone(self.consumer._disconnected_at)
+        self.assertEqual(0, self.consumer._backoff.attempts)
+
+    def test_no_reconnect_while_broker_circuit_is_open(self):
+        connection = MagicMock()
+        self.consumer._connection = connection
+        breaker = CircuitBreaker('broker', 1, 30)
+        self.consumer.set_reconnect_policy(Backoff(1, 60), breaker)
+
+        self.consumer.on_connection_closed(connection, 320, 'restart')
+
+        self.assertGreater(connection.add_timeout.call_args[0][0], 29)
+
+    def test_undecodable_message_is_rejected(self):
+        callback = Mock()
+        self.consumer.set_settings('exchange', 'queue', ['key'], callback)
+
+        self.consumer.on_message(
+            self.channel, Mock(delivery_tag=1),
+            Mock(headers=None, content_type='text/xml'), '<xml/>')
+
+        callback.assert_not_called()
+        self.channel.basic_nack.assert_called_once_with(1, requeue=False)
+        self.assertEqual(0, self.consumer.in_flight)
+
+    def test_undecodable_message_goes_to_decode_error_handler(self):
+        callback, on_decode_error = Mock(), Mock()
+        self.consumer.set_settings('exchange', 'queue', ['key'], callback,
+                                   auto_ack=False)
+        self.consumer.set_decode_error_handler(on_decode_error)
+
+        self.consumer.on_message(
+            self.channel, Mock(delivery_tag=1),
+            Mock(headers={'X-REQUEST-ID': 'r'},
+                 content_type='application/json; charset=utf-8'), b'{')
+
+        callback.assert_not_called()
+        on_decode_error.assert_called_once_with(
+            b'{', {'X-REQUEST-ID': 'r'}, 'application/json; charset=utf-8',
+            ANY)
+        self.channel.basic_ack.assert_called_once_with(1)
+        self.assertEqual(0, self.consumer.in_flight)
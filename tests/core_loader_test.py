@@ -0,0 +1,115 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import signal
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from globomap_loader.loader.autoscale import Autoscaler
+from globomap_loader.loader.loader import CoreLoader
+
+
+class TestCoreLoader(unittest.TestCase):
+
+    def setUp(self):
+        patch('globomap_loader.loader.loader.GloboMapClient').start()
+        patch('globomap_loader.loader.loader.GenericDriver').start()
+        patch('globomap_loader.loader.loader.UpdateExceptionHandler').start()
+        patch('globomap_loader.loader.loader.FACTOR', 2).start()
+        patch('globomap_loader.loader.loader.WORKER_RESTART_DELAY', 0).start()
+        self.worker = patch(
+            'globomap_loader.loader.loader.DriverWorker').start()
+        self.worker.side_effect = lambda *args: Mock()
+        self.loader = CoreLoader()
+        self.loader._supervise = Mock()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_dead_workers_are_restarted(self):
+        self.loader.load()
+        dead = self.loader.workers[0]
+        dead.is_alive.return_value = False
+        self.worker.reset_mock()
+
+        self.loader.restart_dead_workers()
+        self.assertIsNone(self.loader.workers[0])
+        self.loader.restart_dead_workers()
+
+        self.assertEqual(1, self.worker.call_count)
+        self.loader.workers[0].start.assert_called_once_with()
+
+    @patch('globomap_loader.loader.loader.os.kill')
+    def test_stop_terminates_and_kills_stragglers(self, kill):
+        self.loader.load()
+        drained, stuck = self.loader.workers
+        stuck.pid = 4242
+        drained.is_alive.side_effect = [True, False]
+        stuck.is_alive.side_effect = [True, True]
+
+        self.loader.stop(timeout=0)
+
+        drained.terminate.assert_called_once_with()
+        stuck.terminate.assert_called_once_with()
+        kill.assert_called_once_with(4242, signal.SIGKILL)
+        self.loader.restart_dead_workers()
+        self.assertEqual(2, self.worker.call_count)
+
+    def test_autoscale_follows_queue_depth(self):
+        self.loader.autoscaler = Autoscaler(1, 4, 100, 10, 1)
+        self.loader.load()
+        broker = Mock()
+        self.loader._broker = broker
+
+        broker.queue_stats.return_value = (350, 2)
+        self.loader.autoscale()
+        self.assertEqual(4, len(self.loader.workers))
+
+        broker.queue_stats.return_value = (0, 4)
+        self.loader.autoscale()
+        self.assertEqual(3, len(self.loader.workers))
+        self.assertEqual(1, len(self.loader._retired))
+        self.loader._retired[0].terminate.assert_called_once_with()
+
+        broker.queue_stats.side_effect = Exception('closed')
+        self.loader.autoscale()
+        self.assertIsNone(self.loader._broker)
+
+    def test_sharded_workers_are_reassigned_on_scale(self):
+        patch('globomap_loader.loader.loader.QUEUE_SHARDS', 4).start()
+        driver = patch('globomap_loader.loader.loader.GenericDriver').start()
+        self.loader.load()
+        self.assertEqual([[0, 2], [1, 3]],
+                         [call[0][0] for call in driver.call_args_list])
+        driver.reset_mock()
+        first, second = self.loader.workers
+
+        self.loader.scale(6)
+
+        self.assertEqual(4, len(self.loader.workers))
+        self.assertEqual([[0], [1], [2], [3]],
+                         [call[0][0] for call in driver.call_args_list])
+        self.assertEqual([first, second], self.loader._retired)
+        first.terminate.assert_called_once_with()
+
+        broker = Mock()
+        broker.queue_stats.return_value = (5, 1)
+        self.loader._broker = broker
+        self.loader.autoscaler = Mock()
+        self.loader.autoscaler.decide.return_value = 4
+        self.loader.autoscale()
+        self.loader.autoscaler.decide.assert_called_once_with(4, 20)
@@ -0,0 +1,137 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import os
+import tempfile
+import unittest
+
+from mock import patch
+
+from globomap_loader.loader.dedup import content_hash
+from globomap_loader.loader.dedup import DedupCache
+from globomap_loader.loader.dedup import SharedDedupCache
+from globomap_loader.loader.globomap import GloboMapClient
+
+
+class TestDedupCache(unittest.TestCase):
+
+    def test_hit_only_for_same_content_and_action(self):
+        cache = DedupCache(10, 60)
+        doc = ('collections', 'vip', 'vip_1')
+        cache.store(doc, content_hash('UPDATE', {'name': 'a'}))
+
+        self.assertTrue(cache.seen(doc, content_hash('UPDATE', {'name': 'a'})))
+        self.assertFalse(
+            cache.seen(doc, content_hash('UPDATE', {'name': 'b'})))
+        self.assertFalse(cache.seen(doc, content_hash('PATCH', {'name': 'a'})))
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(2, cache.stats()['misses'])
+
+    def test_bounded_and_expiring(self):
+        cache = DedupCache(2, 60)
+        digest = content_hash('UPDATE', {})
+        for key in ('a', 'b', 'c'):
+            cache.store(('collections', 'vip', key), digest)
+
+        self.assertFalse(cache.seen(('collections', 'vip', 'a'), digest))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+        cache.ttl = 0
+        self.assertFalse(cache.seen(('collections', 'vip', 'c'), digest))
+
+    def test_invalidate_collection(self):
+        cache = DedupCache(10, 60)
+        digest = content_hash('UPDATE', {})
+        cache.store(('collections', 'vip', 'a'), digest)
+        cache.store(('collections', 'pool', 'a'), digest)
+
+        cache.invalidate_collection('collections', 'vip')
+
+        self.assertFalse(cache.seen(('collections', 'vip', 'a'), digest))
+        self.assertTrue(cache.seen(('collections', 'pool', 'a'), digest))
+
+
+class TestSharedDedupCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'dedup')
+
+    def test_written_content_is_seen_by_other_processes(self):
+        digest = content_hash('UPDATE', {'name': 'a'})
+        doc = ('collections', 'vip', 'vip_1')
+        SharedDedupCache(self.path, 64, 60).store(doc, digest)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if SharedDedupCache(self.path, 64, 60)
+                     .seen(doc, digest) else 1)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+    def test_invalidate(self):
+        cache = SharedDedupCache(self.path, 64, 60)
+        digest = content_hash('UPDATE', {})
+        cache.store(('collections', 'vip', 'a'), digest)
+        cache.store(('collections', 'pool', 'b'), digest)
+
+        cache.invalidate_collection('collections', 'vip')
+        self.assertFalse(cache.seen(('collections', 'vip', 'a'), digest))
+        self.assertTrue(cache.seen(('collections', 'pool', 'b'), digest))
+
+        cache.invalidate(('collections', 'pool', 'b'))
+        self.assertFalse(cache.seen(('collections', 'pool', 'b'), digest))
+
+
+class TestClientDedup(unittest.TestCase):
+
+    def setUp(self):
+        patch('globomap_loader.loader.globomap.Session').start()
+        patch('globomap_loader.loader.globomap.auth').start()
+        patch('globomap_loader.loader.globomap.Document').start()
+        patch('globomap_loader.loader.globomap.Query').start()
+        patch('globomap_loader.loader.globomap.DEDUP_CACHE_SIZE', 10).start()
+        self.client = GloboMapClient('http://localhost:8080')
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_unchanged_update_is_skipped(self):
+        element = {'name': 'vip_1', 'properties': {'port': 80}}
+
+        self.client.update('collections', 'vip', 'vip_1', element)
+        self.client.update('collections', 'vip', 'vip_1', dict(element))
+        self.assertEqual(1, self.client.doc.put.call_count)
+
+        self.client.patch('collections', 'vip', 'vip_1', element)
+        self.client.update('collections', 'vip', 'vip_1', {'name': 'x'})
+        self.assertEqual(2, self.client.doc.put.call_count)
+        self.assertEqual(1, self.client.doc.patch.call_count)
+
+    def test_delete_clear_and_failures_invalidate(self):
+        element = {'name': 'vip_1'}
+        self.client.update('collections', 'vip', 'vip_1', element)
+        self.client.delete('collections', 'vip', 'vip_1')
+        self.client.update('collections', 'vip', 'vip_1', element)
+        self.client.clear('collections', 'vip', [])
+        self.client.update('collections', 'vip', 'vip_1', element)
+        self.assertEqual(3, self.client.doc.put.call_count)
+
+        self.client.doc.put.side_effect = Exception('down')
+        self.client.delete('collections', 'vip', 'vip_1')
+        with self.assertRaises(Exception):
+            self.client.update('collections', 'vip', 'vip_1', element)
+        self.client.doc.put.side_effect = None
+        self.client.update('collections', 'vip', 'vip_1', element)
+        self.assertEqual(5, self.client.doc.put.call_count)
@@ -0,0 +1,81 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import unittest
+
+from mock import Mock
+
+from globomap_loader.loader.dispatcher import LaneDispatcher
+
+
+def update(action, key, collection='vip'):
+    return {'action': action, 'type': 'collections',
+            'collection': collection, 'key': key, 'element': {}}
+
+
+class TestLaneDispatcher(unittest.TestCase):
+
+    def test_same_document_goes_to_same_lane(self):
+        dispatcher = LaneDispatcher(Mock(), 8, 10)
+
+        self.assertEqual(
+            dispatcher.lane_for(update('CREATE', 'a')),
+            dispatcher.lane_for(update('DELETE', 'a'))
+        )
+
+    def test_keep_order_of_updates_to_same_document(self):
+        handled = []
+        dispatcher = LaneDispatcher(
+            lambda update, kwargs: handled.append(update['action']), 4, 100)
+        dispatcher.start()
+        for action in ('CREATE', 'PATCH', 'UPDATE', 'DELETE'):
+            dispatcher.submit(update(action, 'a'), {})
+        dispatcher.stop()
+
+        self.assertEqual(['CREATE', 'PATCH', 'UPDATE', 'DELETE'], handled)
+
+    def test_pause_when_lane_is_full_and_resume_when_drained(self):
+        release = threading.Event()
+        resumed = threading.Event()
+        on_pause = Mock()
+        dispatcher = LaneDispatcher(
+            lambda update, kwargs: release.wait(5), 1, 2,
+            on_pause=on_pause, on_resume=resumed.set
+        )
+        dispatcher.start()
+        dispatcher.submit(update('PATCH', 'a'), {})
+        dispatcher.submit(update('PATCH', 'b'), {})
+
+        on_pause.assert_called_once_with()
+        self.assertEqual(
+            {'depths': [2], 'paused': True, 'pauses': 1, 'dispatched': 2},
+            dispatcher.stats()
+        )
+
+        release.set()
+        self.assertTrue(resumed.wait(5))
+        dispatcher.stop()
+        self.assertEqual([0], dispatcher.depths())
+
+    def test_handler_errors_do_not_stop_lane(self):
+        handler = Mock(side_effect=[Exception(), None])
+        dispatcher = LaneDispatcher(handler, 1, 10)
+        dispatcher.start()
+        dispatcher.submit(update('PATCH', 'a'), {})
+        dispatcher.submit(update('PATCH', 'a'), {})
+        dispatcher.stop()
+
+        self.assertEqual(2, handler.call_count)
@@ -13,18 +13,26 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import asyncio
+import time
 import unittest
 
 from mock import MagicMock
 from mock import Mock
+from mock import patch
 
+from globomap_loader.loader.globomap import GloboMapCircuitOpen
 from globomap_loader.loader.globomap import GloboMapException
+from globomap_loader.loader.globomap import GloboMapRetry
 from globomap_loader.loader.loader import DriverWorker
 from tests.util import open_json
 
 
 class TestDriverWorker(unittest.TestCase):
 
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
     def test_sync_updates(self):
         update = open_json('tests/json/driver/driver_output_create.json')
         globomap_client_mock = MagicMock()
@@ -52,6 +60,286 @@ class TestDriverWorker(unittest.TestCase):
         self.assertEqual(400, update['status'])
         self.assertEqual({'errors': 'error msg'}, update['error_msg'])
 
+    def test_undecodable_body_goes_to_error_exchange(self):
+        exception_handler = MagicMock()
+
+        DriverWorker(MagicMock(), Mock(), exception_handler) \
+            ._handle_decode_error(b'{', {'X-REQUEST-ID': 'r'},
+                                  'application/json', ValueError('eof'))
+
+        exception_handler.handle_exception.assert_called_once_with(
+            'Mock', {'collection': 'undecodable', 'status': 400,
+                     'error_msg': 'Could not decode body: eof'},
+            body=b'{', headers={'X-REQUEST-ID': 'r'},
+            content_type='application/json')
+
+    def test_process_batch_settles_each_delivery(self):
+        ok = open_json('tests/json/driver/driver_output_create.json')
+        failed = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = Mock()
+        globomap_client_mock.update_elements_state.return_value = [
+            None, GloboMapException({'errors': 'error msg'}, 500)
+        ]
+        driver_mock = Mock()
+        exception_handler = MagicMock()
+
+        DriverWorker(globomap_client_mock, driver_mock, exception_handler) \
+            ._process_batch(('collections', 'vip', 'CREATE'), [
+                (ok, {'delivery_tag': 1}),
+                (failed, {'delivery_tag': 2, 'headers': {}}),
+            ])
+
+        globomap_client_mock.update_elements_state.assert_called_once_with(
+            'CREATE', 'collections', 'vip',
+            [(ok['element'], None), (failed['element'], None)]
+        )
+        exception_handler.handle_exception.assert_called_once_with(
+            'Mock', failed, headers={})
+        self.assertEqual(500, failed['status'])
+        driver_mock.ack.assert_any_call(1)
+        driver_mock.ack.assert_any_call(2)
+        driver_mock.reject.assert_not_called()
+
+    def test_process_batch_requeues_unhandled_failures(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = Mock()
+        globomap_client_mock.update_elements_state.return_value = [
+            GloboMapException({'errors': 'error msg'}, 500)
+        ]
+        driver_mock = Mock()
+        exception_handler = Mock()
+        exception_handler.handle_exception.side_effect = Exception()
+
+        DriverWorker(globomap_client_mock, driver_mock, exception_handler) \
+            ._process_batch(('collections', 'vip', 'CREATE'),
+                            [(update, {'delivery_tag': 7})])
+
+        driver_mock.reject.assert_called_once_with(7)
+        driver_mock.ack.assert_not_called()
+
+    @patch('globomap_loader.loader.loader.BATCH_SIZE', 50)
+    def test_prefetch_fits_open_batches(self):
+        worker = DriverWorker(Mock(), Mock(), None)
+
+        self.assertEqual(200, worker._prefetch_count())
+
+    @patch('globomap_loader.loader.loader.DISPATCH_LANES', 4)
+    @patch('globomap_loader.loader.loader.LANE_DEPTH', 25)
+    def test_prefetch_fills_lanes(self):
+        worker = DriverWorker(Mock(), Mock(), None)
+
+        self.assertEqual(100, worker._prefetch_count())
+
+    @patch('globomap_loader.loader.loader.PREFETCH_COUNT', 7)
+    def test_prefetch_from_settings(self):
+        worker = DriverWorker(Mock(), Mock(), None)
+
+        self.assertEqual(7, worker._prefetch_count())
+
+    @patch('globomap_loader.loader.loader.WORKER_MODE', 'asyncio')
+    def test_asyncio_mode_acks_processed_updates(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = MagicMock()
+        driver_mock = Mock()
+        worker = DriverWorker(globomap_client_mock, driver_mock, None)
+
+        callback, auto_ack = worker._setup_pipeline()
+        self.addCleanup(self._close_pipeline, worker)
+        worker._loop.run_until_complete(callback(update, delivery_tag=3))
+
+        self.assertFalse(auto_ack)
+        globomap_client_mock.update_element_state.assert_called_once_with(
+            'CREATE', 'collections', 'vip', update['element'], None
+        )
+        driver_mock.ack.assert_called_once_with(3)
+
+    @patch('globomap_loader.loader.loader.WORKER_MODE', 'asyncio')
+    def test_asyncio_mode_requeues_unhandled_failures(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = self._mock_globomap_client(
+            GloboMapException({'errors': 'error msg'}, 500)
+        )
+        exception_handler = Mock()
+        exception_handler.handle_exception.side_effect = Exception()
+        driver_mock = Mock()
+        worker = DriverWorker(
+            globomap_client_mock, driver_mock, exception_handler)
+
+        callback, _ = worker._setup_pipeline()
+        self.addCleanup(self._close_pipeline, worker)
+        worker._loop.run_until_complete(callback(update, delivery_tag=4))
+
+        driver_mock.reject.assert_called_once_with(4)
+        driver_mock.ack.assert_not_called()
+
+    @patch('globomap_loader.loader.loader.WORKER_MODE', 'asyncio')
+    def test_asyncio_mode_keeps_order_of_same_document(self):
+        applied = []
+        globomap_client_mock = Mock()
+
+        def update_element_state(action, *args):
+            if action == 'CREATE':
+                time.sleep(0.05)
+            applied.append(action)
+        globomap_client_mock.update_element_state.side_effect = \
+            update_element_state
+        worker = DriverWorker(globomap_client_mock, Mock(), None)
+
+        callback, _ = worker._setup_pipeline()
+        self.addCleanup(self._close_pipeline, worker)
+        tasks = [
+            callback({'action': action, 'type': 'collections',
+                      'collection': 'vip', 'key': 'a'}, delivery_tag=tag)
+            for tag, action in enumerate(['CREATE', 'PATCH', 'DELETE'])
+        ]
+        worker._loop.run_until_complete(asyncio.gather(*tasks))
+
+        self.assertEqual(['CREATE', 'PATCH', 'DELETE'], applied)
+        self.assertEqual({}, worker._document_tasks)
+
+    def test_transient_failure_is_retried_later(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = Mock()
+        globomap_client_mock.update_element_state.side_effect = [
+            GloboMapRetry('unavailable', 503), None]
+        driver_mock = Mock()
+        worker = DriverWorker(globomap_client_mock, driver_mock, None)
+        worker.retry_scheduler = Mock()
+        worker.retry_scheduler.hold.return_value = False
+
+        worker._settle_update(update, delivery_tag=5)
+
+        worker.retry_scheduler.schedule.assert_called_once_with(
+            update, {'delivery_tag': 5}, 1, None)
+        driver_mock.ack.assert_not_called()
+
+        self.assertFalse(
+            worker._attempt_update(update, {'delivery_tag': 5}, 1, 10))
+        driver_mock.ack.assert_called_once_with(5)
+
+    def test_retry_exhausted_goes_to_exception_handler(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = self._mock_globomap_client(
+            GloboMapRetry({'errors': '1200'}, 400))
+        driver_mock = Mock()
+        exception_handler = Mock()
+        worker = DriverWorker(
+            globomap_client_mock, driver_mock, exception_handler)
+        worker.retry_scheduler = Mock()
+        worker.retry_scheduler.schedule.return_value = False
+
+        worker._attempt_update(update, {'delivery_tag': 6}, 3, 10)
+
+        self.assertEqual(
+            1, globomap_client_mock.update_element_state.call_count)
+        exception_handler.handle_exception.assert_called_once_with(
+            'Mock', update)
+        driver_mock.ack.assert_called_once_with(6)
+
+    def test_open_circuit_parks_update_without_using_a_retry(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = self._mock_globomap_client(
+            GloboMapCircuitOpen(20))
+        driver_mock = Mock()
+        worker = DriverWorker(globomap_client_mock, driver_mock, None)
+        worker.retry_scheduler = Mock()
+        worker.retry_scheduler.backoff.return_value = 1
+
+        self.assertTrue(
+            worker._attempt_update(update, {'delivery_tag': 7}, 2, 10))
+
+        worker.retry_scheduler.schedule.assert_called_once_with(
+            update, {'delivery_tag': 7}, 2, 10, 20)
+        driver_mock.ack.assert_not_called()
+        driver_mock.reject.assert_not_called()
+
+    @patch('globomap_loader.loader.loader.BREAKER_OPEN_ACTION', 'requeue')
+    def test_open_circuit_requeues_and_pauses_consuming(self):
+        update = open_json('tests/json/driver/driver_output_create.json')
+        globomap_client_mock = self._mock_globomap_client(
+            GloboMapCircuitOpen(0.05))
+        driver_mock = Mock()
+        exception_handler = Mock()
+        worker = DriverWorker(
+            globomap_client_mock, driver_mock, exception_handler)
+
+        with patch('globomap_loader.loader.loader.threading.Timer') as timer:
+            worker._settle_update(update, delivery_tag=8)
+            worker._settle_update(update, delivery_tag=9)
+
+        driver_mock.reject.assert_any_call(8)
+        driver_mock.reject.assert_any_call(9)
+        driver_mock.pause.assert_called_once_with()
+        timer.assert_called_once_with(1, worker._resume_after_open)
+        exception_handler.handle_exception.assert_not_called()
+
+        worker._resume_after_open()
+        driver_mock.resume.assert_called_once_with()
+
+    @patch('globomap_loader.loader.loader.COALESCE_WINDOW', 60)
+    @patch('globomap_loader.loader.loader.RETRY_QUEUE_SIZE', 0)
+    def test_coalesced_updates_settle_every_delivery(self):
+        first = open_json('tests/json/driver/driver_output_create.json')
+        second = open_json('tests/json/driver/driver_output_create.json')
+        first['action'] = second['action'] = 'PATCH'
+        globomap_client_mock = self._mock_globomap_client(
+            GloboMapException({'errors': 'error msg'}, 500))
+        driver_mock = Mock()
+        exception_handler = Mock()
+        worker = DriverWorker(
+            globomap_client_mock, driver_mock, exception_handler)
+
+        callback, auto_ack = worker._setup_pipeline()
+        callback(first, delivery_tag=1, headers={'id': 1})
+        callback(second, delivery_tag=2, headers={'id': 2})
+        worker.coalescer.stop()
+
+        self.assertFalse(auto_ack)
+        globomap_client_mock.update_element_state.assert_called_once_with(
+            'PATCH', 'collections', 'vip', second['element'], None)
+        exception_handler.handle_exception.assert_any_call(
+            'Mock', first, headers={'id': 1})
+        exception_handler.handle_exception.assert_any_call(
+            'Mock', second, headers={'id': 2})
+        driver_mock.ack.assert_any_call(1)
+        driver_mock.ack.assert_any_call(2)
+
+    def test_cancelled_updates_are_acked(self):
+        driver_mock = Mock()
+        worker = DriverWorker(Mock(), driver_mock, None)
+
+        worker._flush_coalesced(None, [({}, {'delivery_tag': 1}),
+                                       ({}, {'delivery_tag': 2})])
+
+        driver_mock.ack.assert_any_call(1)
+        driver_mock.ack.assert_any_call(2)
+
+    @patch('globomap_loader.loader.loader.SHUTDOWN_TIMEOUT', 30)
+    def test_sigterm_drains_pipeline_then_closes_connection(self):
+        driver_mock = Mock()
+        worker = DriverWorker(Mock(), driver_mock, Mock())
+        worker.batcher = Mock()
+        worker.retry_scheduler = Mock()
+        worker.retry_scheduler.stop.side_effect = \
+            lambda on_pending: on_pending({}, {'delivery_tag': 7})
+        worker._consuming = True
+
+        worker._on_sigterm(None, None)
+
+        self.assertTrue(worker._drained.wait(5))
+        self.assertTrue(worker._stopping)
+        driver_mock.stop_consuming.assert_called_once()
+        worker.batcher.stop.assert_called_once_with()
+        driver_mock.reject.assert_called_once_with(7)
+        driver_mock.shutdown.assert_called_once()
+        self.assertLessEqual(driver_mock.shutdown.call_args[0][0], 30)
+
+    def _close_pipeline(self, worker):
+        if worker.retry_scheduler is not None:
+            worker.retry_scheduler.stop()
+        worker._executor.shutdown()
+        worker._loop.close()
+
     def _mock_driver(self, return_value):
         driver_mock = Mock()
         driver_mock.updates.side_effect = [return_value, []]
@@ -19,6 +19,7 @@ from mock import Mock
 from mock import patch
 from pika.exceptions import ConnectionClosed
 
+from globomap_loader.loader.loader import GLOBOMAP_RMQ_ERROR_EXCHANGE
 from globomap_loader.loader.loader import UpdateExceptionHandler
 
 
@@ -46,3 +47,19 @@ class TestExceptionHandler(unittest.TestCase):
         rabbit_mq_mock.return_value = rabbit_mq
         rabbit_mq.post_message.side_effect = returns
         return rabbit_mq_mock
+
+    def test_republish_original_body(self):
+        handler = UpdateExceptionHandler.__new__(UpdateExceptionHandler)
+        handler.rabbit_mq = Mock()
+        update = {'collection': 'vip', 'status': 400,
+                  'error_msg': {'errors': 'invalid'}}
+
+        handler.handle_exception('Driver', update, body=b'{"raw": 1}',
+                                 headers={'X-REQUEST-ID': 'a'})
+
+        handler.rabbit_mq.post_message.assert_called_once_with(
+            GLOBOMAP_RMQ_ERROR_EXCHANGE, 'globomap.error.Driver.vip',
+            b'{"raw": 1}',
+            {'X-REQUEST-ID': 'a', 'X-ERROR-STATUS': 400,
+             'X-ERROR-MSG': '{"errors": "invalid"}'},
+            content_type=None)
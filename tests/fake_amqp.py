@@ -0,0 +1,286 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import collections
+import threading
+import time
+
+from mock import patch
+from pika import spec
+from tornado.ioloop import IOLoop
+
+Message = collections.namedtuple(
+    'Message', 'body headers published redelivered')
+
+
+class FakeBroker(object):
+    """
+    In-memory queue served through FakeConnection, a stand-in for
+    pika's TornadoConnection that speaks the same callback protocol:
+    declarations answer through their callbacks, deliveries respect
+    basic_qos and acks (multiple included) settle them as RabbitMQ
+    would. Acking an unknown delivery tag closes the channel with 406,
+    like the real broker.
+
+    Messages can be published from any thread while a consumer runs.
+    on_drained is called on the IOLoop once `expected` messages were
+    published and every one of them was acked or dropped. Timeouts added
+    through the connection, such as the consumer reconnect delay, are
+    multiplied by timeout_scale.
+    """
+
+    def __init__(self, expected=None, on_drained=None, timeout_scale=1.0):
+        self.expected = expected
+        self.on_drained = on_drained
+        self.timeout_scale = timeout_scale
+        self.ioloop = None
+        self.queue = collections.deque()
+        self.published = 0
+        self.delivered = 0
+        self.redelivered = 0
+        self.acked = 0
+        self.nacked = 0
+        self.dropped = 0
+        self.ack_frames = 0
+        self.latencies = []
+        self._channel = None
+        self._lock = threading.Lock()
+        self._drained = False
+
+    def publish(self, body, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self._lock:
+            self.queue.append(Message(body, headers, time.time(), False))
+            self.published += 1
+        if self.ioloop is not None and self._channel is not None:
+            self.ioloop.add_callback(self._channel.schedule_delivery)
+
+    def connect(self, on_open_callback):
+        if self.ioloop is None:
+            self.ioloop = IOLoop(make_current=False)
+        return FakeConnection(self, on_open_callback)
+
+    def settled(self, message, acked):
+        if acked:
+            self.acked += 1
+            self.latencies.append(time.time() - message.published)
+        else:
+            self.dropped += 1
+        self.check_drained()
+
+    def requeue(self, messages):
+        with self._lock:
+            for message in reversed(messages):
+                self.queue.appendleft(message._replace(redelivered=True))
+
+    def check_drained(self):
+        if self._drained or self.expected is None:
+            return
+        done = self.acked + self.dropped
+        if done >= self.expected and not self.queue:
+            self._drained = True
+            if self.on_drained:
+                self.on_drained()
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker, on_open_callback):
+        self.broker = broker
+        self.ioloop = broker.ioloop
+        self.is_open = True
+        self._close_callbacks = []
+        self._channel_number = 0
+        self.ioloop.add_callback(on_open_callback, self)
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.call_later(
+            deadline * self.broker.timeout_scale, callback)
+
+    def remove_timeout(self, timeout_id):
+        self.ioloop.remove_timeout(timeout_id)
+
+    def channel(self, on_open_callback, channel_number=None):
+        self._channel_number += 1
+        channel = FakeChannel(self, self._channel_number)
+        self.broker._channel = channel
+        self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if not self.is_open:
+            return
+        self.is_open = False
+        channel = self.broker._channel
+        if channel is not None and channel.is_open:
+            channel._closed(reply_code, reply_text)
+        for callback in self._close_callbacks:
+            self.ioloop.add_callback(callback, self, reply_code, reply_text)
+
+
+class FakeChannel(object):
+
+    BATCH = 100
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self.prefetch_count = 0
+        self._consumer = None
+        self._consumer_tag = None
+        self._tags = 0
+        self._unacked = collections.OrderedDict()
+        self._close_callbacks = []
+        self._cancel_callbacks = []
+        self._scheduled = False
+
+    def __int__(self):
+        return self.channel_number
+
+    def _reply(self, callback, *args):
+        if callback is not None:
+            self.connection.ioloop.add_callback(callback, *args)
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._cancel_callbacks.append(callback)
+
+    def exchange_declare(self, callback=None, *args, **kwargs):
+        self._reply(callback, None)
+
+    def queue_declare(self, callback=None, *args, **kwargs):
+        self._reply(callback, None)
+
+    def queue_bind(self, callback=None, *args, **kwargs):
+        self._reply(callback, None)
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0,
+                  all_channels=False):
+        self.prefetch_count = prefetch_count
+        self._reply(callback, None)
+        self.schedule_delivery()
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        self._consumer = consumer_callback
+        self._consumer_tag = consumer_tag or 'ctag{}.{}'.format(
+            self.channel_number, self._tags)
+        self.schedule_delivery()
+        return self._consumer_tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        self._consumer = None
+        self._consumer_tag = None
+        if not nowait:
+            self._reply(callback, None)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.broker.ack_frames += 1
+        for message in self._settle(delivery_tag, multiple):
+            self.broker.settled(message, True)
+        self.schedule_delivery()
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        messages = self._settle(delivery_tag, multiple)
+        self.broker.nacked += len(messages)
+        if requeue:
+            self.broker.requeue(messages)
+        else:
+            for message in messages:
+                self.broker.settled(message, False)
+        self.schedule_delivery()
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def _settle(self, delivery_tag, multiple):
+        if not self.is_open:
+            return []
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        if not tags or tags[-1] not in self._unacked:
+            self._closed(406, 'PRECONDITION_FAILED - unknown delivery tag '
+                              '{}'.format(delivery_tag))
+            return []
+        return [self._unacked.pop(tag) for tag in tags]
+
+    def schedule_delivery(self):
+        if not self._scheduled and self.is_open:
+            self._scheduled = True
+            self.connection.ioloop.add_callback(self._deliver)
+
+    def _deliver(self):
+        self._scheduled = False
+        for _ in range(self.BATCH):
+            if not self.is_open or self._consumer is None:
+                return
+            if self.prefetch_count and \
+                    len(self._unacked) >= self.prefetch_count:
+                return
+            with self.broker._lock:
+                if not self.broker.queue:
+                    return
+                message = self.broker.queue.popleft()
+            self._tags += 1
+            self._unacked[self._tags] = message
+            self.broker.delivered += 1
+            if message.redelivered:
+                self.broker.redelivered += 1
+            method = spec.Basic.Deliver(
+                self._consumer_tag, self._tags, message.redelivered)
+            properties = spec.BasicProperties(headers=message.headers)
+            self._consumer(self, method, properties, message.body)
+        self.schedule_delivery()
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self._closed(reply_code, reply_text)
+
+    def _closed(self, reply_code, reply_text):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._consumer = None
+        self.broker.requeue(list(self._unacked.values()))
+        self._unacked.clear()
+        for callback in self._close_callbacks:
+            self._reply(callback, self, reply_code, reply_text)
+
+
+def consume_until_drained(driver, broker, callback, auto_ack=True,
+                          prefetch_count=10):
+    """Runs driver.process_updates against the broker and returns once
+    every expected message was settled and the consumer shut down."""
+    client = driver.rabbitmq
+
+    def drained():
+        client._closing = True
+        client.stop_consuming()
+
+    broker.on_drained = drained
+    with patch.object(client, 'connect',
+                      lambda: broker.connect(client.on_connection_open)):
+        broker.ioloop = broker.ioloop or IOLoop(make_current=False)
+        broker.check_drained()
+        driver.process_updates(callback, auto_ack, prefetch_count)
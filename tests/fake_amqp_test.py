@@ -0,0 +1,91 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from globomap_loader.driver.generic import GenericDriver
+from globomap_loader.loader.globomap import GloboMapClient
+from globomap_loader.loader.loader import DriverWorker
+from tests.fake_amqp import FakeBroker
+from tests.fake_amqp import consume_until_drained
+from tests.fake_api import FakeGloboMapAPI
+
+
+def update(key, name):
+    return json.dumps({
+        'action': 'PATCH', 'type': 'collections', 'collection': 'vip',
+        'key': 'globomap_{}'.format(key),
+        'element': {'id': key, 'name': name, 'provider': 'globomap'}
+    })
+
+
+class TestFakeBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeGloboMapAPI()
+        self.api.start()
+        for setting in ('HOST', 'USER', 'PASSWORD', 'VIRTUAL_HOST'):
+            patch('globomap_loader.driver.generic.GLOBOMAP_RMQ_' + setting,
+                  'fake').start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.api.stop()
+
+    @patch('globomap_loader.driver.generic.ACK_BATCH_SIZE', 50)
+    def test_worker_end_to_end(self):
+        broker = FakeBroker(expected=20)
+        for i in range(20):
+            broker.publish(update(i % 5, 'v{}'.format(i)))
+        worker = DriverWorker(
+            GloboMapClient(self.api.url), GenericDriver(), Mock())
+        callback, auto_ack = worker._setup_pipeline()
+
+        consume_until_drained(worker.driver, broker, callback, auto_ack,
+                              worker._prefetch_count())
+        if worker.retry_scheduler:
+            worker.retry_scheduler.stop()
+
+        self.assertEqual(20, broker.acked)
+        self.assertEqual(0, broker.nacked)
+        self.assertLess(broker.ack_frames, 20)
+        documents = self.api.documents[('collections', 'vip')]
+        self.assertEqual(5, len(documents))
+        self.assertEqual('v19', documents['globomap_4']['name'])
+
+    def test_requeue_unacked_on_channel_close(self):
+        broker = FakeBroker(expected=3, timeout_scale=0)
+        for i in range(3):
+            broker.publish(update(i, 'a'))
+        deliveries = []
+
+        def callback(document, **kwargs):
+            deliveries.append(kwargs['delivery_tag'])
+            if len(deliveries) == 2:
+                driver.rabbitmq._channel.close(320, 'CONNECTION_FORCED')
+            elif len(deliveries) > 2:
+                driver.ack(kwargs['delivery_tag'])
+
+        driver = GenericDriver()
+        driver.rabbitmq.set_ack_coalescing(1, 1)
+        consume_until_drained(driver, broker, callback, auto_ack=False,
+                              prefetch_count=2)
+
+        self.assertEqual(3, broker.acked)
+        self.assertEqual(2, broker.redelivered)
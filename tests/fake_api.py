@@ -0,0 +1,337 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+WRITE_CONFLICT = 1200
+
+ROUTES = (
+    ('auth', re.compile(r'^/v2/auth/$')),
+    ('execute', re.compile(r'^/v2/queries/(?P<key>[^/]+)/execute/$')),
+    ('query', re.compile(r'^/v2/queries/(?:(?P<key>[^/]+)/)?$')),
+    ('clear', re.compile(
+        r'^/v2/(?P<type>[^/]+)/(?P<collection>[^/]+)/clear/$')),
+    ('document', re.compile(
+        r'^/v2/(?P<type>[^/]+)/(?P<collection>[^/]+)/(?P<key>[^/]+)/$')),
+    ('collection', re.compile(
+        r'^/v2/(?P<type>[^/]+)/(?P<collection>[^/]+)/$')),
+)
+
+
+def constant(seconds):
+    return lambda: seconds
+
+
+def uniform(low, high):
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    """Long tailed latency, as seen on a loaded API."""
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+class Fault(object):
+
+    def __init__(self, status, body, times, rate, route):
+        self.status = status
+        self.body = body
+        self.times = times
+        self.rate = rate
+        self.route = route
+
+    def matches(self, route):
+        if self.route is not None and self.route != route:
+            return False
+        if self.times is None:
+            return random.random() < self.rate
+        if self.times <= 0:
+            return False
+        self.times -= 1
+        return True
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeGloboMapAPI(object):
+    """
+    Localhost stand-in for the GloboMap API endpoints used by
+    globomap_api_client: auth, documents, clear and queries.
+
+    Documents are kept in memory. Every request waits for a sample of
+    the latency distribution of its route, may be answered by an
+    injected fault, and is counted by route and status code.
+
+        api = FakeGloboMapAPI(latency=lognormal(0.02, 0.5))
+        api.start()
+        api.fail(503, rate=0.01, route='document')
+        api.write_conflict(times=3)
+        ...
+        api.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None,
+                 token_ttl=3600):
+        self.host = host
+        self.port = port
+        self.token_ttl = token_ttl
+        self.documents = collections.defaultdict(dict)
+        self.queries = {}
+        self.counters = collections.Counter()
+        self._latency = {None: latency or constant(0)}
+        self._faults = []
+        self._tokens = set()
+        self._token_seq = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), self._handler())
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def set_latency(self, distribution, route=None):
+        """Latency in seconds of a route, or of every route by default."""
+        self._latency[route] = distribution
+
+    def fail(self, status, times=None, rate=1.0, route=None, body=None):
+        """Answers the next `times` requests of a route, or a `rate`
+        fraction of them, with the given status."""
+        if body is None:
+            body = {'errors': 'Injected error {}'.format(status)}
+        with self._lock:
+            self._faults.append(Fault(status, body, times, rate, route))
+
+    def write_conflict(self, times=None, rate=1.0, route='document'):
+        """The 400 the API answers when ArangoDB reports a write-write
+        conflict (error 1200), retried by GloboMapClient."""
+        self.fail(400, times, rate, route, {
+            'errors': '[HTTP 409][ERR {}] conflict'.format(WRITE_CONFLICT)})
+
+    def clear_faults(self):
+        with self._lock:
+            self._faults = []
+
+    def revoke_tokens(self):
+        """Makes every issued token answer 401 until a new one is made."""
+        with self._lock:
+            self._tokens.clear()
+
+    def reset(self):
+        with self._lock:
+            self.documents.clear()
+            self.counters.clear()
+            self._faults = []
+
+    def requests(self, route=None, status=None):
+        with self._lock:
+            return sum(count for (r, s), count in self.counters.items()
+                       if route in (None, r) and status in (None, s))
+
+    def _issue_token(self):
+        with self._lock:
+            self._token_seq += 1
+            token = 'fake-token-{}'.format(self._token_seq)
+            self._tokens.add(token)
+        expires_at = datetime.now(timezone.utc) + \
+            timedelta(seconds=self.token_ttl)
+        return {'token': token,
+                'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+
+    def _fault(self, route):
+        with self._lock:
+            for fault in self._faults:
+                if fault.matches(route):
+                    return fault.status, fault.body
+        return None
+
+    def _authorized(self, header):
+        token = (header or '').replace('Token token=', '')
+        with self._lock:
+            return token in self._tokens
+
+    def handle(self, method, path, query, body, authorization):
+        """Returns (status, body) of a request, waiting for its latency."""
+        route, params = self._route(path)
+        delay = self._latency.get(route, self._latency[None])()
+        if delay > 0:
+            time.sleep(delay)
+
+        status, content = self._respond(
+            route, params, method, query, body, authorization)
+        with self._lock:
+            self.counters[(route, status)] += 1
+        return status, content
+
+    def _route(self, path):
+        path = path if path.endswith('/') else path + '/'
+        for route, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                return route, match.groupdict()
+        return None, {}
+
+    def _respond(self, route, params, method, query, body, authorization):
+        if route is None:
+            return 404, {'errors': 'Not found'}
+        fault = self._fault(route)
+        if fault:
+            return fault
+        if route == 'auth':
+            return 200, self._issue_token()
+        if not self._authorized(authorization):
+            return 401, {'errors': 'Invalid token'}
+
+        if route == 'execute':
+            if params['key'] not in self.queries:
+                return 404, {'errors': 'Query not found'}
+            return 200, self.queries[params['key']]
+        if route == 'query':
+            if method == 'POST':
+                self.queries[body.get('name')] = []
+                return 200, {'_key': body.get('name')}
+            return 200, {'queries': list(self.queries)}
+        documents = self.documents[(params['type'], params['collection'])]
+        if route == 'clear':
+            documents.clear()
+            return 200, {}
+        if route == 'collection':
+            if method == 'POST':
+                key = body.get('_key') or '{}_{}'.format(
+                    body.get('provider'), body.get('id'))
+                if key in documents:
+                    return 409, {'errors': 'Document already exists'}
+                documents[key] = body
+                return 200, {'_key': key}
+            return 200, {'documents': list(documents.values())}
+
+        key = params['key']
+        if method == 'GET':
+            if key not in documents:
+                return 404, {'errors': 'Document not found'}
+            return 200, documents[key]
+        if method == 'DELETE':
+            if documents.pop(key, None) is None:
+                return 404, {'errors': 'Document not found'}
+            return 200, {}
+        if method == 'PUT':
+            documents[key] = body
+            return 200, {'_key': key}
+        if method == 'PATCH':
+            if key not in documents:
+                return 404, {'errors': 'Document not found'}
+            documents[key].update(body)
+            return 200, {'_key': key}
+        return 405, {'errors': 'Method not allowed'}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(body) if body else {}
+                except ValueError:
+                    body = {}
+                status, content = api.handle(
+                    self.command, path, query, body,
+                    self.headers.get('Authorization'))
+                payload = json.dumps(content).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _distribution(value):
+    name, _, args = value.partition(':')
+    args = [float(arg) for arg in args.split(',') if arg]
+    return {'constant': constant, 'uniform': uniform,
+            'lognormal': lognormal}[name](*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake GloboMap API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=_distribution, default=None,
+                        help='constant:S, uniform:LOW,HIGH or '
+                             'lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--fail', action='append', default=[],
+                        help='STATUS:RATE, e.g. 503:0.01 or 1200:0.05')
+    args = parser.parse_args()
+
+    api = FakeGloboMapAPI(args.host, args.port, args.latency)
+    for fault in args.fail:
+        status, _, rate = fault.partition(':')
+        if int(status) == WRITE_CONFLICT:
+            api.write_conflict(rate=float(rate))
+        else:
+            api.fail(int(status), rate=float(rate), route='document')
+    print('Fake GloboMap API listening on {}'.format(api.start()))
+    try:
+        while True:
+            time.sleep(60)
+            print(dict(api.counters))
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
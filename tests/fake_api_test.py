@@ -0,0 +1,77 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from globomap_loader.loader.globomap import GloboMapClient
+from globomap_loader.loader.globomap import GloboMapRetry
+from tests.fake_api import FakeGloboMapAPI
+
+
+class TestFakeGloboMapAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeGloboMapAPI()
+        self.api.start()
+        self.client = GloboMapClient(self.api.url)
+        self.client.retry_inline = False
+
+    def tearDown(self):
+        self.api.stop()
+
+    def _patch(self, key, **element):
+        element.update({'id': key, 'provider': 'p'})
+        return self.client.update_element_state(
+            'PATCH', 'collections', 'vip', element, 'p_' + key)
+
+    def test_patch_creates_missing_document(self):
+        self._patch('1', name='a')
+        self._patch('1', name='b')
+
+        self.assertEqual(
+            'b', self.api.documents[('collections', 'vip')]['p_1']['name'])
+        self.assertEqual(1, self.api.requests('document', 404))
+        self.assertEqual(1, self.api.requests('collection', 200))
+        self.assertEqual(1, self.api.requests('document', 200))
+
+    def test_renew_token_on_unauthorized(self):
+        self.api.revoke_tokens()
+
+        self._patch('1')
+
+        self.assertEqual(1, self.api.requests('document', 401))
+        self.assertEqual(2, self.api.requests('auth', 200))
+
+    def test_write_conflict_is_retried_later(self):
+        self.api.write_conflict(times=1)
+
+        with self.assertRaises(GloboMapRetry):
+            self._patch('1')
+        self._patch('1')
+
+        self.assertEqual(1, self.api.requests('document', 400))
+
+    def test_server_error_is_retried_later(self):
+        self.api.fail(503, times=11, route='document')
+
+        with self.assertRaises(GloboMapRetry):
+            self._patch('1')
+
+    def test_clear_collection(self):
+        self._patch('1')
+        self.client.update_element_state(
+            'CLEAR', 'collections', 'vip', [[]], None)
+
+        self.assertEqual({}, self.api.documents[('collections', 'vip')])
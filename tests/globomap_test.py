@@ -13,23 +13,113 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import os
 import unittest
 
+from globomap_api_client import exceptions
+from mock import Mock
 from mock import patch
 
 from globomap_loader.loader.globomap import GloboMapClient
+from globomap_loader.loader.globomap import GloboMapRetry
 
 
 class TestGloboMapCllient(unittest.TestCase):
 
     def setUp(self):
         patch('globomap_loader.loader.globomap.Session').start()
+        self.auth_mock = patch('globomap_loader.loader.globomap.auth').start()
+        patch('globomap_loader.loader.globomap.Document').start()
+        patch('globomap_loader.loader.globomap.Query').start()
         self.globomap_client = GloboMapClient('http://localhost:8080')
 
     @classmethod
     def tearDownClass(cls):
         patch.stopall()
 
+    def test_api_objects_share_pooled_session(self):
+        session = self.globomap_client.session
+
+        self.assertIs(session, self.globomap_client.auth.session)
+        self.assertIs(session, self.globomap_client.doc.session)
+        self.assertIs(session, self.globomap_client.query.session)
+        session.mount.assert_any_call(
+            'http://', self.globomap_client.adapter)
+
+    def test_generate_auth_renews_token_only(self):
+        auth = self.globomap_client.auth
+        doc = self.globomap_client.doc
+
+        self.globomap_client.generate_auth()
+
+        auth.generate_token.assert_called_once_with()
+        self.assertIs(doc, self.globomap_client.doc)
+        self.assertEqual(1, self.auth_mock.Auth.call_count)
+
+    def test_unauthorized_renews_token_without_sleeping(self):
+        doc = self.globomap_client.doc
+        doc.delete.side_effect = [exceptions.Unauthorized('expired', 401),
+                                  None]
+        self.globomap_client.tokens = Mock()
+
+        with patch('globomap_loader.loader.globomap.time.sleep') as sleep:
+            self.globomap_client.update_element_state(
+                'DELETE', 'collections', 'vip', None, 'key')
+
+        sleep.assert_not_called()
+        self.assertEqual(2, doc.delete.call_count)
+        self.globomap_client.tokens.unauthorized.assert_called_once_with(
+            self.globomap_client.tokens.ensure_fresh.return_value)
+
+    @patch('globomap_loader.loader.globomap.BREAKER_FAILURE_THRESHOLD', 2)
+    def test_open_circuit_fails_fast(self):
+        self.globomap_client._pid = -1
+        self.globomap_client.retry_inline = False
+        self.globomap_client._ensure_session()
+        doc = self.globomap_client.doc
+        doc.delete.side_effect = exceptions.ApiError('unavailable', 503)
+
+        for _ in range(3):
+            with self.assertRaises(GloboMapRetry):
+                self.globomap_client.update_element_state(
+                    'DELETE', 'collections', 'vip', None, 'key')
+
+        self.assertEqual(2, doc.delete.call_count)
+        self.assertEqual(1, self.globomap_client.breaker_stats()['open'])
+
+    def test_throttle_all_calls_on_too_many_requests(self):
+        self.globomap_client.governor = Mock()
+
+        self.globomap_client._on_response(
+            Mock(status_code=429, headers={'Retry-After': '5'}))
+        self.globomap_client._on_response(
+            Mock(status_code=503, headers={}))
+
+        self.globomap_client.governor.throttle.assert_called_once_with(5)
+        self.globomap_client.session.hooks['response'].append \
+            .assert_called_with(self.globomap_client._on_response)
+
+    def test_new_pool_in_other_process(self):
+        adapter = self.globomap_client.adapter
+        self.globomap_client._pid = -1
+
+        self.globomap_client.update_element_state(
+            'DELETE', 'collections', 'vip', None, 'key')
+
+        self.assertIsNot(adapter, self.globomap_client.adapter)
+        self.assertEqual(os.getpid(), self.globomap_client._pid)
+        self.assertEqual(2, self.auth_mock.Auth.call_count)
+        self.globomap_client.doc.delete.assert_called_once_with(
+            'collections', 'vip', 'key')
+
+    def test_pickle_drops_pool(self):
+        state = self.globomap_client.__getstate__()
+
+        self.assertIsNone(state['_pid'])
+        for attr in ('session', 'adapter', 'auth', 'doc', 'query'):
+            self.assertNotIn(attr, state)
+        self.assertEqual('http://localhost:8080', state['host'])
+
     # def test_create_element(self):
     #     requests_mock = self._mock_request([200])
 
@@ -0,0 +1,172 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from globomap_loader.loader.governor import api_governor
+from globomap_loader.loader.governor import ApiGovernor
+from globomap_loader.loader.governor import parse_rates
+from globomap_loader.loader.governor import retry_after
+from globomap_loader.loader.governor import SharedApiGovernor
+from globomap_loader.loader.governor import TokenBucket
+
+
+def hold_slot(path, taken, release):
+    governor = SharedApiGovernor(path, concurrency=1)
+    with governor.call('UPDATE', 'vip'):
+        taken.set()
+        release.wait(5)
+
+
+class TestApiGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.time_mock = patch('globomap_loader.loader.governor.time').start()
+        self.time_mock.time.return_value = 100
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_parse(self):
+        self.assertEqual({'CREATE': 5.0, '*': 20.0},
+                         parse_rates('CREATE:5, *:20,'))
+        self.assertEqual(3, retry_after('3'))
+        self.time_mock.time.return_value = 1445412470
+        self.assertEqual(10, retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertIsNone(retry_after(None))
+
+    def _sleeps(self):
+        return [c[0][0] for c in self.time_mock.sleep.call_args_list]
+
+    def test_waits_for_the_tightest_bucket(self):
+        governor = ApiGovernor(10, {'DELETE': 2}, {'*': 3})
+
+        for _ in range(3):
+            with governor.call('DELETE', 'vip'):
+                pass
+        with governor.call('UPDATE', 'vip'):
+            pass
+
+        self.assertEqual(0.5, self._sleeps()[0])
+        self.assertAlmostEqual(1 / 3, self._sleeps()[1])
+        self.assertEqual(4, governor.stats()['calls'])
+
+    def test_throttle_pauses_and_halves_rates(self):
+        governor = ApiGovernor(4)
+
+        governor.throttle(2)
+        governor.throttle(2)
+        with governor.call('UPDATE', 'vip'):
+            pass
+
+        self.assertEqual([2], self._sleeps())
+        stats = governor.stats()
+        self.assertEqual(0.5, stats['rate_scale'])
+        self.assertEqual(2, stats['throttled'])
+
+        self.time_mock.time.return_value = 120
+        self.assertEqual(1, governor.stats()['rate_scale'])
+
+    def test_no_limits(self):
+        governor = ApiGovernor()
+
+        for _ in range(100):
+            with governor.call('UPDATE', 'vip'):
+                pass
+
+        self.time_mock.sleep.assert_not_called()
+
+    def test_no_governor_without_limits(self):
+        self.assertIsNone(api_governor(0, {}, {}, 0, '/tmp/governor'))
+        self.assertIsInstance(api_governor(0, {'*': 5}), ApiGovernor)
+
+
+class TestSharedApiGovernor(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'governor')
+
+    def test_buckets_and_throttle_are_shared(self):
+        first = SharedApiGovernor(self.path, 1)
+        second = SharedApiGovernor(self.path, 1)
+
+        with patch('globomap_loader.loader.governor.time') as time_mock:
+            time_mock.time.return_value = 100
+            with first.call('UPDATE', 'vip'):
+                pass
+            second.throttle(3)
+            with second.call('UPDATE', 'vip'):
+                pass
+            self.assertEqual(0.5, first.stats()['rate_scale'])
+
+        time_mock.sleep.assert_called_once_with(3)
+
+    def test_slots_are_shared_by_processes(self):
+        context = multiprocessing.get_context('fork')
+        taken, release = context.Event(), context.Event()
+        child = context.Process(
+            target=hold_slot, args=(self.path, taken, release))
+        child.start()
+        self.addCleanup(child.join, 5)
+        self.addCleanup(release.set)
+        self.assertTrue(taken.wait(5))
+        governor = SharedApiGovernor(self.path, concurrency=1)
+        called = threading.Event()
+
+        def call():
+            with governor.call('UPDATE', 'vip'):
+                called.set()
+        thread = threading.Thread(target=call)
+        thread.start()
+
+        self.assertFalse(called.wait(0.2))
+        release.set()
+        self.assertTrue(called.wait(5))
+        thread.join(5)
+        self.assertEqual(set(), governor._held)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @patch('globomap_loader.loader.governor.time')
+    def test_bursts_then_spreads_calls(self, time_mock):
+        time_mock.time.return_value = 100
+        bucket = TokenBucket(2, burst=2)
+
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertEqual(0.5, bucket.acquire())
+        self.assertEqual(1, bucket.acquire())
+        time_mock.sleep.assert_called_with(1)
+
+        time_mock.time.return_value = 102
+        self.assertTrue(bucket.try_acquire())
+
+    def test_no_limit(self):
+        self.assertEqual(0, TokenBucket(0).acquire(100))
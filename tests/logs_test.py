@@ -0,0 +1,114 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import copy
+import logging
+import logging.config
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from globomap_loader.logs import MessageSummary
+from globomap_loader.logs import SampledLogger
+from globomap_loader.settings import LOGGING
+
+
+class TestSampledLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = Mock()
+        self.logger.isEnabledFor.side_effect = \
+            lambda level: level >= logging.INFO
+
+    def test_samples_info_and_renders_payload_only_when_written(self):
+        sampled = SampledLogger(self.logger, 0.5)
+        payload = Mock()
+
+        with patch('globomap_loader.logs.random.random',
+                   side_effect=[0.9, 0.1]):
+            sampled.log(logging.INFO, 'Received %s', 1, payload=payload)
+            sampled.log(logging.INFO, 'Received %s', 2, payload=payload)
+
+        self.logger.log.assert_called_once_with(
+            logging.INFO, 'Received %s payload=%s', 2, payload)
+        self.assertEqual(1, sampled.suppressed)
+        sampled.log(logging.DEBUG, 'Skipped')
+        self.assertEqual(1, self.logger.log.call_count)
+
+    def test_rate_limits_every_level(self):
+        sampled = SampledLogger(self.logger, 0.01, per_second=2)
+
+        for _ in range(5):
+            sampled.log(logging.ERROR, 'Failed')
+
+        self.assertEqual(2, self.logger.log.call_count)
+        self.assertEqual(3, sampled.suppressed)
+
+    def test_bypass_writes_everything(self):
+        sampled = SampledLogger(self.logger, 0, per_second=1, bypass=True)
+
+        for _ in range(3):
+            sampled.log(logging.INFO, 'Received', payload={})
+        sampled.log(logging.DEBUG, 'Skipped')
+
+        self.assertEqual(3, self.logger.log.call_count)
+
+    def test_samples_with_default_logging_config(self):
+        config = copy.deepcopy(LOGGING)
+        config['handlers'] = {'default': {
+            'class': 'logging.handlers.BufferingHandler', 'capacity': 10000}}
+        config['loggers']['globomap_loader']['handlers'] = ['default']
+        logger = logging.getLogger('globomap_loader')
+        saved = logger.level, logger.handlers[:], logger.propagate
+        self.addCleanup(self._restore, logger, *saved)
+        logging.config.dictConfig(config)
+        sampled = SampledLogger(
+            logging.getLogger('globomap_loader.driver.consumer'), 0.01)
+
+        with patch('globomap_loader.logs.random.random',
+                   side_effect=[index / 1000.0 for index in range(1000)]):
+            for index in range(1000):
+                sampled.log(logging.INFO, 'Received %s', index, payload={})
+
+        self.assertEqual(10, len(logger.handlers[0].buffer))
+        self.assertEqual(990, sampled.suppressed)
+
+    def _restore(self, logger, level, handlers, propagate):
+        logger.setLevel(level)
+        logger.handlers = handlers
+        logger.propagate = propagate
+
+
+class TestMessageSummary(unittest.TestCase):
+
+    @patch('globomap_loader.logs.time')
+    def test_summary_every_interval(self, time_mock):
+        logger = Mock()
+        sampled = SampledLogger(logger)
+        sampled.suppressed = 7
+        time_mock.time.return_value = 0
+        summary = MessageSummary(logger, 60, sampled)
+
+        summary.record('acked', 0.1)
+        summary.record('rejected', 0.3)
+        logger.info.assert_not_called()
+        time_mock.time.return_value = 60
+        summary.record('acked', 0.2)
+
+        args = logger.info.call_args[0]
+        self.assertEqual(
+            (60, 'acked=2 rejected=1', 0.2, 0.3, 0.3, 7), args[1:])
+        self.assertEqual(0, sampled.suppressed)
@@ -0,0 +1,125 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import unittest
+
+from mock import MagicMock
+from mock import Mock
+from prometheus_client import CollectorRegistry
+from prometheus_client import Gauge
+from prometheus_client import REGISTRY
+
+from globomap_loader import metrics
+from globomap_loader.driver.consumer import RabbitMQClient
+from globomap_loader.loader.globomap import GloboMapClient
+from globomap_loader.loader.globomap import GloboMapRetry
+from globomap_loader.loader.loader import UpdateExceptionHandler
+from tests.fake_api import FakeGloboMapAPI
+
+
+# Multiprocess modes accepted by the pinned prometheus_client==0.3.1
+PINNED_GAUGE_MODES = ('min', 'max', 'livesum', 'liveall', 'all')
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_gauges_use_modes_of_pinned_client(self):
+        gauges = [value for value in vars(metrics).values()
+                  if isinstance(value, Gauge)]
+        self.assertIn(metrics.BREAKER_STATE, gauges)
+
+        for gauge in gauges:
+            mode = gauge._multiprocess_mode
+            self.assertIn(mode, PINNED_GAUGE_MODES, gauge._name)
+            Gauge(gauge._name, gauge._documentation, gauge._labelnames,
+                  registry=CollectorRegistry(), multiprocess_mode=mode)
+
+    def test_export_component_stats(self):
+        metrics.register_stats('dispatcher', lambda: {
+            'depths': [1, 2], 'paused': True, 'dispatched': 7,
+            'last_decision': 'increase'})
+
+        metrics.export_stats()
+
+        self.assertEqual(3, sample('globomap_loader_component_stat',
+                                   component='dispatcher', stat='depths'))
+        self.assertEqual(1, sample('globomap_loader_component_stat',
+                                   component='dispatcher', stat='paused'))
+        self.assertEqual(7, sample('globomap_loader_component_stat',
+                                   component='dispatcher', stat='dispatched'))
+        self.assertIsNone(REGISTRY.get_sample_value(
+            'globomap_loader_component_stat',
+            {'component': 'dispatcher', 'stat': 'last_decision'}))
+
+    def test_count_consumed_and_acked_messages(self):
+        consumed = sample('globomap_loader_messages_consumed_total')
+        acked = sample('globomap_loader_messages_acked_total')
+        consumer = RabbitMQClient('localhost', 5672, 'user', 'password', '/')
+        consumer._channel = MagicMock()
+        consumer.set_settings('exchange', 'queue', ['key'], Mock())
+
+        consumer.on_message(consumer._channel, Mock(delivery_tag=1),
+                            Mock(headers=None, content_type=None),
+                            json.dumps({}))
+
+        self.assertEqual(
+            consumed + 1, sample('globomap_loader_messages_consumed_total'))
+        self.assertEqual(
+            acked + 1, sample('globomap_loader_messages_acked_total'))
+        self.assertEqual(0, sample('globomap_loader_messages_in_flight'))
+
+    def test_count_error_publishes(self):
+        handler = UpdateExceptionHandler.__new__(UpdateExceptionHandler)
+        handler.rabbit_mq = Mock()
+        handler.rabbit_mq.post_message.side_effect = [True, False]
+        published = sample('globomap_loader_error_publishes_total',
+                           result='published')
+        dropped = sample('globomap_loader_error_publishes_total',
+                         result='dropped')
+
+        handler.handle_exception('Driver', {'collection': 'vip'})
+        handler.handle_exception('Driver', {'collection': 'vip'})
+
+        self.assertEqual(published + 1, sample(
+            'globomap_loader_error_publishes_total', result='published'))
+        self.assertEqual(dropped + 1, sample(
+            'globomap_loader_error_publishes_total', result='dropped'))
+
+    def test_api_latency_and_retries(self):
+        api = FakeGloboMapAPI()
+        api.start()
+        self.addCleanup(api.stop)
+        client = GloboMapClient(api.url)
+        client.retry_inline = False
+        api.write_conflict(times=1)
+        requests = sample('globomap_loader_api_request_seconds_count',
+                          action='DELETE', collection='metrics')
+        retries = sample('globomap_loader_retries_total',
+                         reason='ValidationError')
+
+        with self.assertRaises(GloboMapRetry):
+            client.update_element_state(
+                'DELETE', 'collections', 'metrics', None, 'p_1')
+
+        self.assertEqual(requests + 1, sample(
+            'globomap_loader_api_request_seconds_count',
+            action='DELETE', collection='metrics'))
+        self.assertEqual(retries + 1, sample(
+            'globomap_loader_retries_total', reason='ValidationError'))
@@ -0,0 +1,93 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+from requests import Session
+from requests.exceptions import ReadTimeout
+
+from globomap_loader.loader.pool import PooledAdapter
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _session(self, adapter):
+        session = Session()
+        session.mount('http://', adapter)
+        return session
+
+    def test_reuse_connection(self):
+        adapter = PooledAdapter(2, 60)
+        session = self._session(adapter)
+        for _ in range(3):
+            session.get(self.url)
+
+        self.assertEqual({
+            'requests': 3, 'hits': 2, 'new_connections': 1,
+            'idle_evictions': 0
+        }, adapter.stats())
+
+    def test_default_timeout(self):
+        session = self._session(PooledAdapter(2, 60, timeout=0.1))
+
+        with self.assertRaises(ReadTimeout):
+            session.get(self.url + 'slow')
+        session.get(self.url, timeout=5)
+
+    def test_evict_idle_connections(self):
+        adapter = PooledAdapter(2, -1)
+        session = self._session(adapter)
+        for _ in range(2):
+            session.get(self.url)
+
+        self.assertEqual({
+            'requests': 2, 'hits': 0, 'new_connections': 2,
+            'idle_evictions': 1
+        }, adapter.stats())
@@ -0,0 +1,71 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import unittest
+
+from mock import Mock
+
+from globomap_loader.driver.qos import PrefetchController
+
+
+class TestPrefetchController(unittest.TestCase):
+
+    def _controller(self, in_flight=0, initial=20):
+        self.apply = Mock()
+        return PrefetchController(
+            initial, 2, 30, 5, 10, 1, 0.1, self.apply, lambda: in_flight)
+
+    def test_increase_when_window_is_full(self):
+        controller = self._controller(in_flight=20)
+        controller.record(0.1)
+
+        self.assertEqual(25, controller.adjust())
+        self.apply.assert_called_once_with(25)
+        self.assertEqual('increase', controller.last_decision)
+
+    def test_increase_up_to_maximum(self):
+        controller = self._controller(in_flight=30, initial=28)
+        controller.record(0.1)
+        controller.adjust()
+        controller.record(0.1)
+
+        self.assertEqual(30, controller.adjust())
+        self.assertEqual(1, controller.stats()['increases'])
+        self.assertEqual('hold', controller.last_decision)
+
+    def test_halve_on_errors(self):
+        controller = self._controller(in_flight=20)
+        controller.record(0.1)
+        controller.record(0.1, error=True)
+
+        self.assertEqual(10, controller.adjust())
+        self.apply.assert_called_once_with(10)
+
+    def test_halve_on_slow_api(self):
+        controller = self._controller(in_flight=20)
+        controller.record(3)
+
+        self.assertEqual(10, controller.adjust())
+        self.assertEqual(
+            {'prefetch': 10, 'increases': 0, 'decreases': 1,
+             'last_decision': 'decrease'},
+            controller.stats()
+        )
+
+    def test_hold_without_traffic(self):
+        controller = self._controller(in_flight=0)
+
+        self.assertEqual(20, controller.adjust())
+        self.apply.assert_not_called()
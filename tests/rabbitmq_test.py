@@ -13,11 +13,21 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import MagicMock
+from mock import Mock
 from mock import patch
+from pika import spec
+from pika.exceptions import ConnectionClosed
 
+from globomap_loader.rabbitmq import BufferedPublisher
+from globomap_loader.rabbitmq import ConfirmedPublisher
+from globomap_loader.rabbitmq import MessageSpool
 from globomap_loader.rabbitmq import RabbitMQClient
 
 
@@ -57,7 +67,17 @@ class TestRabbitMQClient(unittest.TestCase):
             mandatory=True
         )
         pika_mock.BasicProperties.assert_any_call(
-            delivery_mode=2, headers={'x-header': 123})
+            delivery_mode=2, headers={'x-header': 123}, content_type=None)
+
+    def test_queue_stats_declares_passively(self):
+        _, channel_mock = self._mock_pika(None)
+        channel_mock.queue_declare.return_value.method = Mock(
+            message_count=42, consumer_count=3)
+        rabbitmq = RabbitMQClient('localhost', 5672, 'user', 'password', '/')
+
+        self.assertEqual((42, 3), rabbitmq.queue_stats('updates'))
+        channel_mock.queue_declare.assert_called_once_with(
+            queue='updates', passive=True)
 
     def _mock_pika(self, message):
         pika_mock = patch('globomap_loader.rabbitmq.pika').start()
@@ -71,3 +91,191 @@ class TestRabbitMQClient(unittest.TestCase):
         pika_mock.BlockingConnection.return_value = connection_mock
 
         return pika_mock, channel_mock
+
+
+class TestConfirmedPublisher(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(ConfirmedPublisher, 'start').start()
+        self.publisher = ConfirmedPublisher(
+            'localhost', 5672, 'user', 'password', '/',
+            buffer_size=3, max_unconfirmed=2)
+        self.publisher._connection = MagicMock()
+        self.channel = MagicMock()
+        self.channel.is_open = True
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _post(self, count):
+        for i in range(count):
+            self.publisher.post_message('exchange', 'key', str(i), None)
+
+    def _confirm(self, method):
+        self.publisher._on_confirm(Mock(method=method))
+
+    def test_confirm_mode_once_per_channel(self):
+        self.publisher._on_channel_open(self.channel)
+
+        self.channel.confirm_delivery.assert_called_once_with(
+            self.publisher._on_confirm)
+        self.channel.tx_select.assert_not_called()
+
+    def test_cap_unconfirmed_publishes(self):
+        self._post(3)
+        self.publisher._on_channel_open(self.channel)
+        self.assertEqual(2, self.channel.basic_publish.call_count)
+
+        self._confirm(spec.Basic.Ack(delivery_tag=2, multiple=True))
+
+        self.assertEqual(3, self.channel.basic_publish.call_count)
+        self.assertEqual(2, self.publisher.stats()['confirmed'])
+        self.assertEqual(1, self.publisher.stats()['unconfirmed'])
+
+    def test_publish_nacked_message_again(self):
+        self.publisher._on_channel_open(self.channel)
+        self._post(1)
+        self.publisher._drain()
+
+        self._confirm(spec.Basic.Nack(delivery_tag=1))
+
+        self.assertEqual(2, self.channel.basic_publish.call_count)
+        self.assertEqual(1, self.publisher.stats()['nacked'])
+
+    def test_drop_when_buffer_is_full(self):
+        self._post(3)
+
+        self.assertFalse(
+            self.publisher.post_message('exchange', 'key', 'x', None))
+        self.assertEqual(1, self.publisher.stats()['dropped'])
+
+    def test_requeue_unconfirmed_on_channel_close(self):
+        self.publisher._on_channel_open(self.channel)
+        self._post(2)
+        self.publisher._drain()
+
+        self.publisher._on_channel_closed(1, 406, 'error')
+
+        self.assertEqual(2, self.publisher.stats()['buffered'])
+        self.assertEqual(0, self.publisher.stats()['unconfirmed'])
+        self.assertTrue(self.publisher.flush(0) is False)
+
+
+class TestBufferedPublisher(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(BufferedPublisher, 'start').start()
+        self.client = MagicMock()
+        self.client_class = patch(
+            'globomap_loader.rabbitmq.RabbitMQClient',
+            return_value=self.client).start()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = MessageSpool(os.path.join(directory, 'errors.spool'))
+        self.publisher = BufferedPublisher(
+            'localhost', 5672, 'user', 'password', '/', batch_size=3,
+            max_wait=60, spool=self.spool)
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _post(self, *keys):
+        for i, key in enumerate(keys):
+            self.publisher.post_message('exchange', key, str(i), None)
+
+    def test_flush_when_batch_is_full(self):
+        self._post('a', 'b')
+        self.assertFalse(self.publisher._due())
+
+        self._post('a')
+        self.assertTrue(self.publisher._due())
+
+    def test_one_transaction_per_routing_key(self):
+        self._post('a', 'b', 'a')
+
+        self.publisher._flush(self.publisher._buffer)
+
+        keys = [c[0][1] for c in self.client.post_message.call_args_list]
+        self.assertEqual(['a', 'a', 'b'], keys)
+        self.assertEqual(2, self.client.channel.tx_commit.call_count)
+        self.assertEqual(3, self.publisher.stats()['published'])
+
+    def test_spool_when_broker_is_unreachable_and_replay(self):
+        self.client_class.side_effect = [ConnectionClosed(), self.client]
+        self._post('a', 'b')
+
+        self.publisher._flush(self.publisher._buffer)
+
+        self.assertEqual(2, self.publisher.stats()['spooled'])
+        self.assertTrue(self.publisher._replay_due())
+
+        self.publisher._retry_at = 0
+        self.publisher._flush([])
+
+        self.assertEqual(2, self.publisher.stats()['replayed'])
+        self.assertEqual(0, self.spool.size())
+        self.assertEqual(['0', '1'], [
+            c[0][2] for c in self.client.post_message.call_args_list])
+
+    def test_spool_groups_not_committed(self):
+        self.client.channel.tx_commit.side_effect = [None, ConnectionClosed()]
+        self._post('a', 'b', 'c')
+
+        self.publisher._flush(self.publisher._buffer)
+
+        self.assertEqual(1, self.publisher.stats()['published'])
+        self.assertEqual(2, self.publisher.stats()['spooled'])
+
+    def test_stop_spools_buffer(self):
+        self._post('a')
+
+        self.publisher.stop(0)
+
+        replayed = []
+        self.spool.replay(replayed.extend, 10)
+        self.assertEqual([('exchange', 'a', '0', None, None)], replayed)
+
+
+class TestMessageSpool(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = MessageSpool(os.path.join(directory, 'errors.spool'))
+
+    def test_keep_messages_not_replayed(self):
+        messages = [('exchange', str(i), b'\x00%d' % i,
+                     {'X-ERROR-STATUS': 500}, None) for i in range(5)]
+        self.spool.append(messages)
+        chunks = []
+
+        def publish(chunk):
+            if len(chunks) == 1:
+                raise ConnectionClosed()
+            chunks.append(chunk)
+
+        with self.assertRaises(ConnectionClosed):
+            self.spool.replay(publish, 2)
+        self.assertEqual(3, self.spool.replay(chunks.append, 2))
+        self.assertEqual([messages[:2], messages[2:4], messages[4:]], chunks)
+        self.assertEqual(0, self.spool.size())
+
+    def test_records_are_json(self):
+        self.spool.append([('exchange', 'key', 'body', None, 'text/plain')])
+
+        with open(self.spool.path, 'rb') as spool:
+            record = json.loads(spool.read()[MessageSpool.RECORD.size:])
+        self.assertEqual('body', record['body'])
+
+    def test_writers_are_not_blocked_while_replaying(self):
+        self.spool.append([('exchange', 'a', 'a', None, None)])
+        published = []
+
+        def publish(chunk):
+            self.spool.append([('exchange', 'b', 'b', None, None)])
+            published.extend(chunk)
+
+        self.assertEqual(1, self.spool.replay(publish, 10))
+        self.assertEqual([('exchange', 'a', 'a', None, None)], published)
+        self.spool.replay(published.extend, 10)
+        self.assertEqual('b', published[1][1])
@@ -0,0 +1,122 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import json
+import unittest
+
+from mock import Mock
+
+from globomap_loader.loader.globomap import GloboMapException
+from globomap_loader.loader.globomap import GloboMapRetry
+from globomap_loader.loader.replay import ErrorReplayer
+
+
+def delivery(tag, update, driver='Napi', headers=None):
+    method = Mock(delivery_tag=tag,
+                  routing_key='globomap.error.{}.vip'.format(driver))
+    properties = Mock(headers=headers, content_type=None)
+    return method, properties, json.dumps(update).encode()
+
+
+class TestErrorReplayer(unittest.TestCase):
+
+    def setUp(self):
+        self.rabbit_mq = Mock()
+        self.client = Mock()
+
+    def _replayer(self, deliveries, **kwargs):
+        self.rabbit_mq.queue_stats.return_value = (len(deliveries), 0)
+        self.rabbit_mq.get_delivery.side_effect = deliveries
+        return ErrorReplayer(self.rabbit_mq, self.client, 'errors', rate=0,
+                             **kwargs)
+
+    def test_strips_error_fields_and_acks_replayed(self):
+        update = {'action': 'UPDATE', 'type': 'collections',
+                  'collection': 'vip', 'key': 'vip_1', 'element': {'a': 1},
+                  'status': 503, 'error_msg': 'unavailable'}
+
+        stats = self._replayer([delivery(1, update)]).run()
+
+        self.client.update_element_state.assert_called_once_with(
+            'UPDATE', 'collections', 'vip', {'a': 1}, 'vip_1')
+        self.rabbit_mq.ack_message.assert_called_once_with(1)
+        self.rabbit_mq.nack_message.assert_not_called()
+        self.assertEqual(1, stats['replayed'])
+
+    def test_filters_and_requeues_the_rest(self):
+        update = {'action': 'PATCH', 'type': 'collections',
+                  'collection': 'vip', 'key': 'vip_1'}
+        deliveries = [
+            delivery(1, update, headers={'X-ERROR-STATUS': 503}),
+            delivery(2, update, headers={'X-ERROR-STATUS': 400}),
+            delivery(3, update, driver='Other',
+                     headers={'X-ERROR-STATUS': 503}),
+            delivery(4, dict(update, status=503)),
+        ]
+
+        stats = self._replayer(
+            deliveries, drivers=['Napi'], statuses=[503]).run()
+
+        self.assertEqual(2, self.client.update_element_state.call_count)
+        self.assertEqual(
+            [1, 4],
+            sorted(c[0][0] for c in self.rabbit_mq.ack_message.call_args_list))
+        self.assertEqual(
+            [2, 3],
+            sorted(c[0][0] for c in
+                   self.rabbit_mq.nack_message.call_args_list))
+        self.assertEqual(2, stats['skipped'])
+
+    def test_requeues_updates_failing_again(self):
+        self.client.update_element_state.side_effect = \
+            GloboMapException('unavailable', 503)
+        update = {'action': 'DELETE', 'type': 'collections',
+                  'collection': 'vip', 'key': 'vip_1'}
+
+        stats = self._replayer([delivery(1, update)]).run()
+
+        self.rabbit_mq.ack_message.assert_not_called()
+        self.rabbit_mq.nack_message.assert_called_once_with(1)
+        self.assertEqual(1, stats['failed'])
+
+    def test_transient_failures_are_requeued_without_inline_retries(self):
+        self.client.update_element_state.side_effect = \
+            GloboMapRetry('unavailable', 503)
+        update = {'action': 'DELETE', 'type': 'collections',
+                  'collection': 'vip', 'key': 'vip_1'}
+
+        stats = self._replayer([delivery(1, update)]).run()
+
+        self.assertFalse(self.client.retry_inline)
+        self.client.update_element_state.assert_called_once_with(
+            'DELETE', 'collections', 'vip', None, 'vip_1')
+        self.rabbit_mq.nack_message.assert_called_once_with(1)
+        self.assertEqual(1, stats['failed'])
+
+    def test_reads_only_messages_queued_at_start(self):
+        self.rabbit_mq.queue_stats.return_value = (1, 0)
+        self.rabbit_mq.get_delivery.side_effect = [
+            delivery(1, {'action': 'DELETE', 'type': 'collections',
+                         'collection': 'vip', 'key': 'vip_1'}),
+            AssertionError('read past the initial depth'),
+        ]
+
+        ErrorReplayer(self.rabbit_mq, self.client, 'errors', rate=0).run()
+
+        self.assertEqual(1, self.rabbit_mq.get_delivery.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
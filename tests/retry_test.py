@@ -0,0 +1,96 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import unittest
+
+from globomap_loader.loader.retry import RetryScheduler
+
+
+def update(action, key):
+    return {'action': action, 'type': 'collections',
+            'collection': 'vip', 'key': key}
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.done = threading.Event()
+
+    def _handler(self, update, kwargs, attempt, first_seen):
+        self.handled.append((update['action'], attempt))
+        if len(self.handled) == self.expected:
+            self.done.set()
+        return False
+
+    def test_backoff_is_exponential_with_jitter(self):
+        scheduler = RetryScheduler(None, 10, 1, 8, 60)
+
+        for attempt, delay in ((1, 1), (2, 2), (3, 4), (4, 8), (10, 8)):
+            backoff = scheduler.backoff(attempt)
+            self.assertGreaterEqual(backoff, delay / 2)
+            self.assertLessEqual(backoff, delay)
+
+    def test_run_retry_when_due(self):
+        self.expected = 1
+        scheduler = RetryScheduler(self._handler, 10, 0.01, 0.01, 60)
+        scheduler.start()
+
+        self.assertTrue(scheduler.schedule(update('PATCH', 'a'), {}, 1))
+        self.assertTrue(self.done.wait(5))
+        scheduler.stop()
+        self.assertEqual([('PATCH', 1)], self.handled)
+        self.assertEqual(0, scheduler.depth())
+
+    def test_reject_past_deadline_or_when_full(self):
+        scheduler = RetryScheduler(self._handler, 1, 1, 100, 30)
+
+        self.assertFalse(scheduler.schedule(update('PATCH', 'a'), {}, 8))
+        self.assertTrue(scheduler.schedule(update('PATCH', 'a'), {}, 1))
+        self.assertFalse(scheduler.schedule(update('PATCH', 'b'), {}, 1))
+        self.assertEqual(
+            {'depth': 1, 'scheduled': 1, 'rejected': 2}, scheduler.stats())
+
+    def test_hold_updates_of_document_with_pending_retry(self):
+        self.expected = 3
+        scheduler = RetryScheduler(self._handler, 10, 0.01, 0.01, 60)
+
+        self.assertFalse(scheduler.hold(update('PATCH', 'a'), {}))
+        scheduler.schedule(update('CREATE', 'a'), {}, 1)
+        self.assertTrue(scheduler.hold(update('PATCH', 'a'), {}))
+        self.assertTrue(scheduler.hold(update('DELETE', 'a'), {}))
+        self.assertFalse(scheduler.hold(update('PATCH', 'b'), {}))
+        self.assertEqual(3, scheduler.depth())
+
+        scheduler.start()
+        self.assertTrue(self.done.wait(5))
+        scheduler.stop()
+        self.assertEqual(
+            [('CREATE', 1), ('PATCH', 0), ('DELETE', 0)], self.handled)
+        self.assertFalse(scheduler.hold(update('PATCH', 'a'), {}))
+
+    def test_stop_hands_over_pending_updates(self):
+        scheduler = RetryScheduler(self._handler, 10, 60, 60, 600)
+        scheduler.start()
+        scheduler.schedule(update('CREATE', 'a'), {'delivery_tag': 1}, 1)
+        scheduler.hold(update('PATCH', 'a'), {'delivery_tag': 2})
+        pending = []
+
+        scheduler.stop(lambda update, kwargs: pending.append(
+            (update['action'], kwargs['delivery_tag'])))
+
+        self.assertEqual([('CREATE', 1), ('PATCH', 2)], pending)
+        self.assertEqual(0, scheduler.depth())
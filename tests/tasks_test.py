@@ -0,0 +1,111 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import unittest
+
+from mock import Mock
+
+from globomap_loader.tasks import parse_dependencies
+from globomap_loader.tasks import parse_queries
+from globomap_loader.tasks import QueryRunner
+
+
+class TestQueryRunner(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual([('q1', 'v1'), ('q2', '')],
+                         parse_queries('q1;v1,q2,'))
+        self.assertEqual({'q2': {'q1', 'q3'}, 'q4': {'q2'}},
+                         parse_dependencies('q2:q1+q3,q4:q2,'))
+
+    def test_runs_dependencies_first(self):
+        order = []
+        client = Mock()
+        client.run_query.side_effect = lambda query, variable: \
+            order.append(query)
+
+        outcomes = QueryRunner(client, 4, 5).run(
+            [('q3', ''), ('q2', ''), ('q1', '')],
+            {'q3': {'q2'}, 'q2': {'q1'}})
+
+        self.assertEqual(['q1', 'q2', 'q3'], order)
+        self.assertEqual({'ok'}, set(outcomes.values()))
+
+    def test_skips_dependents_of_failed_query(self):
+        client = Mock()
+        client.run_query.side_effect = \
+            lambda query, variable: 1 / (query != 'q1')
+
+        outcomes = QueryRunner(client, 2, 5).run(
+            [('q1', ''), ('q2', ''), ('q3', '')], {'q2': {'q1'}})
+
+        self.assertEqual({('q1', ''): 'failed', ('q2', ''): 'skipped',
+                          ('q3', ''): 'ok'}, outcomes)
+
+    def test_skips_circular_dependencies(self):
+        client = Mock()
+
+        outcomes = QueryRunner(client, 2, 5).run(
+            [('q1', ''), ('q2', '')], {'q1': {'q2'}, 'q2': {'q1'}})
+
+        self.assertEqual({'skipped'}, set(outcomes.values()))
+        client.run_query.assert_not_called()
+
+    def test_timed_out_query_keeps_its_slot_until_it_returns(self):
+        release = threading.Event()
+        calls = []
+
+        def run_query(query, variable):
+            calls.append((query, release.is_set()))
+            if query == 'slow':
+                release.wait(5)
+        client = Mock()
+        client.run_query.side_effect = run_query
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+
+        outcomes = QueryRunner(client, 1, 0.1).run(
+            [('slow', ''), ('fast', '')])
+
+        timer.cancel()
+        self.assertEqual({('slow', ''): 'timeout', ('fast', ''): 'ok'},
+                         outcomes)
+        self.assertEqual([('slow', False), ('fast', True)], calls)
+
+    def test_skips_query_still_running(self):
+        started, release = threading.Event(), threading.Event()
+
+        def run_query(query, variable):
+            started.set()
+            release.wait(5)
+        client = Mock()
+        client.run_query.side_effect = run_query
+        first = threading.Thread(
+            target=QueryRunner(client, 1, 0.1).run, args=([('slow', '')],))
+        first.start()
+
+        try:
+            self.assertTrue(started.wait(5))
+            second = QueryRunner(client, 1, 0.1).run([('slow', '')])
+        finally:
+            release.set()
+            first.join(5)
+
+        self.assertEqual({('slow', ''): 'skipped'}, second)
+        self.assertEqual(1, client.run_query.call_count)
+
+if __name__ == '__main__':
+    unittest.main()
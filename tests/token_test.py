@@ -0,0 +1,97 @@
+"""
+   Copyright 2018 Globo.com
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import threading
+import time
+import unittest
+
+from mock import Mock
+
+from globomap_loader.loader.token import parse_expires_at
+from globomap_loader.loader.token import TokenManager
+
+
+class FakeAuth(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.generate_token()
+
+    def generate_token(self):
+        time.sleep(self.delay)
+        self.calls += 1
+        self.token = 'token-{}'.format(self.calls)
+        self.auth = {'token': self.token}
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def test_parse_expires_at(self):
+        self.assertEqual(
+            0, parse_expires_at('1970-01-01T00:00:00.000000Z'))
+        self.assertEqual(60, parse_expires_at('1970-01-01T00:01:00Z'))
+        self.assertIsNone(parse_expires_at('tomorrow'))
+        self.assertIsNone(parse_expires_at(None))
+
+    def test_expiry_from_api_response(self):
+        auth = Mock(auth={'expires_at': '2030-01-01T00:00:00Z'})
+        tokens = TokenManager(auth, 3600, 60)
+
+        self.assertEqual(
+            parse_expires_at('2030-01-01T00:00:00Z'), tokens.expires_at)
+
+    def test_ensure_fresh_keeps_valid_token(self):
+        auth = FakeAuth()
+        tokens = TokenManager(auth, 3600, 60)
+
+        self.assertEqual('token-1', tokens.ensure_fresh())
+        self.assertEqual(1, auth.calls)
+
+    def test_ensure_fresh_renews_expiring_token(self):
+        auth = FakeAuth()
+        tokens = TokenManager(auth, 30, 60)
+        tokens._thread = Mock()
+
+        self.assertEqual('token-2', tokens.ensure_fresh())
+        self.assertEqual(1, tokens.stats()['refreshes'])
+
+    def test_concurrent_unauthorized_renew_once(self):
+        auth = FakeAuth(delay=0.1)
+        tokens = TokenManager(auth, 3600, 60)
+        threads = [
+            threading.Thread(target=tokens.unauthorized, args=('token-1',))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual('token-2', auth.token)
+        stats = tokens.stats()
+        self.assertEqual(1, stats['refreshes'])
+        self.assertEqual(5, stats['unauthorized'])
+        self.assertGreater(stats['refresh_latency'], 0)
+
+    def test_background_renewal(self):
+        auth = FakeAuth()
+        tokens = TokenManager(auth, 0.2, 0.1)
+        tokens.start()
+
+        deadline = time.time() + 5
+        while auth.calls < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertGreaterEqual(auth.calls, 2)